@@ -6,11 +6,46 @@
 //! directory in each respective module.
 
 use std::env;
+use std::process::{self, Command};
+use std::time::{Duration, SystemTime, UNIX_EPOCH};
 
 use bootstrap::{Build, Config};
 
 fn main() {
+    // When x.py had nothing to download or build it replaces itself with
+    // this binary instead of waiting for it, and leaves the summary of the
+    // build (and exiting with 1 on failure) to us.
+    if let Some(start) = env::var("BOOTSTRAP_START_TIME").ok().and_then(|s| s.parse().ok()) {
+        env::remove_var("BOOTSTRAP_START_TIME");
+        return supervise(start);
+    }
+
     let args = env::args().skip(1).collect::<Vec<_>>();
     let config = Config::parse(&args);
     Build::new(config).build();
 }
+
+/// Run the build in a child process and report its outcome like x.py does
+///
+/// Failures exit through `process::exit` with their own status from wherever
+/// they are detected, or panic, abort or are killed by a signal, so they are
+/// only seen reliably from the outside.
+fn supervise(start: f64) {
+    let status = env::current_exe()
+        .and_then(|exe| Command::new(exe).args(env::args_os().skip(1)).status());
+    let elapsed = SystemTime::now()
+        .duration_since(UNIX_EPOCH + Duration::from_secs_f64(start))
+        .unwrap_or_default()
+        .as_secs();
+    let elapsed = format!("{}:{:02}:{:02}", elapsed / 3600, elapsed / 60 % 60, elapsed % 60);
+    match status {
+        Ok(status) if status.success() => {
+            println!("Build completed successfully in {}", elapsed);
+        }
+        _ => {
+            eprintln!("failed to run: {}", env::args().collect::<Vec<_>>().join(" "));
+            println!("Build completed unsuccessfully in {}", elapsed);
+            process::exit(1);
+        }
+    }
+}
@@ -1,154 +1,2465 @@
 from __future__ import absolute_import, division, print_function
-import argparse
+import collections
 import contextlib
-import datetime
-import hashlib
+import errno
+import importlib
 import os
 import re
-import shutil
-import subprocess
 import sys
-import tarfile
-import tempfile
+import threading
 
-from time import time
+from time import sleep, time
 
+try:
+    import queue
+except ImportError:
+    import Queue as queue
 
-def get(url, path, verbose=False):
-    suffix = '.sha256'
-    sha_url = url + suffix
-    with tempfile.NamedTemporaryFile(delete=False) as temp_file:
-        temp_path = temp_file.name
-    with tempfile.NamedTemporaryFile(suffix=suffix, delete=False) as sha_file:
-        sha_path = sha_file.name
 
+class LazyModule(object):
+    """Stand-in for a module which is only imported once it's used
+
+    Most runs of x.py find everything up to date and never download,
+    extract or hash anything, so they shouldn't pay for importing the
+    modules doing that. The first of `names` which can be imported is used.
+
+    >>> LazyModule("no_such_module", "json").dumps([1])
+    '[1]'
+    >>> module_available(LazyModule("no_such_module"))
+    False
+    """
+    def __init__(self, *names):
+        self._names = names
+        self._module = None
+
+    def _load(self):
+        if self._module is None:
+            for name in self._names:
+                try:
+                    self._module = importlib.import_module(name)
+                    break
+                except ImportError:
+                    if name == self._names[-1]:
+                        raise
+        return self._module
+
+    def __getattr__(self, name):
+        return getattr(self._load(), name)
+
+
+def module_available(module):
+    """Check whether a LazyModule can be imported"""
     try:
-        download(sha_path, sha_url, False, verbose)
+        module._load()  # pylint: disable=protected-access
+        return True
+    except ImportError:
+        return False
+
+
+argparse = LazyModule("argparse")
+datetime = LazyModule("datetime")
+gzip = LazyModule("gzip")
+hashlib = LazyModule("hashlib")
+httplib = LazyModule("http.client", "httplib")
+json = LazyModule("json")
+lzma = LazyModule("lzma")
+multiprocessing = LazyModule("multiprocessing")
+random = LazyModule("random")
+shutil = LazyModule("shutil")
+socket = LazyModule("socket")
+ssl = LazyModule("ssl")
+struct = LazyModule("struct")
+subprocess = LazyModule("subprocess")
+tarfile = LazyModule("tarfile")
+tempfile = LazyModule("tempfile")
+urlparse = LazyModule("urllib.parse", "urlparse")
+zlib = LazyModule("zlib")
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+    import msvcrt
+
+# Size of the blocks in which downloads and tarballs are streamed and hashed
+CHUNK_SIZE = 1024 * 1024
+
+
+class Tracer(object):
+    """Record where bootstrap.py spends its time as Chrome trace events
+
+    Nothing is recorded unless a path is given, the trace is written there
+    by `write` and can be loaded into chrome://tracing or Perfetto.
+    """
+    def __init__(self, path=None):
+        self.path = path
+        self.events = []
+        self.threads = {}
+        self.lock = threading.Lock()
+        self.local = threading.local()
+
+    @contextlib.contextmanager
+    def span(self, name, category="bootstrap", **args):
+        """Record the `with` block as a span
+
+        The arguments of the span are yielded, so that the block can add
+        details like the number of bytes transferred.
+        """
+        if self.path is None:
+            yield args
+            return
+        stack = self.local.__dict__.setdefault("stack", [])
+        stack.append(args)
+        start = time()
+        try:
+            yield args
+        except BaseException as error:
+            args["error"] = str(error) or error.__class__.__name__
+            raise
+        finally:
+            stack.pop()
+            self._record(name, category, start, time(), args)
+
+    def mark(self, name, category="bootstrap", **args):
+        """Record something which took no time, like a cache hit"""
+        if self.path is not None:
+            now = time()
+            self._record(name, category, now, now, args)
+
+    def note(self, key, value):
+        """Set an argument of the innermost span of the current thread"""
+        stack = getattr(self.local, "stack", None)
+        if stack:
+            stack[-1][key] = value
+
+    def _record(self, name, category, start, end, args):
+        thread = threading.current_thread()
+        with self.lock:
+            if thread.ident not in self.threads:
+                self.threads[thread.ident] = (len(self.threads) + 1, thread.name)
+            self.events.append({
+                "name": name, "cat": category, "ph": "X",
+                "ts": int(start * 1e6), "dur": int((end - start) * 1e6),
+                "pid": os.getpid(), "tid": self.threads[thread.ident][0],
+                "args": args,
+            })
+
+    def write(self):
+        """Write the trace, if one is being recorded"""
+        if self.path is None:
+            return
+        with self.lock:
+            events = list(self.events)
+            for tid, name in self.threads.values():
+                events.append({"name": "thread_name", "ph": "M", "pid": os.getpid(),
+                               "tid": tid, "args": {"name": name}})
+        with open(self.path, "w") as trace:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, trace)
+
+
+# Set RUST_BOOTSTRAP_TRACE to a path to trace what x.py does before handing
+# over to the bootstrap binary
+tracer = Tracer(os.environ.get("RUST_BOOTSTRAP_TRACE") or None)
+
+
+def get(url, path, verbose=False, progress_bar=True, expected=None):
+    """Download `url` to `path` unless `path` already holds the right file
+
+    `expected` is the SHA-256 of the file. If it isn't known it's fetched
+    from `<url>.sha256`.
+    """
+    with tracer.span("download", url=url, bytes=0) as span:
+        if expected is None:
+            expected = fetch_sha256(url, verbose)
+        # Partial downloads are kept next to their final destination, so that a
+        # failed attempt, or a later run of x.py, can resume them.
+        part_path = path + '.part'
         if os.path.exists(path):
-            if verify(path, sha_path, False):
+            if check_sha256(path, expected, False):
                 if verbose:
                     print("using already-download file", path)
+                span["cache"] = "hit"
                 return
             else:
                 if verbose:
                     print("ignoring already-download file",
                           path, "due to failed verification")
                 os.unlink(path)
-        download(temp_path, url, True, verbose)
-        if not verify(temp_path, sha_path, verbose):
-            raise RuntimeError("failed verification")
+        span["cache"] = "miss"
+        for resume in (True, False):
+            resumed = resume and os.path.exists(part_path) and \
+                os.path.getsize(part_path) > 0
+            offset = os.path.getsize(part_path) if resumed else 0
+            if resumed:
+                print("resuming partial download of", path)
+            if dist_mirrors.covers(url):
+                found = dist_mirrors.download(part_path, url, expected, verbose, resume)
+            else:
+                found = download(part_path, url, True, verbose, progress_bar, resume)
+            if os.path.exists(part_path):
+                span["bytes"] += os.path.getsize(part_path) - offset
+            if check_sha256(part_path, expected, verbose, found):
+                break
+            delete_if_present(part_path, verbose)
+            if not resumed:
+                raise RuntimeError("failed verification")
+            # The partial data may come from an older upload of the file
+            print("discarding partial download of", path)
         if verbose:
-            print("moving {} to {}".format(temp_path, path))
-        shutil.move(temp_path, path)
+            print("moving {} to {}".format(part_path, path))
+        shutil.move(part_path, path)
+
+
+def fetch_sha256(url, verbose=False):
+    """Return the SHA-256 published for `url` in `<url>.sha256`"""
+    suffix = '.sha256'
+    with tempfile.NamedTemporaryFile(suffix=suffix, delete=False) as sha_file:
+        sha_path = sha_file.name
+    try:
+        download(sha_path, url + suffix, False, verbose)
+        return read_sha256(sha_path)
     finally:
         delete_if_present(sha_path, verbose)
-        delete_if_present(temp_path, verbose)
 
 
-def delete_if_present(path, verbose):
-    """Remove the given file if present"""
-    if os.path.isfile(path):
-        if verbose:
-            print("removing", path)
-        os.unlink(path)
+def delete_if_present(path, verbose):
+    """Remove the given file if present"""
+    if os.path.isfile(path):
+        if verbose:
+            print("removing", path)
+        os.unlink(path)
+
+
+def download(path, url, probably_big, verbose, progress_bar=True, resume=False):
+    """Download `url` to `path`, returning the SHA-256 of the whole file
+
+    With `resume`, data already in `path` is kept and only the rest of the
+    file is requested, if the server supports it. Retries always resume.
+    """
+    for attempt in range(0, 4):
+        try:
+            return _download(path, url, probably_big, verbose, True,
+                             progress_bar, resume)
+        except Cancelled:
+            raise
+        except RuntimeError as error:
+            print("\nspurious failure ({}), trying again".format(error))
+            sleep(backoff_delay(attempt))
+            http_downloader.check_cancelled()
+            resume = True
+    return _download(path, url, probably_big, verbose, False, progress_bar, True)
+
+
+def backoff_delay(attempt):
+    """Return how long to wait before retrying after `attempt` failures
+
+    This is an exponential backoff with full jitter, so that many clients
+    failing at the same time don't all come back at the same moment.
+
+    >>> 0 <= backoff_delay(0) <= 1
+    True
+    >>> 0 <= backoff_delay(3) <= 8
+    True
+    """
+    return random.uniform(0, min(30, 2 ** attempt))
+
+
+def _download(path, url, probably_big, verbose, exception, progress_bar=True,
+              resume=False):
+    if probably_big or verbose:
+        print("downloading {}".format(url))
+    if http_downloader.supports(url):
+        try:
+            return http_downloader.download(
+                path, url, (probably_big or verbose) and progress_bar, resume)
+        except RuntimeError as error:
+            if verbose or exception:
+                raise
+            sys.exit(str(error))
+    # see http://serverfault.com/questions/301128/how-to-download
+    if sys.platform == 'win32':
+        run(["PowerShell.exe", "/nologo", "-Command",
+             "[Net.ServicePointManager]::SecurityProtocol = [Net.SecurityProtocolType]::Tls12;",
+             "(New-Object System.Net.WebClient).DownloadFile('{}', '{}')".format(url, path)],
+            verbose=verbose,
+            exception=exception)
+        return sha256_file(path)
+    else:
+        if (probably_big or verbose) and progress_bar:
+            option = "-#"
+        else:
+            option = "-s"
+        sha256 = hashlib.sha256()
+        offset = 0
+        if resume and os.path.exists(path):
+            offset = os.path.getsize(path)
+            hash_file(path, sha256)
+        # The body is streamed through our stdout pipe so that it can be
+        # hashed while it arrives. curl can't rewind a pipe, so there is no
+        # `--retry` here: `download` retries the whole transfer instead.
+        with open(path, "ab" if offset else "wb") as destination:
+            try:
+                run(["curl", option,
+                     "-y", "30", "-Y", "10",    # timeout if speed is < 10 bytes/sec for > 30 seconds
+                     "--connect-timeout", "30", # timeout if cannot connect within 30 seconds
+                     "-C", str(offset), "-Sf", url],
+                    verbose=verbose,
+                    exception=exception,
+                    consume_stdout=lambda body: copy_hashed(body, destination, sha256))
+            except RuntimeError:
+                # curl refuses to resume when the server ignores ranges,
+                # make the next attempt start from scratch in that case.
+                if offset and destination.tell() == offset:
+                    destination.truncate(0)
+                raise
+        return sha256.hexdigest()
+
+
+class HttpDownloader(object):
+    """Download files over HTTP(S) within this process
+
+    Idle connections are kept alive and pooled per (scheme, host, port), so
+    fetching every stage0 artifact from the same server pays for a TCP and
+    TLS handshake once per worker thread instead of once per file.
+
+    Connecting and every single read time out after `timeout` seconds, and
+    a transfer averaging less than `low_speed_limit` bytes per second over
+    `low_speed_time` seconds is aborted, like curl's `-y 30 -Y 10` does.
+
+    Once the `cancel` event is set every transfer in progress stops with
+    Cancelled, so that a failed phase doesn't wait for the downloads of the
+    others.
+    """
+    def __init__(self, timeout=30, low_speed_limit=10, low_speed_time=30):
+        self.timeout = timeout
+        self.low_speed_limit = low_speed_limit
+        self.low_speed_time = low_speed_time
+        self.enabled = True
+        self.cancel = None
+        self.connections_opened = 0
+        self._idle = {}
+        self._lock = threading.Lock()
+
+    def check_cancelled(self):
+        """Raise Cancelled if the downloads were cancelled"""
+        if self.cancel is not None and self.cancel.is_set():
+            raise Cancelled("download cancelled")
+
+    def supports(self, url):
+        """Check whether `url` can be fetched without falling back to curl
+
+        Proxies are left to curl, which knows how to talk to them.
+        """
+        scheme = urlparse.urlsplit(url).scheme
+        if not self.enabled or scheme not in ('http', 'https'):
+            return False
+        if scheme == 'https' and not module_available(ssl):
+            return False
+        for var in ('{}_proxy'.format(scheme), 'all_proxy'):
+            if os.environ.get(var) or os.environ.get(var.upper()):
+                return False
+        return True
+
+    def download(self, path, url, progress_bar=False, resume=False, cancel=None):
+        """Write the body of `url` to `path` and return its SHA-256
+
+        With `resume`, the data already in `path` is kept and the rest of the
+        file is requested with a `Range` header. If the server ignores it the
+        whole file is downloaded again. Setting the `cancel` event makes the
+        download fail.
+
+        Raises RuntimeError if the download fails for any reason.
+        """
+        offset = 0
+        if resume and os.path.exists(path):
+            offset = os.path.getsize(path)
+        headers = {"Range": "bytes={}-".format(offset)} if offset else None
+        try:
+            key, conn, response = self.request(url, headers)
+            try:
+                sha256 = hashlib.sha256()
+                total = response.getheader("Content-Length")
+                total = int(total) if total else None
+                if offset and response.status == 206 and \
+                        content_range_start(response) == offset:
+                    hash_file(path, sha256)
+                    mode = "ab"
+                    total = total and total + offset
+                elif offset and response.status == 416:
+                    # The partial file is already complete
+                    response.read()
+                    hash_file(path, sha256)
+                    self._release(key, conn, response)
+                    return sha256.hexdigest()
+                elif response.status == 200:
+                    mode = "wb"
+                else:
+                    raise RuntimeError("failed to download {}: HTTP {} {}".format(
+                        url, response.status, response.reason))
+                with open(path, mode) as destination:
+                    if progress_bar and total:
+                        print_progress(destination.tell(), total)
+                    self._copy(response, destination, sha256,
+                               total if progress_bar else None, cancel)
+            except BaseException:
+                conn.close()
+                raise
+            self._release(key, conn, response)
+            return sha256.hexdigest()
+        except (httplib.HTTPException, socket.error) as error:
+            raise RuntimeError("failed to download {}: {}".format(url, error))
+
+    def stream(self, url, consume):
+        """Pass the body of `url` to `consume` while it's being downloaded
+
+        `consume` gets a file object from which it can read the body. A
+        background thread hashes the response and queues it up in memory, so
+        the transfer overlaps with whatever `consume` does with the data, like
+        decompressing it. Once `consume` is done the rest of the body is read
+        and its SHA-256 is returned.
+
+        Raises RuntimeError if the download fails for any reason.
+        """
+        try:
+            key, conn, response = self.request(url)
+        except (httplib.HTTPException, socket.error) as error:
+            raise RuntimeError("failed to download {}: {}".format(url, error))
+        if response.status != 200:
+            conn.close()
+            raise RuntimeError("failed to download {}: HTTP {} {}".format(
+                url, response.status, response.reason))
+        pipe = ChunkPipe()
+        sha256 = hashlib.sha256()
+        errors = []
+
+        def pump():
+            try:
+                self._copy(response, pipe, sha256)
+            except BaseException as error:  # pylint: disable=broad-except
+                errors.append(error)
+            finally:
+                pipe.close()
+
+        thread = start_thread(pump)
+        try:
+            consume(pipe)
+            pipe.drain()
+        except BaseException:
+            pipe.abort()
+            thread.join()
+            conn.close()
+            # A failed download is the reason the consumer failed, if any
+            if errors and isinstance(errors[0], Cancelled):
+                raise errors[0]
+            if errors and not isinstance(errors[0], RuntimeError):
+                raise RuntimeError("failed to download {}: {}".format(url, errors[0]))
+            raise
+        thread.join()
+        if errors:
+            conn.close()
+            if isinstance(errors[0], Cancelled):
+                raise errors[0]
+            raise RuntimeError("failed to download {}: {}".format(url, errors[0]))
+        self._release(key, conn, response)
+        tracer.note("bytes", pipe.tell())
+        return sha256.hexdigest()
+
+    def request(self, url, headers=None, method="GET"):
+        """Send a request for `url`, following redirects
+
+        Returns the pool key, the connection and the response, whose body
+        hasn't been read yet. Hand the connection back with `_release` once
+        the body is consumed, or close it.
+        """
+        for _ in range(0, 5):
+            parts = urlparse.urlsplit(url)
+            key = (parts.scheme, parts.hostname, parts.port)
+            target = parts.path or '/'
+            if parts.query:
+                target += '?' + parts.query
+            while True:
+                conn, reused = self._connect(key)
+                try:
+                    conn.request(method, target, headers=headers or {})
+                    response = conn.getresponse()
+                    break
+                except (httplib.HTTPException, socket.error):
+                    conn.close()
+                    # The server may have closed an idle connection behind
+                    # our back, only a fresh one failing is an error.
+                    if not reused:
+                        raise
+            if response.status in (301, 302, 303, 307, 308):
+                response.read()
+                self._release(key, conn, response)
+                url = urlparse.urljoin(url, response.getheader("Location"))
+                continue
+            return key, conn, response
+        raise RuntimeError("too many redirects while fetching {}".format(url))
+
+    def close(self):
+        """Close all the idle connections"""
+        with self._lock:
+            idle, self._idle = self._idle, {}
+        for conns in idle.values():
+            for conn in conns:
+                conn.close()
+
+    def _connect(self, key):
+        with self._lock:
+            idle = self._idle.get(key)
+            if idle:
+                return idle.pop(), True
+            self.connections_opened += 1
+        scheme, host, port = key
+        if scheme == 'https':
+            conn = httplib.HTTPSConnection(
+                host, port, timeout=self.timeout,
+                context=ssl.create_default_context())
+        else:
+            conn = httplib.HTTPConnection(host, port, timeout=self.timeout)
+        return conn, False
+
+    def _release(self, key, conn, response):
+        if response.will_close:
+            conn.close()
+            return
+        with self._lock:
+            self._idle.setdefault(key, []).append(conn)
+
+    def _copy(self, response, destination, sha256, total=None, cancel=None):
+        # Reads are kept small so that the speed check below runs often,
+        # each one is also bounded by the socket timeout.
+        done = destination.tell()
+        window_start = time()
+        window_bytes = 0
+        while True:
+            if cancel is not None and cancel.is_set():
+                raise RuntimeError("download cancelled")
+            self.check_cancelled()
+            chunk = response.read(64 * 1024)
+            if not chunk:
+                break
+            sha256.update(chunk)
+            destination.write(chunk)
+            done += len(chunk)
+            window_bytes += len(chunk)
+            now = time()
+            if now - window_start >= self.low_speed_time:
+                if window_bytes < self.low_speed_limit * (now - window_start):
+                    raise RuntimeError("transfer too slow, aborting")
+                window_start = now
+                window_bytes = 0
+            if total:
+                print_progress(done, total)
+        if total:
+            print()
+
+
+class ChunkPipe(object):
+    """Bounded in-memory pipe from a producer to a consumer thread
+
+    The producer calls `write` and finally `close`, the consumer reads the
+    data back like from a file. `abort` makes further writes fail.
+    """
+    def __init__(self, depth=16):
+        self._chunks = queue.Queue(depth)
+        self._buffer = b""
+        self._eof = False
+        self._written = 0
+        self._aborted = threading.Event()
+
+    def write(self, chunk):
+        """Queue up `chunk`, waiting while the pipe is full"""
+        self._put(chunk)
+        self._written += len(chunk)
+
+    def tell(self):
+        """Return how many bytes were written"""
+        return self._written
+
+    def close(self):
+        """Signal the end of the data"""
+        try:
+            self._put(None)
+        except RuntimeError:
+            pass
+
+    def abort(self):
+        """Make the producer fail, the consumer is done"""
+        self._aborted.set()
+
+    def _put(self, chunk):
+        while True:
+            if self._aborted.is_set():
+                raise RuntimeError("reader went away")
+            try:
+                self._chunks.put(chunk, True, 0.1)
+                return
+            except queue.Full:
+                pass
+
+    def read(self, size=-1):
+        """Read up to `size` bytes, or everything if `size` is negative
+
+        Like for sockets, fewer bytes may be returned, but only an empty
+        string means the end of the data.
+        """
+        while not self._eof and (not self._buffer or size < 0):
+            chunk = self._chunks.get()
+            if chunk is None:
+                self._eof = True
+            else:
+                self._buffer += chunk
+        if size < 0:
+            size = len(self._buffer)
+        data, self._buffer = self._buffer[:size], self._buffer[size:]
+        return data
+
+    def drain(self):
+        """Read and drop everything that's left"""
+        while self.read(CHUNK_SIZE):
+            pass
+
+
+def content_range_start(response):
+    """Return the first byte position of a 206 response, or None"""
+    match = re.match(r'bytes\s+(\d+)-', response.getheader("Content-Range") or "")
+    return int(match.group(1)) if match else None
+
+
+def print_progress(done, total):
+    """Draw a curl-like progress bar for a download of `total` bytes"""
+    width = 72
+    filled = width * done // total
+    sys.stdout.write("\r{}{} {:5.1f}%".format(
+        "#" * filled, " " * (width - filled), 100.0 * done / total))
+    sys.stdout.flush()
+
+
+http_downloader = HttpDownloader()
+
+
+class MirrorSet(object):
+    """Dist servers carrying copies of the files of a trusted primary server
+
+    Files below the primary's URL are downloaded from whichever server,
+    the primary included, answered a probe the fastest. If that transfer
+    slows down below `race_speed` bytes per second for `race_time` seconds
+    the next server is raced against it and the first to deliver a file
+    matching its checksum wins. Servers which fail are skipped in favour of
+    the next one. Checksums are never taken from the mirrors, the caller
+    fetches them from the primary.
+    """
+    def __init__(self, primary=None, mirrors=(), downloader=None, probe_timeout=5,
+                 race_speed=64 * 1024, race_time=10):
+        self.primary = None
+        self.mirrors = []
+        self.downloader = downloader or http_downloader
+        self.probe_timeout = probe_timeout
+        self.race_speed = race_speed
+        self.race_time = race_time
+        self._ranking = None
+        self._lock = threading.Lock()
+        if primary is not None:
+            self.configure(primary, mirrors)
+
+    def configure(self, primary, mirrors):
+        """Set the trusted primary server and its mirrors"""
+        self.primary = primary.rstrip("/")
+        self.mirrors = [mirror.rstrip("/") for mirror in mirrors
+                        if mirror.rstrip("/") != self.primary]
+        self._ranking = None
+
+    def covers(self, url):
+        """Check whether `url` can be downloaded from the mirrors"""
+        return bool(self.mirrors) and url.startswith(self.primary + "/") and \
+            self.downloader.supports(url)
+
+    def urls(self, url):
+        """Return the URLs `url` can be downloaded from, fastest first"""
+        if not self.covers(url):
+            return [url]
+        path = url[len(self.primary):]
+        return [server + path for server in self.rank(url)]
+
+    def rank(self, url):
+        """Return the servers ordered by how fast they answered a probe
+
+        They're probed once, with a HEAD request for `url`, and servers
+        failing the probe come last.
+        """
+        with self._lock:
+            if self._ranking is not None:
+                return self._ranking
+            servers = [self.primary] + self.mirrors
+            path = url[len(self.primary):]
+            prober = HttpDownloader(timeout=self.probe_timeout)
+
+            def probe(server):
+                start = time()
+                try:
+                    _, conn, response = prober.request(server + path, method="HEAD")
+                    response.read()
+                    conn.close()
+                except (httplib.HTTPException, socket.error, RuntimeError):
+                    return None
+                if response.status != 200:
+                    return None
+                return time() - start
+
+            latencies = dict(parallel_imap(probe, servers, len(servers)))
+            self._ranking = sorted(servers, key=lambda server: (
+                latencies[server] is None, latencies[server], servers.index(server)))
+            return self._ranking
+
+    def download(self, path, url, expected, verbose=False, resume=False):
+        """Download `url` to `path` and return its SHA-256
+
+        The file must match `expected`, else the next server is tried. Raises
+        RuntimeError if no server delivered it.
+        """
+        pending = self.urls(url)
+        results = queue.Queue()
+        running = {}
+        # (time, size) samples of the only running transfer
+        progress = []
+
+        def start(source, target, resume):
+            cancel = threading.Event()
+            running[source] = (target, cancel)
+            del progress[:]
+            print("downloading {}".format(source))
+
+            def fetch():
+                try:
+                    found = self.downloader.download(target, source, resume=resume,
+                                                     cancel=cancel)
+                    results.put((source, found, None))
+                except BaseException as error:  # pylint: disable=broad-except
+                    results.put((source, None, error))
+            start_thread(fetch)
+
+        def slow():
+            target = list(running.values())[0][0]
+            now = time()
+            progress.append((now, os.path.getsize(target) if os.path.exists(target) else 0))
+            while len(progress) > 1 and progress[1][0] <= now - self.race_time:
+                progress.pop(0)
+            elapsed = now - progress[0][0]
+            return elapsed >= self.race_time and \
+                progress[-1][1] - progress[0][1] < self.race_speed * elapsed
+
+        start(pending.pop(0), path, resume)
+        while running:
+            try:
+                source, found, error = results.get(True, 1)
+            except queue.Empty:
+                if len(running) == 1 and pending and slow():
+                    print("download is slow, racing another mirror")
+                    start(pending.pop(0), path + ".race", False)
+                continue
+            target, _ = running.pop(source)
+            if error is None and found == expected:
+                for _, cancel in running.values():
+                    cancel.set()
+                # The losers have to stop writing before their files go
+                while running:
+                    other = results.get(True, 365 * 24 * 3600)[0]
+                    delete_if_present(running.pop(other)[0], verbose)
+                if target != path:
+                    shutil.move(target, path)
+                return found
+            if error is None:
+                print("invalid checksum for {}".format(source))
+                delete_if_present(target, verbose)
+            else:
+                print("failed to download {}: {}".format(source, error))
+                # Mirrors carry identical files, so the next one can resume
+                # a partial download of another
+                if target != path:
+                    delete_if_present(target, verbose)
+            if not running and pending:
+                start(pending.pop(0), path, True)
+        raise RuntimeError("failed to download {} from any mirror".format(url))
+
+
+# Configured by bootstrap() from RUST_DIST_MIRRORS or build.dist-mirrors
+dist_mirrors = MirrorSet()
+
+
+def copy_hashed(source, destination, sha256):
+    """Copy `source` to `destination` in fixed-size chunks, hashing each one
+
+    Stops with Cancelled once the downloads were cancelled, see
+    HttpDownloader.
+    """
+    while True:
+        http_downloader.check_cancelled()
+        chunk = source.read(CHUNK_SIZE)
+        if not chunk:
+            break
+        sha256.update(chunk)
+        destination.write(chunk)
+
+
+def hash_file(path, sha256):
+    """Feed the contents of the given file to `sha256` in fixed-size chunks"""
+    with open(path, "rb") as source:
+        while True:
+            chunk = source.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            sha256.update(chunk)
+
+
+def sha256_file(path):
+    """Return the SHA-256 of the given file, read in fixed-size chunks"""
+    sha256 = hashlib.sha256()
+    hash_file(path, sha256)
+    return sha256.hexdigest()
+
+
+def verify(path, sha_path, verbose, found=None):
+    """Check if the sha256 sum of the given path is valid
+
+    `found` is the digest of `path` if it is already known, for example
+    because it was computed while the file was being downloaded.
+    """
+    return check_sha256(path, read_sha256(sha_path), verbose, found)
+
+
+def read_sha256(sha_path):
+    """Return the checksum stored in a `sha256sum`-style file"""
+    with open(sha_path, "r") as sha256sum:
+        return sha256sum.readline().split()[0]
+
+
+def check_sha256(path, expected, verbose, found=None):
+    """Check if the sha256 sum of the given path is `expected`"""
+    if verbose:
+        print("verifying", path)
+    if found is None:
+        with tracer.span("verify", path=path):
+            found = sha256_file(path)
+    verified = found == expected
+    if not verified:
+        print("invalid checksum:\n"
+              "    found:    {}\n"
+              "    expected: {}".format(found, expected))
+    return verified
+
+
+class FileLock(object):
+    """Advisory lock on `path`, shared between processes
+
+    Locks are taken with flock() on Unix and msvcrt.locking() on Windows,
+    where shared locks are exclusive. The operating system releases them
+    when the process holding them exits, even if it crashes. On file systems
+    without flock(), like some network file systems, `flock` is cleared and
+    an exclusive lock is a `<path>.owner` file naming the host and process
+    which holds it instead, such a file left behind by a process which is
+    gone is removed.
+
+    A blocking `acquire` waits at most `timeout` seconds, or forever if it's
+    None, and then gives up with an error naming the holder of the lock.
+    The holder of an exclusive lock may `remove` its file along with what it
+    guards, a lock taken on the removed file in the meantime doesn't count.
+    """
+    def __init__(self, path, shared=False, timeout=None):
+        self.path = path
+        self.shared = shared
+        self.timeout = timeout
+        self.flock = fcntl is not None
+        self._fd = None
+        self._owner = None
+
+    def acquire(self, blocking=True):
+        """Take the lock, returns False if `blocking` is not set and the lock
+        is held by somebody else"""
+        deadline = None if self.timeout is None else time() + self.timeout
+        delay = None
+        while not self._try_acquire():
+            if not blocking:
+                return False
+            if deadline is not None and time() >= deadline:
+                raise RuntimeError("timed out after {}s waiting for the lock on {}{}".format(
+                    self.timeout, self.path, self.holder()))
+            if delay is None:
+                print("waiting for the lock on {}{}".format(self.path, self.holder()))
+                delay = 0.05
+            sleep(delay)
+            delay = min(1.0, delay * 2)
+        return True
+
+    def _try_acquire(self):
+        if not self.flock and fcntl is not None:
+            return self._create_owner()
+        while True:
+            fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o666)
+            try:
+                if fcntl is not None:
+                    flags = fcntl.LOCK_SH if self.shared else fcntl.LOCK_EX
+                    fcntl.flock(fd, flags | fcntl.LOCK_NB)
+                else:
+                    msvcrt.locking(fd, msvcrt.LK_NBLCK, 1)
+            except (IOError, OSError) as error:
+                os.close(fd)
+                if fcntl is not None and \
+                        error.errno in (errno.ENOLCK, errno.EOPNOTSUPP, errno.ENOSYS):
+                    self.flock = False
+                    return self._create_owner()
+                return False
+            if fcntl is None or self._opened(fd):
+                break
+            # The file was removed by the previous holder, lock the new one
+            os.close(fd)
+        self._fd = fd
+        if fcntl is not None and not self.shared:
+            # Let whoever waits for the lock know who they are waiting for
+            os.ftruncate(fd, 0)
+            os.write(fd, self._owner_id())
+            os.lseek(fd, 0, os.SEEK_SET)
+        return True
+
+    def _create_owner(self):
+        """Take the lock by creating `<path>.owner`"""
+        owner = self.path + ".owner"
+        try:
+            fd = os.open(owner, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666)
+        except OSError as error:
+            if error.errno != errno.EEXIST:
+                raise
+            if self._stale():
+                self._break(owner)
+            return False
+        try:
+            os.write(fd, self._owner_id())
+        finally:
+            os.close(fd)
+        self._owner = owner
+        return True
+
+    def _opened(self, fd):
+        """Return whether `fd` is the file currently at `path`"""
+        try:
+            current = os.stat(self.path)
+        except OSError:
+            return False
+        opened = os.fstat(fd)
+        return (current.st_dev, current.st_ino) == (opened.st_dev, opened.st_ino)
+
+    @staticmethod
+    def _owner_id():
+        return "{} {}\n".format(os.getpid(), socket.gethostname()).encode("utf-8")
+
+    def _read_owner(self):
+        """Return the `(pid, host)` of the holder of the lock, if known"""
+        path = self.path if self.flock else self.path + ".owner"
+        try:
+            with open(path, "r") as owner:
+                pid, host = owner.read().split()
+            return int(pid), host
+        except (IOError, OSError, ValueError):
+            return None
+
+    def _break(self, owner):
+        """Remove the stale `owner` file
+
+        Only one process at a time may do this, and it checks again that the
+        lock is stale once it's allowed to: somebody else could have removed
+        it and taken the lock in the meantime.
+        """
+        try:
+            fd = os.open(owner + ".break", os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666)
+        except OSError:
+            return
+        os.close(fd)
+        try:
+            if self._stale():
+                print("removing stale lock {}{}".format(owner, self.holder()))
+                delete_if_present(owner, False)
+        finally:
+            os.unlink(owner + ".break")
+
+    def _stale(self):
+        """Return whether the lock is held by a process of this host which is
+        gone"""
+        holder = self._read_owner()
+        if holder is None or holder[1] != socket.gethostname():
+            return False
+        try:
+            os.kill(holder[0], 0)
+        except OSError as error:
+            return error.errno == errno.ESRCH
+        return False
+
+    def holder(self):
+        """Describe who holds the lock for messages, if that's known"""
+        holder = self._read_owner()
+        if holder is None:
+            return ""
+        return " (held by process {} on {})".format(*holder)
+
+    def downgrade(self):
+        """Turn an exclusive lock into a shared one
+
+        flock() briefly releases the lock while converting it, somebody else
+        may take it and `remove` it in between. Returns False if that
+        happened, the lock isn't held anymore then.
+        """
+        self.shared = True
+        if fcntl is not None and self._fd is not None:
+            os.ftruncate(self._fd, 0)
+            fcntl.flock(self._fd, fcntl.LOCK_SH)
+            if not self._opened(self._fd):
+                self.release()
+                return False
+        return True
+
+    def release(self):
+        """Release the lock if it is held"""
+        if self._owner is not None:
+            delete_if_present(self._owner, False)
+            self._owner = None
+        if self._fd is None:
+            return
+        if fcntl is not None:
+            if not self.shared:
+                os.ftruncate(self._fd, 0)
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+        else:
+            os.lseek(self._fd, 0, os.SEEK_SET)
+            msvcrt.locking(self._fd, msvcrt.LK_UNLCK, 1)
+        os.close(self._fd)
+        self._fd = None
+
+    def remove(self):
+        """Delete the file of an exclusive lock and release the lock
+
+        Files which are still open can't be deleted on Windows, in which case
+        the file is left behind.
+        """
+        try:
+            os.unlink(self.path)
+        except OSError:
+            pass
+        self.release()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *args):
+        self.release()
+
+
+class Stage0Cache(object):
+    """Machine-wide cache of stage0 tarballs, addressed by their SHA-256
+
+    Every tarball lives in `<root>/sha256/<sha256>/<filename>`, so all the
+    build directories and worktrees of a machine can share one download.
+    An entry is populated under an exclusive lock and kept under a shared
+    lock while it is in use. The modification time of an entry is bumped
+    whenever it is used, and `prune` evicts the least recently used entries
+    until the cache fits in `max_size` bytes. Toolchains extracted in
+    `<root>/toolchains` or the given `store`, and bootstrap binaries kept in
+    `<root>/bootstrap` count as entries as well.
+    """
+    # Directories of trees which are evicted like tarballs, and how deep
+    # below them the trees are
+    TREES = [("toolchains", 3), ("bootstrap", 1)]
+
+    def __init__(self, root, max_size=None, lock_timeout=None, store=None):
+        self.root = root
+        self.max_size = max_size
+        self.lock_timeout = lock_timeout
+        self.store = store
+
+    def entry(self, sha256):
+        """Return the directory holding the tarball with the given hash"""
+        return os.path.join(self.root, "sha256", sha256)
+
+    def lock(self, sha256, shared=False):
+        """Return the lock guarding the given entry"""
+        return self.lock_path(self.entry(sha256), shared)
+
+    def lock_path(self, path, shared=False):
+        """Return the lock guarding the entry or tree at `path`"""
+        return FileLock(path + ".lock", shared, self.lock_timeout)
+
+    def fetch(self, url, filename, verbose=False, progress_bar=True, expected=None,
+              delta=False):
+        """Make sure the tarball published at `url` is in the cache
+
+        Returns its path along with a shared lock on it, which prevents it
+        from being evicted until it's released. `expected` is the SHA-256 of
+        the tarball, when it's known no request is made for a cached one.
+        With `delta`, a missing tarball is first looked for as a delta
+        against a cached one.
+        """
+        if expected is None:
+            expected = fetch_sha256(url, verbose)
+        entry = self.entry(expected)
+        try:
+            os.makedirs(os.path.dirname(entry))
+        except OSError:
+            if not os.path.isdir(os.path.dirname(entry)):
+                raise
+        path = os.path.join(entry, filename)
+        while True:
+            lock = self.lock(expected)
+            lock.acquire()
+            try:
+                # Only created now, `prune` could evict it until the lock is held
+                if not os.path.isdir(entry):
+                    os.makedirs(entry)
+                if os.path.exists(path):
+                    if verbose:
+                        print("using cached file", path)
+                    os.utime(path, None)
+                    tracer.mark("download", url=url, bytes=0, cache="hit")
+                elif not (delta and self.patch(url, path, expected, verbose)):
+                    get(url, path, verbose, progress_bar, expected)
+                downgraded = lock.downgrade()
+            except BaseException:
+                lock.release()
+                raise
+            if downgraded and os.path.exists(path):
+                return path, lock
+            # Evicted while the lock was being downgraded, fetch it again
+            lock.release()
+
+    def patch(self, url, path, expected, verbose=False):
+        """Try to create `path` from a delta against the most recently used
+        tarball of the same component, see `fetch_delta`"""
+        component = stage0_component(os.path.basename(path))
+        if component is None:
+            return False
+        for sha256, names, _, _ in reversed(self.entries()):
+            bases = [name for name in names if stage0_component(name) == component]
+            if sha256 == expected or not bases:
+                continue
+            # The base must not be evicted while it's being read
+            lock = self.lock(sha256, shared=True)
+            if not lock.acquire(blocking=False):
+                return False
+            try:
+                return fetch_delta(url, path, os.path.join(self.entry(sha256), bases[0]),
+                                   sha256, expected, verbose)
+            finally:
+                lock.release()
+        return False
+
+    def entries(self):
+        """Return the `(sha256, filenames, size, last_used)` of every entry,
+        least recently used first"""
+        entries = []
+        objects = os.path.join(self.root, "sha256")
+        if not os.path.isdir(objects):
+            return entries
+        for sha256 in os.listdir(objects):
+            entry = os.path.join(objects, sha256)
+            if not os.path.isdir(entry):
+                continue
+            files = [os.path.join(entry, name) for name in os.listdir(entry)]
+            size = sum(os.path.getsize(name) for name in files)
+            last_used = max([os.path.getmtime(name) for name in files] or
+                            [os.path.getmtime(entry)])
+            names = sorted(os.path.basename(name) for name in files)
+            entries.append((sha256, names, size, last_used))
+        entries.sort(key=lambda entry: entry[3])
+        return entries
+
+    def trees(self):
+        """Return the `(path, names, size, last_used)` of every tree in the
+        cache, least recently used first
+
+        The modification time of the top directory of a tree is bumped
+        whenever it's used.
+        """
+        areas = [(os.path.join(self.root, area), depth) for area, depth in self.TREES]
+        if self.store is not None and \
+                os.path.abspath(self.store) != os.path.abspath(areas[0][0]):
+            areas.append((self.store, areas[0][1]))
+        trees = []
+        for area, depth in areas:
+            paths = [area]
+            for _ in range(depth):
+                paths = [os.path.join(path, name)
+                         for path in paths if os.path.isdir(path)
+                         for name in os.listdir(path)
+                         # Trees are only complete once they are renamed
+                         if ".tmp-" not in name and not name.endswith(".lock")]
+            for path in paths:
+                if not os.path.isdir(path):
+                    continue
+                size = sum(os.lstat(os.path.join(root, name)).st_size
+                           for root, dirs, files in os.walk(path)
+                           for name in files + dirs)
+                trees.append((path, sorted(os.listdir(path)), size,
+                              os.path.getmtime(path)))
+        trees.sort(key=lambda tree: tree[3])
+        return trees
+
+    def describe(self, path):
+        """Return how an entry or tree is named in messages, relative to the
+        cache unless it's outside of it"""
+        relative = os.path.relpath(path, self.root)
+        return path if relative.startswith(os.pardir) else relative
+
+    def evictable(self):
+        """Return the `(path, names, size, last_used)` of every tarball
+        entry and tree, least recently used first"""
+        entries = [(self.entry(entry[0]),) + entry[1:] for entry in self.entries()]
+        entries.extend(self.trees())
+        entries.sort(key=lambda entry: entry[3])
+        return entries
+
+    def size(self):
+        """Return how many bytes the cache holds"""
+        return sum(entry[2] for entry in self.evictable())
+
+    def verify(self):
+        """Evict the entries whose tarball doesn't match their SHA-256,
+        entries in use are skipped. Returns the evicted entries."""
+        evicted = []
+        for entry in self.entries():
+            path = self.entry(entry[0])
+            if all(sha256_file(os.path.join(path, name)) == entry[0]
+                   for name in entry[1] if not name.endswith(".part")):
+                continue
+            lock = self.lock(entry[0])
+            if not lock.acquire(blocking=False):
+                continue
+            try:
+                print("evicting corrupt", ", ".join(entry[1]), "from the stage0 cache")
+                shutil.rmtree(path)
+            except BaseException:
+                lock.release()
+                raise
+            lock.remove()
+            evicted.append(entry)
+        return evicted
+
+    def prune(self, max_size=None, verbose=False):
+        """Evict least recently used entries and trees until at most
+        `max_size` bytes are left, the ones in use are skipped. Their lock
+        files are deleted with them. Returns the `(path, names, size,
+        last_used)` of the evicted ones."""
+        if max_size is None:
+            max_size = self.max_size
+        if max_size is None:
+            return []
+        entries = self.evictable()
+        total = sum(entry[2] for entry in entries)
+        evicted = []
+        for entry in entries:
+            if total <= max_size:
+                break
+            lock = self.lock_path(entry[0])
+            if not lock.acquire(blocking=False):
+                continue
+            try:
+                if verbose:
+                    print("evicting", self.describe(entry[0]),
+                          "from the stage0 cache")
+                shutil.rmtree(entry[0])
+            except BaseException:
+                lock.release()
+                raise
+            lock.remove()
+            total -= entry[2]
+            evicted.append(entry)
+        return evicted
+
+
+def parse_size(size):
+    """Parse a size in bytes with an optional K, M, G or T suffix
+
+    >>> parse_size("512")
+    512
+    >>> parse_size("10G")
+    10737418240
+    >>> parse_size("1.5k")
+    1536
+    """
+    size = str(size).strip().upper().rstrip("B")
+    units = "KMGT"
+    if size and size[-1] in units:
+        return int(float(size[:-1]) * 1024 ** (units.index(size[-1]) + 1))
+    return int(size)
+
+
+def unpack(tarball, tarball_suffix, dst, verbose=False, match=None):
+    """Unpack the given tarball file"""
+    print("extracting", tarball)
+    fname = os.path.basename(tarball).replace(tarball_suffix, "")
+    with tracer.span("unpack", tarball=tarball), open(tarball, "rb") as source:
+        unpack_stream(source, tarball_suffix, fname, dst, verbose, match)
+
+
+def unpack_stream(source, tarball_suffix, fname, dst, verbose=False, match=None):
+    """Unpack a tarball read from the `source` file object
+
+    The archive is decompressed exactly once, as a stream. The `fname`
+    directory and the `match` component prefix are stripped from every
+    member on the fly and members are written straight to their final
+    location under `dst`.
+    """
+    mode = "r|xz" if tarball_suffix.endswith(".xz") else "r|gz"
+    # Newer Pythons warn unless told how far to trust the archive
+    extract_args = {"filter": "tar"} if hasattr(tarfile, "tar_filter") else {}
+
+    def destination(member):
+        if "/" not in member:
+            return None
+        name = member.replace(fname + "/", "", 1)
+        if match is not None:
+            if not name.startswith(match):
+                return None
+            name = name[len(match) + 1:]
+        return name
+
+    with contextlib.closing(tarfile.open(fileobj=source, mode=mode)) as tar:
+        for member in tar:
+            name = destination(member.name)
+            if not name:
+                continue
+            if verbose:
+                print("  extracting", member.name)
+            dst_path = os.path.join(dst, name)
+            if member.isdir():
+                if not os.path.isdir(dst_path):
+                    os.makedirs(dst_path)
+                continue
+            parent = os.path.dirname(dst_path)
+            if not os.path.isdir(parent):
+                os.makedirs(parent)
+            # Replace rather than overwrite existing files, they may be
+            # hard links to files which must not change.
+            if os.path.lexists(dst_path):
+                os.unlink(dst_path)
+            member.name = name
+            if member.islnk():
+                member.linkname = destination(member.linkname) or member.linkname
+            tar.extract(member, dst, **extract_args)
+
+
+def promote(staging, dst, verbose=False):
+    """Move everything from the `staging` directory into `dst`
+
+    Existing files are replaced. Each file is renamed into place, so `dst`
+    never contains partially written files. `staging` is removed afterwards.
+    """
+    for root, dirs, files in os.walk(staging):
+        target_dir = os.path.normpath(os.path.join(dst, os.path.relpath(root, staging)))
+        if not os.path.isdir(target_dir):
+            os.makedirs(target_dir)
+        # Links to directories are moved like files
+        links = [name for name in dirs if os.path.islink(os.path.join(root, name))]
+        dirs[:] = [name for name in dirs if name not in links]
+        for name in files + links:
+            target = os.path.join(target_dir, name)
+            if verbose:
+                print("  installing", target)
+            if sys.platform == 'win32' and os.path.lexists(target):
+                os.unlink(target)
+            os.rename(os.path.join(root, name), target)
+    shutil.rmtree(staging)
+
+
+def materialize(src, dst, verbose=False):
+    """Recreate the tree `src` under `dst` without copying data if possible
+
+    Files are reflinked (copy-on-write clones) where the file system supports
+    it, hard linked otherwise and copied as a last resort. Existing files in
+    `dst` are replaced.
+    """
+    can_reflink = [True]
+    for root, dirs, files in os.walk(src):
+        target_dir = os.path.normpath(os.path.join(dst, os.path.relpath(root, src)))
+        if not os.path.isdir(target_dir):
+            os.makedirs(target_dir)
+        links = [name for name in dirs if os.path.islink(os.path.join(root, name))]
+        dirs[:] = [name for name in dirs if name not in links]
+        for name in files + links:
+            source = os.path.join(root, name)
+            target = os.path.join(target_dir, name)
+            if verbose:
+                print("  linking", target)
+            if os.path.lexists(target):
+                os.unlink(target)
+            if os.path.islink(source):
+                os.symlink(os.readlink(source), target)
+                continue
+            if can_reflink[0]:
+                if reflink(source, target):
+                    continue
+                can_reflink[0] = False
+            try:
+                os.link(source, target)
+            except (AttributeError, OSError):
+                shutil.copy2(source, target)
+
+
+def reflink(src, dst):
+    """Make `dst` a copy-on-write clone of `src`, returns False if the
+    platform or the file system doesn't support it"""
+    if fcntl is None or not sys.platform.startswith('linux'):
+        return False
+    ficlone = 0x40049409
+    with open(src, 'rb') as source:
+        with open(dst, 'wb') as target:
+            try:
+                fcntl.ioctl(target.fileno(), ficlone, source.fileno())
+                cloned = True
+            except (IOError, OSError):
+                cloned = False
+    if not cloned:
+        os.unlink(dst)
+        return False
+    shutil.copystat(src, dst)
+    return True
+
+
+def run(args, verbose=False, exception=False, consume_stdout=None, **kwargs):
+    """Run a child program in a new process
+
+    If `consume_stdout` is given it is called with the pipe connected to the
+    standard output of the child while the child is running.
+    """
+    if verbose:
+        print("running: " + ' '.join(args))
+    sys.stdout.flush()
+    if consume_stdout is not None:
+        kwargs["stdout"] = subprocess.PIPE
+    # Use Popen here instead of call() as it apparently allows powershell on
+    # Windows to not lock up waiting for input presumably.
+    ret = subprocess.Popen(args, **kwargs)
+    if consume_stdout is not None:
+        with contextlib.closing(ret.stdout):
+            consume_stdout(ret.stdout)
+    code = ret.wait()
+    if code != 0:
+        err = "failed to run: " + ' '.join(args)
+        if verbose or exception:
+            raise RuntimeError(err)
+        sys.exit(err)
+
+
+def run_help(args, verbose=False, **kwargs):
+    """Run bootstrap to print help, passing its output on while it runs
+
+    Returns 0, or 1 if bootstrap failed in any way, along with everything
+    printed, which on failure ends with the command which failed, like for
+    other commands.
+    """
+    printed = []
+    stdout = getattr(sys.stdout, 'buffer', sys.stdout)
+
+    def tee(pipe):
+        for line in iter(pipe.readline, b''):
+            printed.append(line)
+            stdout.write(line)
+            sys.stdout.flush()
+    try:
+        run(args, verbose=verbose, exception=True, consume_stdout=tee, **kwargs)
+        status = 0
+    except RuntimeError as error:
+        status = 1
+        printed.append("{}\n".format(error).encode('utf-8'))
+        stdout.write(printed[-1])
+        sys.stdout.flush()
+    return status, b''.join(printed).decode('utf-8', 'replace')
+
+
+def parallel_imap(func, items, jobs, cancel=None):
+    """Call `func` on every item using a pool of at most `jobs` threads
+
+    `(item, result)` pairs are yielded in completion order. If any call
+    raises, the items which haven't been started yet are dropped and the
+    exception is re-raised in the caller once the running calls finished.
+    Once the `cancel` event is set no further calls are started either, and
+    Cancelled is raised instead.
+
+    >>> sorted(parallel_imap(lambda x: x * 2, [1, 2, 3], 2))
+    [(1, 2), (2, 4), (3, 6)]
+    """
+    def check_cancelled():
+        if cancel is not None and cancel.is_set():
+            raise Cancelled("cancelled")
+
+    items = list(items)
+    if jobs <= 1 or len(items) <= 1:
+        for item in items:
+            check_cancelled()
+            yield item, func(item)
+        return
+
+    pending = queue.Queue()
+    for item in items:
+        pending.put(item)
+    results = queue.Queue()
+    cancelled = threading.Event()
+
+    def worker():
+        while not cancelled.is_set():
+            try:
+                item = pending.get_nowait()
+            except queue.Empty:
+                return
+            try:
+                check_cancelled()
+                results.put((item, func(item), None))
+            except BaseException as error:  # pylint: disable=broad-except
+                results.put((item, None, error))
+
+    threads = [start_thread(worker) for _ in range(min(jobs, len(items)))]
+    try:
+        for _ in items:
+            # A timeout keeps the wait interruptible with Ctrl-C on Python 2
+            item, result, error = results.get(True, 365 * 24 * 3600)
+            if error is not None:
+                raise error
+            yield item, result
+    finally:
+        cancelled.set()
+        for thread in threads:
+            thread.join()
+
+
+class Cancelled(RuntimeError):
+    """Raised by work given up on because another phase failed"""
+
+
+def start_thread(target, *args):
+    """Start a daemon thread running `target`
+
+    The new thread belongs to the same phase as the current one, so that
+    PhaseOutput attributes its output correctly.
+    """
+    thread = threading.Thread(target=target, args=args)
+    thread.daemon = True
+    thread.phase = getattr(threading.current_thread(), "phase", None)
+    thread.start()
+    return thread
+
+
+class PhaseOutput(object):
+    """Stand-in for sys.stdout while several phases run concurrently
+
+    Only the earliest phase which hasn't finished yet writes through, the
+    output of the others is held back until every phase before them has
+    finished. Output from threads outside of any phase always writes
+    through.
+    """
+    def __init__(self, stream, phases):
+        self.stream = stream
+        self.phases = list(phases)
+        self.buffers = dict((phase, []) for phase in self.phases)
+        self.finished = set()
+        self.live = self.phases[0] if self.phases else None
+        self.lock = threading.Lock()
+
+    def write(self, data):
+        phase = getattr(threading.current_thread(), "phase", None)
+        with self.lock:
+            if phase is None or phase == self.live:
+                self.stream.write(data)
+            else:
+                self.buffers[phase].append(data)
+
+    def flush(self):
+        self.stream.flush()
+
+    def finish(self, phase):
+        """Mark `phase` as finished and pass on the held back output"""
+        with self.lock:
+            self.finished.add(phase)
+            while self.live in self.finished:
+                index = self.phases.index(self.live) + 1
+                self.live = self.phases[index] if index < len(self.phases) else None
+                if self.live is not None:
+                    self.stream.write("".join(self.buffers.pop(self.live)))
+            self.stream.flush()
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+
+def run_phases(phases, cancel=None):
+    """Run `(name, func, dependencies)` phases concurrently
+
+    Each phase is started in its own thread as soon as all the phases it
+    depends on have finished, and its output is kept together as described
+    in PhaseOutput. After the first failure no further phases are started
+    and the `cancel` event is set, which the phases check in their loops to
+    give up early. The ones still running are waited for and the failure is
+    re-raised.
+
+    >>> order = []
+    >>> run_phases([("b", lambda: order.append("b"), ["a"]),
+    ...             ("a", lambda: order.append("a"), [])])
+    >>> order
+    ['a', 'b']
+    """
+    router = PhaseOutput(sys.stdout, [name for name, _, _ in phases])
+    results = queue.Queue()
+    started = set()
+    finished = set()
+    running = 0
+    failure = None
+
+    def phase(name, func):
+        threading.current_thread().phase = name
+        threading.current_thread().name = name
+        try:
+            with tracer.span(name, category="phase"):
+                func()
+        except BaseException as error:  # pylint: disable=broad-except
+            results.put((name, error))
+        else:
+            results.put((name, None))
+
+    sys.stdout.flush()
+    sys.stdout = router
+    try:
+        while True:
+            if failure is None:
+                for name, func, dependencies in phases:
+                    if name not in started and all(dep in finished for dep in dependencies):
+                        started.add(name)
+                        running += 1
+                        start_thread(phase, name, func)
+            if not running:
+                break
+            # A timeout keeps the wait interruptible with Ctrl-C on Python 2
+            name, error = results.get(True, 365 * 24 * 3600)
+            running -= 1
+            router.finish(name)
+            if error is None:
+                finished.add(name)
+            elif failure is None:
+                failure = error
+                if cancel is not None:
+                    cancel.set()
+    finally:
+        # Phases which never started hold back nothing but their successors
+        for name, _, _ in phases:
+            router.finish(name)
+        sys.stdout = router.stream
+    if failure is not None:
+        raise failure
+    if len(finished) != len(phases):
+        raise Exception("phases with unmet dependencies: {}".format(", ".join(
+            name for name, _, _ in phases if name not in finished)))
+
+
+def git_dir(path):
+    """Return the git directory of the checkout at `path`, or None
+
+    Submodules have a `.git` file pointing at their directory inside of
+    the superproject's `.git/modules`.
+    """
+    dot_git = os.path.join(path, ".git")
+    if os.path.isdir(dot_git):
+        return dot_git
+    try:
+        with open(dot_git) as gitfile:
+            line = gitfile.readline().strip()
+    except (IOError, OSError):
+        return None
+    if not line.startswith("gitdir:"):
+        return None
+    return os.path.normpath(os.path.join(path, line[len("gitdir:"):].strip()))
+
+
+def read_git_head(gitdir):
+    """Resolve the commit HEAD of a git directory points at without running git
+
+    Returns None when the reference can't be resolved from loose or packed
+    refs, in which case git itself has to be asked.
+    """
+    try:
+        with open(os.path.join(gitdir, "HEAD")) as head_file:
+            head = head_file.read().strip()
+        if not head.startswith("ref: "):
+            return head
+        ref = head[len("ref: "):]
+        common = gitdir
+        if os.path.exists(os.path.join(gitdir, "commondir")):
+            with open(os.path.join(gitdir, "commondir")) as commondir:
+                common = os.path.join(gitdir, commondir.read().strip())
+        for root in (gitdir, common):
+            if os.path.isfile(os.path.join(root, ref)):
+                with open(os.path.join(root, ref)) as ref_file:
+                    return ref_file.read().strip()
+        with open(os.path.join(common, "packed-refs")) as packed:
+            for line in packed:
+                fields = line.split()
+                if len(fields) == 2 and fields[1] == ref:
+                    return fields[0]
+    except (IOError, OSError):
+        pass
+    return None
+
+
+def parse_git_version(version):
+    """Parse the output of `git --version` into a tuple of integers
+
+    >>> parse_git_version("git version 2.39.5")
+    (2, 39, 5)
+    >>> parse_git_version("git version 2.20.1.windows.1")
+    (2, 20, 1)
+    """
+    parts = []
+    for part in version.split()[2].split("."):
+        if not part.isdigit():
+            break
+        parts.append(int(part))
+    return tuple(parts)
+
+
+def cpu_count():
+    """Return how many processors this machine has"""
+    if hasattr(os, 'cpu_count'):
+        return os.cpu_count() or 1
+    return multiprocessing.cpu_count()
+
+
+def vendored_crates(vendor_dir):
+    """Return the names of the crates in a `cargo vendor` directory"""
+    return sorted(name for name in os.listdir(vendor_dir)
+                  if os.path.isfile(os.path.join(vendor_dir, name, ".cargo-checksum.json")))
+
+
+def verify_crate(vendor_dir, crate, cache):
+    """Check the files of a vendored crate against its .cargo-checksum.json
+
+    `cache` maps the paths of files, relative to `vendor_dir`, to the
+    `[size, mtime, inode, sha256]` they had when they were last hashed, so
+    only files which changed since then are read. Returns whether the crate
+    is intact along with the cache entries of its files.
+    """
+    crate_dir = os.path.join(vendor_dir, crate)
+    try:
+        with open(os.path.join(crate_dir, ".cargo-checksum.json")) as checksums:
+            expected = json.load(checksums)["files"]
+    except (IOError, OSError, ValueError, KeyError, TypeError):
+        return False, {}
+    intact = True
+    entries = {}
+    for name, sha256 in expected.items():
+        path = os.path.join(crate_dir, name)
+        try:
+            info = os.stat(path)
+        except OSError:
+            intact = False
+            continue
+        key = os.path.join(crate, name)
+        stat = [info.st_size, info.st_mtime, info.st_ino]
+        cached = cache.get(key)
+        found = cached[3] if cached and cached[:3] == stat else sha256_file(path)
+        entries[key] = stat + [found]
+        if found != sha256:
+            intact = False
+    return intact, entries
+
+
+def verify_vendored(vendor_dir, cache_path, jobs):
+    """Return the vendored crates whose files don't match their checksums
+
+    Crates are verified by `jobs` threads at once. The hashes of the files
+    are kept in `cache_path` for the next run, see `verify_crate`.
+    """
+    try:
+        with open(cache_path) as cached:
+            cache = json.load(cached)
+    except (IOError, OSError, ValueError):
+        cache = {}
+    broken = []
+    entries = {}
+    verified = parallel_imap(lambda crate: verify_crate(vendor_dir, crate, cache),
+                             vendored_crates(vendor_dir), jobs)
+    for crate, (intact, crate_entries) in verified:
+        entries.update(crate_entries)
+        if not intact:
+            broken.append(crate)
+    try:
+        with output(cache_path) as cached:
+            json.dump(entries, cached)
+    except (IOError, OSError):
+        pass
+    return sorted(broken)
+
+
+def restore_crate(crate_dir, crate_file):
+    """Replace a vendored crate with the contents of the given .crate file
+
+    Like `cargo vendor`, only the files listed in its .cargo-checksum.json are
+    kept, and that file itself is left as it is.
+    """
+    checksum_path = os.path.join(crate_dir, ".cargo-checksum.json")
+    with open(checksum_path) as checksums:
+        files = json.load(checksums)["files"]
+    temp = crate_dir + ".tmp"
+    shutil.rmtree(temp, ignore_errors=True)
+    os.makedirs(temp)
+    with tarfile.open(crate_file, "r:gz") as tar:
+        for member in tar.getmembers():
+            name = member.name.split("/", 1)[-1]
+            if not member.isfile() or name not in files:
+                continue
+            target = os.path.join(temp, name)
+            if not os.path.isdir(os.path.dirname(target)):
+                os.makedirs(os.path.dirname(target))
+            with open(target, "wb") as destination:
+                shutil.copyfileobj(tar.extractfile(member), destination)
+            if member.mode & 0o111:
+                os.chmod(target, 0o755)
+    shutil.copy2(checksum_path, temp)
+    shutil.rmtree(crate_dir)
+    os.rename(temp, crate_dir)
+
+
+# Types of program headers: loaded segments, the path of the dynamic linker
+# and the program headers themselves
+PT_LOAD = 1
+PT_INTERP = 3
+PT_PHDR = 6
+
+# By EI_CLASS, 1 for 32 and 2 for 64-bit: where e_phoff is and its format,
+# where e_phentsize and e_phnum are, and the fields of a program header
+ELF_CLASSES = {
+    1: (28, "I", 42, ("p_type", "p_offset", "p_vaddr", "p_paddr", "p_filesz",
+                      "p_memsz", "p_flags", "p_align"), "IIIIIIII"),
+    2: (32, "Q", 54, ("p_type", "p_flags", "p_offset", "p_vaddr", "p_paddr",
+                      "p_filesz", "p_memsz", "p_align"), "IIQQQQQQ"),
+}
+
+
+def elf_program_headers(elf):
+    """Return the `(class, byte order, e_phentsize, program headers)` of the
+    given open ELF file, each header as a dict, or None if it isn't one"""
+    elf.seek(0)
+    header = elf.read(64)
+    if len(header) < 52 or header[:4] != b"\x7fELF":
+        return None
+    ident = bytearray(header[:6])
+    order = {1: "<", 2: ">"}.get(ident[5])
+    if order is None or ident[4] not in ELF_CLASSES or \
+            (ident[4] == 2 and len(header) < 64):
+        return None
+    phoff_at, phoff_format, phentsize_at, fields, layout = ELF_CLASSES[ident[4]]
+    phoff, = struct.unpack(order + phoff_format,
+                           header[phoff_at:phoff_at + struct.calcsize(phoff_format)])
+    phentsize, phnum = struct.unpack(order + "HH", header[phentsize_at:phentsize_at + 4])
+    size = struct.calcsize(order + layout)
+    elf.seek(phoff)
+    table = elf.read(phentsize * phnum)
+    headers = []
+    for index in range(phnum):
+        entry = table[index * phentsize:index * phentsize + size]
+        if len(entry) < size:
+            break
+        headers.append(dict(zip(fields, struct.unpack(order + layout, entry))))
+    return ident[4], order, phentsize, headers
+
+
+def elf_interpreter(path):
+    """Return the `(offset, size, interpreter)` of the PT_INTERP segment of
+    the given ELF file, or None if it has none or isn't an ELF file at all"""
+    with open(path, "rb") as elf:
+        found = elf_program_headers(elf)
+        for header in found[3] if found else []:
+            if header["p_type"] != PT_INTERP:
+                continue
+            elf.seek(header["p_offset"])
+            interpreter = elf.read(header["p_filesz"]).split(b"\0")[0]
+            return header["p_offset"], header["p_filesz"], interpreter.decode("utf-8")
+    return None
+
+
+def set_elf_interpreter(path, interpreter):
+    """Point the given ELF executable at another dynamic linker
+
+    The path is overwritten in place when the new one fits in the PT_INTERP
+    segment. Otherwise it's appended to the file, see append_elf_interpreter.
+    Returns False, leaving the file as it is, when it has no PT_INTERP or no
+    segment to load.
+    """
+    found = elf_interpreter(path)
+    if found is None:
+        return False
+    offset, size, current = found
+    if current == interpreter:
+        return True
+    encoded = interpreter.encode("utf-8") + b"\0"
+    with open(path, "r+b") as elf:
+        if len(encoded) > size:
+            return append_elf_interpreter(elf, encoded)
+        elf.seek(offset)
+        elf.write(encoded + b"\0" * (size - len(encoded)))
+    return True
+
+
+def append_elf_interpreter(elf, encoded):
+    """Append the NUL terminated path of a dynamic linker to the given open
+    ELF file, with a copy of its program headers pointing PT_INTERP at it
+
+    Like `patchelf --set-interpreter` does, a new read-only PT_LOAD segment
+    maps both past the end of the other segments. The headers are moved
+    rather than extended in place since sections usually follow them right
+    away. Kernels before 5.18 find them at `e_phoff` relative to the first
+    segment, so the new one is placed at the same offset from its address.
+    """
+    elf_class, order, phentsize, headers = elf_program_headers(elf)
+    phoff_at, phoff_format, phentsize_at, fields, layout = ELF_CLASSES[elf_class]
+    loads = [header for header in headers if header["p_type"] == PT_LOAD]
+    if not loads:
+        return False
+    # Page aligned for any page size up to 64K, without padding the file
+    # to the 2M alignment of some older executables
+    page = min(max([header["p_align"] for header in loads] + [0x1000]), 0x10000)
+    bias = loads[0]["p_vaddr"] - loads[0]["p_offset"]
+    elf.seek(0, os.SEEK_END)
+    offset = max([elf.tell()] + [
+        header["p_vaddr"] + header["p_memsz"] - bias for header in loads])
+    offset = (offset + page - 1) // page * page
+    table_size = (len(headers) + 1) * phentsize
+
+    for header in headers:
+        if header["p_type"] == PT_PHDR:
+            header.update(p_offset=offset, p_vaddr=offset + bias, p_paddr=offset + bias,
+                          p_filesz=table_size, p_memsz=table_size)
+        elif header["p_type"] == PT_INTERP:
+            address = offset + bias + table_size
+            header.update(p_offset=offset + table_size, p_vaddr=address, p_paddr=address,
+                          p_filesz=len(encoded), p_memsz=len(encoded))
+    # PT_LOAD headers are sorted by address, the new one comes last
+    last = max(index for index, header in enumerate(headers) if header["p_type"] == PT_LOAD)
+    headers.insert(last + 1, {
+        "p_type": PT_LOAD, "p_flags": 4, "p_offset": offset,
+        "p_vaddr": offset + bias, "p_paddr": offset + bias,
+        "p_filesz": table_size + len(encoded), "p_memsz": table_size + len(encoded),
+        "p_align": page})
+
+    padding = b"\0" * (phentsize - struct.calcsize(order + layout))
+    elf.seek(offset)
+    for header in headers:
+        elf.write(struct.pack(order + layout, *[header[field] for field in fields]))
+        elf.write(padding)
+    elf.write(encoded)
+    elf.seek(phoff_at)
+    elf.write(struct.pack(order + phoff_format, offset))
+    elf.seek(phentsize_at + 2)
+    elf.write(struct.pack(order + "H", len(headers)))
+    return True
+
+
+# Dynamic linkers of the running NixOS system by file name, see nix_loader()
+_nix_loaders = {}
+
+
+def nix_loader(loader):
+    """Return the path of the dynamic linker called `loader` which the
+    programs of the running NixOS system use, or None if it isn't found
+
+    It's the interpreter of the system's shell, `ldd` is only asked about it
+    when the shell uses another one. The result is kept for the rest of the
+    process.
+    """
+    if loader in _nix_loaders:
+        return _nix_loaders[loader]
+    shell = "/run/current-system/sw/bin/sh"
+    try:
+        found = elf_interpreter(os.path.realpath(shell))
+    except (IOError, OSError, struct.error):
+        found = None
+    if found is not None and found[2].split("/")[-1] == loader:
+        _nix_loaders[loader] = found[2]
+        return found[2]
+
+    try:
+        ldd_output = subprocess.check_output(['ldd', shell])
+        ldd_output = ldd_output.strip().decode(sys.getdefaultencoding())
+    except (subprocess.CalledProcessError, OSError) as reason:
+        print("warning: unable to call ldd:", reason)
+        return None
+    for line in ldd_output.splitlines():
+        libname = line.split()[0]
+        if libname.endswith(loader):
+            _nix_loaders[loader] = libname
+            break
+    else:
+        _nix_loaders[loader] = None
+    return _nix_loaders[loader]
+
+
+def support_xz():
+    """Return whether this Python can read `.tar.xz` tarballs"""
+    try:
+        with tempfile.NamedTemporaryFile(delete=False) as temp_file:
+            temp_path = temp_file.name
+        with tarfile.open(temp_path, "w:xz") as tar:
+            pass
+        return True
+    except tarfile.CompressionError:
+        return False
+
+
+def stage0_data(rust_root):
+    """Build a dictionary from stage0.txt"""
+    return read_stage0_file(os.path.join(rust_root, "src/stage0.txt"))
+
+
+def read_stage0_file(path):
+    """Build a dictionary from a file in the format of stage0.txt"""
+    with open(path, 'r') as nightlies:
+        lines = [line.rstrip() for line in nightlies
+                 if not line.startswith("#")]
+        return dict([line.split(": ", 1) for line in lines if line])
+
+
+def stage0_checksums(rust_root, data):
+    """Return the SHA-256 pinned for stage0 tarballs, by `<date>/<filename>`
+
+    They are read from `src/stage0.sha256`, a manifest in the format of
+    `sha256sum` written by `bootstrap.py stage0-pin`, and from
+    `<date>/<filename>: <sha256>` entries of stage0.txt, which take
+    precedence.
+    """
+    checksums = {}
+    manifest = os.path.join(rust_root, "src", "stage0.sha256")
+    if os.path.exists(manifest):
+        checksums.update(read_sha256_manifest(manifest))
+    checksums.update((key, value) for key, value in data.items() if "/" in key)
+    return checksums
+
+
+def read_sha256_manifest(path):
+    """Return the `{name: sha256}` listed in a `sha256sum`-style manifest"""
+    checksums = {}
+    with open(path, "r") as manifest:
+        for line in manifest:
+            if not line.strip() or line.startswith("#"):
+                continue
+            sha256, name = line.split(None, 1)
+            # `sha256sum` marks files hashed in binary mode with a `*`
+            checksums[name.strip().lstrip("*")] = sha256
+    return checksums
+
+
+def write_sha256_manifest(path, checksums):
+    """Write `{name: sha256}` to a manifest `sha256sum -c` can check"""
+    with output(path) as manifest:
+        for name in sorted(checksums):
+            manifest.write("{}  {}\n".format(checksums[name], name))
+
+
+def stage0_tarballs(data, triple, tarball_suffix):
+    """Return the `(date, filename)` of the stage0 tarballs of `triple`
+
+    >>> data = {"date": "2019-12-18", "rustc": "beta", "cargo": "beta",
+    ...         "rustfmt": "nightly-2019-12-19"}
+    >>> for tarball in stage0_tarballs(data, "x86_64-pc-windows-gnu", ".tar.xz"):
+    ...     print("/".join(tarball))
+    2019-12-18/rust-std-beta-x86_64-pc-windows-gnu.tar.xz
+    2019-12-18/rustc-beta-x86_64-pc-windows-gnu.tar.xz
+    2019-12-18/rust-mingw-beta-x86_64-pc-windows-gnu.tar.xz
+    2019-12-18/cargo-beta-x86_64-pc-windows-gnu.tar.xz
+    2019-12-19/rustfmt-nightly-x86_64-pc-windows-gnu.tar.xz
+    """
+    date = data["date"]
+    tarballs = [
+        (date, "rust-std-{}-{}{}".format(data["rustc"], triple, tarball_suffix)),
+        (date, "rustc-{}-{}{}".format(data["rustc"], triple, tarball_suffix)),
+    ]
+    if "pc-windows-gnu" in triple:
+        tarballs.append(
+            (date, "rust-mingw-{}-{}{}".format(data["rustc"], triple, tarball_suffix)))
+    tarballs.append((date, "cargo-{}-{}{}".format(data["cargo"], triple, tarball_suffix)))
+    if data.get("rustfmt"):
+        channel, rustfmt_date = data["rustfmt"].split("-", 1)
+        tarballs.append(
+            (rustfmt_date, "rustfmt-{}-{}{}".format(channel, triple, tarball_suffix)))
+    return tarballs
+
+
+# Components of the stage0 toolchain, as they are named in tarballs
+STAGE0_COMPONENTS = ("rust-std", "rust-mingw", "rustc", "cargo", "rustfmt")
+
+
+def stage0_component(filename):
+    """Return what the given stage0 tarball is, regardless of its channel
+
+    Tarballs of different dates with the same component are deltas of
+    each other.
+
+    >>> stage0_component("rust-std-beta-x86_64-unknown-linux-gnu.tar.xz")
+    ('rust-std', 'x86_64-unknown-linux-gnu.tar.xz')
+    >>> stage0_component("rustc-1.40.0-x86_64-unknown-linux-gnu.tar.xz")
+    ('rustc', 'x86_64-unknown-linux-gnu.tar.xz')
+    >>> stage0_component("rustc-beta-x86_64-unknown-linux-gnu.tar.xz.part") is None
+    True
+    """
+    if not filename.endswith((".tar.xz", ".tar.gz")):
+        return None
+    for component in STAGE0_COMPONENTS:
+        if filename.startswith(component + "-"):
+            channel, _, rest = filename[len(component) + 1:].partition("-")
+            return (component, rest) if channel and rest else None
+    return None
+
+
+# A delta starts with this line and a JSON line telling how the tarball is
+# compressed. Copy instructions (`C`, an offset and a length in the base)
+# and insertions (`I`, a length and the data) follow. Both work on the
+# uncompressed tar streams: the new tar stream is rebuilt from them and
+# compressed again exactly like the published tarball was.
+DELTA_MAGIC = b"stage0-delta 2\n"
+# The data of tar members is split into chunks that end after this marker,
+# chunks of the new tarball which are found in the base are copied from it.
+DELTA_MARKER = b"\xa5\x5a"
+DELTA_MIN_CHUNK = 8 * 1024
+DELTA_MAX_CHUNK = 1024 * 1024
+# Compression levels tried to reproduce a tarball, most common first
+XZ_PRESETS = [6, 9, 0, 1, 2, 3, 4, 5, 7, 8]
+GZIP_LEVELS = [9, 6, 1, 2, 3, 4, 5, 7, 8]
+
+
+def open_tarball(path):
+    """Open the uncompressed tar stream of the given tarball"""
+    if path.endswith(".tar.xz"):
+        if not module_available(lzma):
+            raise ValueError("{} can't be read without the lzma module".format(path))
+        return lzma.LZMAFile(path)
+    return gzip.GzipFile(path)
 
 
-def download(path, url, probably_big, verbose):
-    for _ in range(0, 4):
-        try:
-            _download(path, url, probably_big, verbose, True)
+def read_exact(source, size):
+    """Read `size` bytes from `source`, fewer only at its end"""
+    data = b""
+    while len(data) < size:
+        chunk = source.read(size - len(data))
+        if not chunk:
+            break
+        data += chunk
+    return data
+
+
+def content_chunks(source, length=None):
+    """Split the next `length` bytes of `source`, or all of it, into chunks
+    for deltas
+
+    Chunks end after a marker, at least DELTA_MIN_CHUNK bytes after their
+    start, so the same content is split the same way wherever it sits.
+
+    >>> import io
+    >>> data = DELTA_MARKER + b"a" * DELTA_MIN_CHUNK + DELTA_MARKER + b"b" * 4
+    >>> [len(chunk) for chunk in content_chunks(io.BytesIO(data))]
+    [8196, 4]
+    >>> [len(chunk) for chunk in content_chunks(io.BytesIO(data), 10)]
+    [10]
+    """
+    buf = b""
+    eof = False
+    while True:
+        while not eof and len(buf) < DELTA_MAX_CHUNK:
+            size = DELTA_MAX_CHUNK if length is None else min(length, DELTA_MAX_CHUNK)
+            data = source.read(size) if size else b""
+            eof = not data
+            if length is not None:
+                length -= len(data)
+            buf += data
+        if not buf:
             return
-        except RuntimeError:
-            print("\nspurious failure, trying again")
-    _download(path, url, probably_big, verbose, False)
+        end = buf.find(DELTA_MARKER, DELTA_MIN_CHUNK, DELTA_MAX_CHUNK)
+        end = min(len(buf), DELTA_MAX_CHUNK) if end < 0 else end + len(DELTA_MARKER)
+        yield buf[:end]
+        buf = buf[end:]
 
 
-def _download(path, url, probably_big, verbose, exception):
-    if probably_big or verbose:
-        print("downloading {}".format(url))
-    # see http://serverfault.com/questions/301128/how-to-download
-    if sys.platform == 'win32':
-        run(["PowerShell.exe", "/nologo", "-Command",
-             "[Net.ServicePointManager]::SecurityProtocol = [Net.SecurityProtocolType]::Tls12;",
-             "(New-Object System.Net.WebClient).DownloadFile('{}', '{}')".format(url, path)],
-            verbose=verbose,
-            exception=exception)
-    else:
-        if probably_big or verbose:
-            option = "-#"
+def tar_member_size(header):
+    """Return the size of the data following the given tar header, None if
+    it isn't one
+
+    >>> tar_member_size(b"\\0" * 124 + b"00000001750\\0" + b"\\0" * 376)
+    1000
+    >>> tar_member_size(b"\\0" * 512)
+    0
+    >>> tar_member_size(b"\\0" * 124 + b"not a size!\\0" + b"\\0" * 376) is None
+    True
+    """
+    if len(header) < 512:
+        return None
+    field = header[124:136]
+    if bytearray(field)[0] & 0x80:
+        # Sizes of 8 GiB and more are stored in base-256
+        size = 0
+        for byte in bytearray(field)[1:]:
+            size = size * 256 + byte
+        return size
+    field = field.strip(b"\0 ")
+    try:
+        return int(field, 8) if field else 0
+    except ValueError:
+        return None
+
+
+def tar_chunks(source):
+    """Split an uncompressed tar stream into chunks for deltas
+
+    Every header is a chunk of its own, so a changed file only changes the
+    chunks of its member. Member data is split like `content_chunks` does.
+    """
+    while True:
+        header = read_exact(source, 512)
+        if not header:
+            return
+        yield header
+        size = tar_member_size(header)
+        if size is None:
+            for chunk in content_chunks(source):
+                yield chunk
+            return
+        if size:
+            for chunk in content_chunks(source, (size + 511) // 512 * 512):
+                yield chunk
+
+
+def gzip_header(path):
+    """Return the bytes of the header of the given gzip file"""
+    with open(path, "rb") as gzip_file:
+        data = bytearray(gzip_file.read(64 * 1024))
+    if data[:2] != b"\x1f\x8b":
+        raise ValueError("{} isn't a gzip file".format(path))
+    flags = data[3]
+    end = 10
+    if flags & 4:
+        end += 2 + (data[end] | data[end + 1] << 8)
+    for flag in (8, 16):
+        # The file name and the comment are NUL-terminated
+        if flags & flag:
+            end = data.index(b"\0", end) + 1
+    if flags & 2:
+        end += 2
+    return bytes(data[:end])
+
+
+class TarballCompressor(object):
+    """Compress a tar stream with the settings `compression_settings`
+    returned for a tarball"""
+    def __init__(self, settings):
+        self.gzip = settings["format"] == "gz"
+        if self.gzip:
+            self._compressor = zlib.compressobj(settings["level"], zlib.DEFLATED,
+                                                -zlib.MAX_WBITS)
+            self._header = bytes(bytearray(settings["header"]))
         else:
-            option = "-s"
-        run(["curl", option,
-             "-y", "30", "-Y", "10",    # timeout if speed is < 10 bytes/sec for > 30 seconds
-             "--connect-timeout", "30", # timeout if cannot connect within 30 seconds
-             "--retry", "3", "-Sf", "-o", path, url],
-            verbose=verbose,
-            exception=exception)
+            if not module_available(lzma):
+                raise ValueError("xz deltas can't be applied without the lzma module")
+            self._compressor = lzma.LZMACompressor(
+                format=lzma.FORMAT_XZ, check=settings["check"], preset=settings["preset"])
+            self._header = b""
+        self._crc = 0
+        self._size = 0
 
+    def compress(self, data):
+        """Return the compressed data available after feeding `data`"""
+        if self.gzip:
+            self._crc = zlib.crc32(data, self._crc)
+            self._size += len(data)
+        compressed = self._header + self._compressor.compress(data)
+        self._header = b""
+        return compressed
 
-def verify(path, sha_path, verbose):
-    """Check if the sha256 sum of the given path is valid"""
-    if verbose:
-        print("verifying", path)
-    with open(path, "rb") as source:
-        found = hashlib.sha256(source.read()).hexdigest()
-    with open(sha_path, "r") as sha256sum:
-        expected = sha256sum.readline().split()[0]
-    verified = found == expected
-    if not verified:
-        print("invalid checksum:\n"
-              "    found:    {}\n"
-              "    expected: {}".format(found, expected))
-    return verified
+    def flush(self):
+        """Return the rest of the compressed stream"""
+        compressed = self._header + self._compressor.flush()
+        if self.gzip:
+            compressed += struct.pack("<II", self._crc & 0xffffffff, self._size & 0xffffffff)
+        return compressed
 
 
-def unpack(tarball, tarball_suffix, dst, verbose=False, match=None):
-    """Unpack the given tarball file"""
-    print("extracting", tarball)
-    fname = os.path.basename(tarball).replace(tarball_suffix, "")
-    with contextlib.closing(tarfile.open(tarball)) as tar:
-        for member in tar.getnames():
-            if "/" not in member:
-                continue
-            name = member.replace(fname + "/", "", 1)
-            if match is not None and not name.startswith(match):
-                continue
-            name = name[len(match) + 1:]
+def compression_settings(tarball):
+    """Return how to compress the tar stream of `tarball` again into exactly
+    the same bytes, or None if no setting does that
 
-            dst_path = os.path.join(dst, name)
-            if verbose:
-                print("  extracting", member)
-            tar.extract(member, dst)
-            src_path = os.path.join(dst, member)
-            if os.path.isdir(src_path) and os.path.exists(dst_path):
+    Settings are checked by compressing the tar stream and comparing the
+    result with the tarball as it's produced, so a wrong one is usually
+    given up on after the first few blocks.
+    """
+    if tarball.endswith(".tar.xz"):
+        with open(tarball, "rb") as tarball_file:
+            stream_flags = bytearray(tarball_file.read(8))
+        if len(stream_flags) < 8:
+            return None
+        candidates = [{"format": "xz", "preset": preset | extreme,
+                       "check": stream_flags[7] & 0x0f}
+                      for extreme in (0, lzma.PRESET_EXTREME) for preset in XZ_PRESETS]
+    else:
+        header = list(bytearray(gzip_header(tarball)))
+        candidates = [{"format": "gz", "level": level, "header": header}
+                      for level in GZIP_LEVELS]
+    for settings in candidates:
+        compressor = TarballCompressor(settings)
+        with open_tarball(tarball) as source, open(tarball, "rb") as published:
+            while True:
+                data = source.read(CHUNK_SIZE)
+                compressed = compressor.compress(data) if data else compressor.flush()
+                if read_exact(published, len(compressed)) != compressed:
+                    break
+                if not data:
+                    if not published.read(1):
+                        return settings
+                    break
+    return None
+
+
+def write_delta(base, target, delta):
+    """Write a delta which turns the tarball `base` into the tarball `target`
+
+    Both tarballs are streamed, only the hashes of the chunks of `base` are
+    kept in memory. Returns the size of the delta, raises ValueError if the
+    compression of `target` can't be reproduced.
+    """
+    settings = compression_settings(target)
+    if settings is None:
+        raise ValueError("the compression of {} can't be reproduced".format(target))
+    index = {}
+    offset = 0
+    with open_tarball(base) as source:
+        for chunk in tar_chunks(source):
+            index.setdefault(hashlib.sha256(chunk).digest(), offset)
+            offset += len(chunk)
+
+    temp = delta + ".tmp"
+    with open_tarball(target) as source, open(temp, "wb") as delta_file:
+        delta_file.write(DELTA_MAGIC)
+        delta_file.write(json.dumps(settings, sort_keys=True).encode("utf-8") + b"\n")
+        # Copies of adjacent chunks of the base are merged into one
+        copy = None
+        for chunk in tar_chunks(source):
+            offset = index.get(hashlib.sha256(chunk).digest())
+            if copy is not None and offset == copy[0] + copy[1]:
+                copy[1] += len(chunk)
                 continue
-            shutil.move(src_path, dst_path)
-    shutil.rmtree(os.path.join(dst, fname))
+            if copy is not None:
+                delta_file.write(b"C" + struct.pack(">QQ", *copy))
+                copy = None
+            if offset is None:
+                delta_file.write(b"I" + struct.pack(">Q", len(chunk)) + chunk)
+            else:
+                copy = [offset, len(chunk)]
+        if copy is not None:
+            delta_file.write(b"C" + struct.pack(">QQ", *copy))
+    os.rename(temp, delta)
+    return os.path.getsize(delta)
 
 
-def run(args, verbose=False, exception=False, **kwargs):
-    """Run a child program in a new process"""
-    if verbose:
-        print("running: " + ' '.join(args))
-    sys.stdout.flush()
-    # Use Popen here instead of call() as it apparently allows powershell on
-    # Windows to not lock up waiting for input presumably.
-    ret = subprocess.Popen(args, **kwargs)
-    code = ret.wait()
-    if code != 0:
-        err = "failed to run: " + ' '.join(args)
-        if verbose or exception:
-            raise RuntimeError(err)
-        sys.exit(err)
+def apply_delta(base, delta, destination):
+    """Write the tarball `delta` creates from the tarball `base` to
+    `destination`
 
+    The tar stream of `base` is unpacked next to `destination` while the
+    delta is applied. Returns the SHA-256 of the new tarball, raises
+    ValueError if `delta` isn't a delta.
+    """
+    sha256 = hashlib.sha256()
+    unpacked = destination + ".base"
+    try:
+        with open_tarball(base) as source, open(unpacked, "wb") as unpacked_file:
+            shutil.copyfileobj(source, unpacked_file, CHUNK_SIZE)
+        with open(delta, "rb") as delta_file, open(unpacked, "rb") as base_file, \
+                open(destination, "wb") as output_file:
+            if delta_file.read(len(DELTA_MAGIC)) != DELTA_MAGIC:
+                raise ValueError("{} isn't a stage0 delta".format(delta))
+            compressor = TarballCompressor(json.loads(delta_file.readline().decode("utf-8")))
 
-def stage0_data(rust_root):
-    """Build a dictionary from stage0.txt"""
-    nightlies = os.path.join(rust_root, "src/stage0.txt")
-    with open(nightlies, 'r') as nightlies:
-        lines = [line.rstrip() for line in nightlies
-                 if not line.startswith("#")]
-        return dict([line.split(": ", 1) for line in lines if line])
+            def copy(source, length):
+                while length > 0:
+                    chunk = source.read(min(length, CHUNK_SIZE))
+                    if not chunk:
+                        raise ValueError("truncated delta or base")
+                    compressed = compressor.compress(chunk)
+                    sha256.update(compressed)
+                    output_file.write(compressed)
+                    length -= len(chunk)
+
+            while True:
+                kind = delta_file.read(1)
+                if not kind:
+                    break
+                if kind == b"C":
+                    offset, length = struct.unpack(">QQ", delta_file.read(16))
+                    base_file.seek(offset)
+                    copy(base_file, length)
+                elif kind == b"I":
+                    length, = struct.unpack(">Q", delta_file.read(8))
+                    copy(delta_file, length)
+                else:
+                    raise ValueError("corrupt delta {}".format(delta))
+            compressed = compressor.flush()
+            sha256.update(compressed)
+            output_file.write(compressed)
+    finally:
+        delete_if_present(unpacked, False)
+    return sha256.hexdigest()
+
+
+def fetch_delta(url, path, base, base_sha256, expected, verbose=False):
+    """Try to create `path` from `base` and the delta published for them
+
+    Deltas are published at `<url>.delta-<SHA-256 of base>`. Returns False
+    if there is none, or if the result doesn't match `expected`, the
+    tarball has to be downloaded then.
+    """
+    delta_url = "{}.delta-{}".format(url, base_sha256)
+    delta = path + ".delta"
+    part_path = path + ".part"
+    print("downloading {} as a delta against {}".format(
+        os.path.basename(path), base))
+    with tracer.span("download delta", url=delta_url, bytes=0) as span:
+        try:
+            _download(delta, delta_url, False, verbose, True, False)
+            span["bytes"] = os.path.getsize(delta)
+            found = apply_delta(base, delta, part_path)
+        except Exception as error:  # pylint: disable=broad-except
+            # Whatever is wrong with the delta or the base, the whole
+            # tarball can still be downloaded
+            print("no usable delta ({}), downloading the whole tarball".format(error))
+            delete_if_present(part_path, verbose)
+            return False
+        finally:
+            delete_if_present(delta, verbose)
+    if not check_sha256(part_path, expected, verbose, found):
+        print("the delta didn't apply, downloading the whole tarball")
+        delete_if_present(part_path, verbose)
+        return False
+    shutil.move(part_path, path)
+    return True
+
+
+def format_toml(value):
+    """Format a value from config.toml as a string, strings are left as they are
+
+    >>> format_toml(False)
+    'false'
+    >>> format_toml([1, "a"])
+    '[1, "a"]'
+    >>> format_toml(None) is None
+    True
+    """
+    if value is None or isinstance(value, type(u"")) or isinstance(value, str):
+        return value
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    if isinstance(value, list):
+        return '[' + ', '.join(json.dumps(item) if isinstance(item, (type(u""), str))
+                               else format_toml(item) for item in value) + ']'
+    return str(value)
 
 
 def format_build_time(duration):
@@ -160,19 +2471,105 @@ def format_build_time(duration):
     return str(datetime.timedelta(seconds=int(duration)))
 
 
-def default_build_triple():
-    """Build triple as in LLVM"""
+def host_uname():
+    """Return what `uname -s` and `uname -m` print on this host, without
+    running them, or None on Windows outside of MSYS
+
+    Python from python.org doesn't have `os.uname()` on Windows. Its only
+    `uname` is the one of the MSYS or Git Bash shell it's started from,
+    which names itself after `MSYSTEM`, like `MINGW64_NT-10.0`.
+    """
+    if hasattr(os, 'uname'):
+        uname = os.uname()
+        return uname[0], uname[4]
+    msystem = os.environ.get('MSYSTEM')
+    if msystem:
+        return msystem + '_NT', os.environ.get('PROCESSOR_ARCHITECTURE', '').lower()
+    return None
+
+
+def host_is_android():
+    """Return whether `uname -o` prints Android on this Linux host
+
+    Python 3.7 and later built for Android have `sys.getandroidapilevel()`,
+    which a glibc userland running on an Android kernel doesn't, just like its
+    `uname -o` says GNU/Linux. Older Pythons still have to ask `uname`.
+    """
+    if sys.version_info >= (3, 7):
+        return hasattr(sys, 'getandroidapilevel')
+    uname = subprocess.check_output(['uname', '-o'])
+    return uname.strip().decode(sys.getdefaultencoding()) == 'Android'
+
+
+# Bumped whenever detect_build_triple() starts looking at something new, so
+# that `.host-triple` files written by older versions are detected again.
+HOST_TRIPLE_FORMAT = 2
+
+
+def host_triple_key():
+    """Return everything the host triple is detected from, on one line
+
+    That's the whole of `os.uname()`, which covers what `uname -o`,
+    `uname -p` and `isainfo -k` print for the same kernel, `MSYSTEM`, and
+    whether this Python was built for Android.
+    """
+    uname = os.uname() if hasattr(os, 'uname') else host_uname()
+    return "\t".join(
+        ["host-triple v{}".format(HOST_TRIPLE_FORMAT)] +
+        [str(part) for part in uname or ()] +
+        [os.environ.get('MSYSTEM', ''),
+         str(hasattr(sys, 'getandroidapilevel'))])
+
+
+# The build triple of this host, detected once by default_build_triple()
+_build_triple = None
+
+
+def default_build_triple(build_dir=None):
+    """Build triple as in LLVM
+
+    It's detected once for the whole process. With `build_dir` the result is
+    also kept in `<build_dir>/.host-triple`, along with host_triple_key(),
+    and reused by later runs for as long as that key stays the same.
+    """
+    global _build_triple
+    if _build_triple is not None:
+        return _build_triple
+    key = host_triple_key()
+    stamp = build_dir and os.path.join(build_dir, ".host-triple")
+    if stamp and os.path.exists(stamp):
+        with open(stamp) as cached:
+            lines = cached.read().splitlines()
+        if len(lines) == 2 and lines[0] == key:
+            _build_triple = lines[1]
+            return _build_triple
+    triple = detect_build_triple(host_uname())
+    if stamp:
+        try:
+            if not os.path.isdir(build_dir):
+                os.makedirs(build_dir)
+            with output(stamp) as cached:
+                cached.write("{}\n{}\n".format(key, triple))
+        except (OSError, IOError):
+            pass
+    _build_triple = triple
+    return triple
+
+
+def detect_build_triple(uname):
+    """Return the LLVM triple of a host given its `(uname -s, uname -m)`
+
+    >>> detect_build_triple(("Darwin", "x86_64"))
+    'x86_64-apple-darwin'
+    >>> detect_build_triple(("FreeBSD", "amd64"))
+    'x86_64-unknown-freebsd'
+    >>> detect_build_triple(None)
+    'x86_64-pc-windows-msvc'
+    """
+    if uname is None:
+        return 'x86_64-pc-windows-msvc'
     default_encoding = sys.getdefaultencoding()
-    try:
-        ostype = subprocess.check_output(
-            ['uname', '-s']).strip().decode(default_encoding)
-        cputype = subprocess.check_output(
-            ['uname', '-m']).strip().decode(default_encoding)
-    except (subprocess.CalledProcessError, OSError):
-        if sys.platform == 'win32':
-            return 'x86_64-pc-windows-msvc'
-        err = "uname not found"
-        sys.exit(err)
+    ostype, cputype = uname
 
     # The goal here is to come up with the same triple as LLVM would,
     # at least for the subset of platforms we're willing to target.
@@ -189,9 +2586,7 @@ def default_build_triple():
     if ostype in ostype_mapper:
         ostype = ostype_mapper[ostype]
     elif ostype == 'Linux':
-        os_from_sp = subprocess.check_output(
-            ['uname', '-o']).strip().decode(default_encoding)
-        if os_from_sp == 'Android':
+        if host_is_android():
             ostype = 'linux-android'
         else:
             ostype = 'unknown-linux-gnu'
@@ -315,6 +2710,246 @@ def output(filepath):
         os.remove(tmp)
 
 
+class TomlParser(object):
+    """Parser for the subset of TOML used by config.toml
+
+    `parse` returns `(table, key, value)` for every key in the order they
+    appear, where `table` is the dotted path of the enclosing table (None at
+    the top level). Tables, arrays of tables, dotted keys, inline tables,
+    multi-line strings and arrays are understood, inline tables are
+    flattened like regular ones. Dates are kept as strings. Invalid input
+    raises ValueError.
+
+    >>> TomlParser('[a.b]\\nc.d = [1, 2,\\n  3]  # three').parse()
+    [('a.b.c', 'd', [1, 2, 3])]
+    >>> TomlParser('x = { y = true, z = "s" }').parse()
+    [('x', 'y', True), ('x', 'z', 's')]
+    """
+    BARE_KEY = re.compile(r'[A-Za-z0-9_-]+')
+    SCALAR = re.compile(r'[A-Za-z0-9_:.+-]+(?: [0-9][0-9:.+-]*(?:Z|z)?)?')
+    ESCAPES = {'b': '\b', 't': '\t', 'n': '\n', 'f': '\f', 'r': '\r',
+               '"': '"', '\\': '\\'}
+
+    def __init__(self, text):
+        self.text = text
+        self.pos = 0
+        self.entries = []
+
+    def parse(self):
+        """Parse the whole document"""
+        table = []
+        while True:
+            self.skip(newlines=True)
+            if self.pos >= len(self.text):
+                return self.entries
+            if self.text.startswith('[', self.pos):
+                array = self.text.startswith('[[', self.pos)
+                self.pos += 2 if array else 1
+                table = self.key()
+                self.expect(']]' if array else ']')
+            else:
+                self.key_value(table)
+            self.skip()
+            if self.pos < len(self.text) and self.text[self.pos] not in '\r\n':
+                self.fail("expected the end of the line")
+
+    def key_value(self, table):
+        """Parse `key = value` and record it, inline tables key by key"""
+        path = table + self.key()
+        self.expect('=')
+        self.skip()
+        self.record(path, self.value())
+
+    def record(self, path, value):
+        """Record the value of the key at `path`"""
+        if isinstance(value, dict):
+            for key, nested in value.items():
+                self.record(path + [key], nested)
+        else:
+            self.entries.append(('.'.join(path[:-1]) or None, path[-1], value))
+
+    def key(self):
+        """Parse a possibly dotted key into its parts"""
+        parts = []
+        while True:
+            self.skip()
+            if self.text.startswith('"', self.pos):
+                parts.append(self.basic_string())
+            elif self.text.startswith("'", self.pos):
+                parts.append(self.literal_string())
+            else:
+                match = self.BARE_KEY.match(self.text, self.pos)
+                if match is None:
+                    self.fail("expected a key")
+                parts.append(match.group())
+                self.pos = match.end()
+            self.skip()
+            if not self.text.startswith('.', self.pos):
+                return parts
+            self.pos += 1
+
+    def value(self):
+        """Parse any value"""
+        text = self.text
+        if text.startswith('"""', self.pos):
+            return self.multiline_string('"""')
+        if text.startswith("'''", self.pos):
+            return self.multiline_string("'''")
+        if text.startswith('"', self.pos):
+            return self.basic_string()
+        if text.startswith("'", self.pos):
+            return self.literal_string()
+        if text.startswith('[', self.pos):
+            self.pos += 1
+            items = []
+            while True:
+                self.skip(newlines=True)
+                if text.startswith(']', self.pos):
+                    self.pos += 1
+                    return items
+                items.append(self.value())
+                self.skip(newlines=True)
+                if text.startswith(',', self.pos):
+                    self.pos += 1
+                elif not text.startswith(']', self.pos):
+                    self.fail("expected `,` or `]`")
+        if text.startswith('{', self.pos):
+            self.pos += 1
+            table = collections.OrderedDict()
+            self.skip()
+            if text.startswith('}', self.pos):
+                self.pos += 1
+                return table
+            while True:
+                path = self.key()
+                self.expect('=')
+                self.skip()
+                nested = table
+                for part in path[:-1]:
+                    nested = nested.setdefault(part, collections.OrderedDict())
+                nested[path[-1]] = self.value()
+                self.skip()
+                if text.startswith('}', self.pos):
+                    self.pos += 1
+                    return table
+                self.expect(',')
+        match = self.SCALAR.match(text, self.pos)
+        if match is None:
+            self.fail("expected a value")
+        self.pos = match.end()
+        return self.scalar(match.group())
+
+    def scalar(self, token):
+        """Convert a bare value: a boolean, a number or a date"""
+        if token in ('true', 'false'):
+            return token == 'true'
+        number = token.replace('_', '')
+        for prefix, base in (('0x', 16), ('0o', 8), ('0b', 2)):
+            if number.startswith(prefix):
+                return int(number[2:], base)
+        try:
+            return int(number)
+        except ValueError:
+            pass
+        try:
+            return float(number)
+        except ValueError:
+            pass
+        if re.match(r'^\d{4}-\d{2}-\d{2}|^\d{2}:\d{2}', token):
+            return token
+        self.fail("invalid value `{}`".format(token))
+
+    def basic_string(self):
+        """Parse a string in double quotes, handling escapes"""
+        self.pos += 1
+        chars = []
+        while True:
+            if self.pos >= len(self.text) or self.text[self.pos] in '\r\n':
+                self.fail("unterminated string")
+            char = self.text[self.pos]
+            self.pos += 1
+            if char == '"':
+                return ''.join(chars)
+            chars.append(self.escape() if char == '\\' else char)
+
+    def literal_string(self):
+        """Parse a string in single quotes, which has no escapes"""
+        end = self.text.find("'", self.pos + 1)
+        newline = self.text.find('\n', self.pos + 1)
+        if end == -1 or -1 < newline < end:
+            self.fail("unterminated string")
+        value = self.text[self.pos + 1:end]
+        self.pos = end + 1
+        return value
+
+    def multiline_string(self, delimiter):
+        """Parse a string in triple quotes"""
+        self.pos += 3
+        if self.text.startswith('\r\n', self.pos):
+            self.pos += 2
+        elif self.text.startswith('\n', self.pos):
+            self.pos += 1
+        chars = []
+        while True:
+            if self.pos >= len(self.text):
+                self.fail("unterminated string")
+            if self.text.startswith(delimiter, self.pos):
+                self.pos += 3
+                return ''.join(chars)
+            char = self.text[self.pos]
+            self.pos += 1
+            if char != '\\' or delimiter == "'''":
+                chars.append(char)
+            elif self.text[self.pos:self.pos + 1] in ('\n', '\r', ' ', '\t'):
+                # A backslash at the end of a line trims all whitespace after it
+                while self.pos < len(self.text) and self.text[self.pos] in ' \t\r\n':
+                    self.pos += 1
+            else:
+                chars.append(self.escape())
+
+    def escape(self):
+        """Parse the escape sequence after a backslash"""
+        char = self.text[self.pos:self.pos + 1]
+        self.pos += 1
+        if char in self.ESCAPES:
+            return self.ESCAPES[char]
+        if char in ('u', 'U'):
+            digits = 4 if char == 'u' else 8
+            code = self.text[self.pos:self.pos + digits]
+            self.pos += digits
+            try:
+                return unichr(int(code, 16))
+            except NameError:
+                return chr(int(code, 16))
+            except ValueError:
+                pass
+        self.fail("invalid escape sequence")
+
+    def skip(self, newlines=False):
+        """Skip whitespace and comments, and newlines if allowed"""
+        while self.pos < len(self.text):
+            char = self.text[self.pos]
+            if char in ' \t' or (newlines and char in '\r\n'):
+                self.pos += 1
+            elif char == '#':
+                end = self.text.find('\n', self.pos)
+                self.pos = len(self.text) if end == -1 else end
+            else:
+                return
+
+    def expect(self, token):
+        """Skip whitespace and then the given token"""
+        self.skip()
+        if not self.text.startswith(token, self.pos):
+            self.fail("expected `{}`".format(token))
+        self.pos += len(token)
+
+    def fail(self, message):
+        """Raise a ValueError pointing at the current position"""
+        line = self.text.count('\n', 0, self.pos) + 1
+        raise ValueError("line {}: {}".format(line, message))
+
+
 class RustBuild(object):
     """Provide all the methods required to build Rust"""
     def __init__(self):
@@ -325,12 +2960,25 @@ class RustBuild(object):
         self.rustfmt_channel = ''
         self.build = ''
         self.build_dir = os.path.join(os.getcwd(), "build")
+        self.checksums = {}
         self.clean = False
         self.config_toml = ''
         self.rust_root = ''
         self.use_locked_deps = ''
         self.use_vendored_sources = ''
         self.verbose = False
+        # Set while other phases run at the same time, output which can't be
+        # attributed to a phase (progress bars, child processes) is avoided.
+        self.concurrent_phases = False
+        # Set once anything had to be downloaded, updated or built
+        self.work_done = False
+        self._locked_packages = None
+        # Cleared when rustfmt isn't needed up front, see rustfmt_ready()
+        self.fetch_rustfmt = True
+        # Fingerprint of the bootstrap binaries, set by build_bootstrap()
+        self.fingerprint = None
+        # Set by run_phases() once a phase failed, see parallel_imap()
+        self.cancel = threading.Event()
 
 
     def download_stage0(self):
@@ -342,20 +2990,31 @@ class RustBuild(object):
 
         Each downloaded tarball is extracted, after that, the script
         will move all the content to the right place.
+
+        Another x.py using the same build directory may be doing the same
+        thing at the same time, bin_root() is locked while it's checked and
+        populated so that one waits for the other and then finds the
+        programs it needs already in place.
         """
+        build_dir = os.path.dirname(self.bin_root())
+        if not os.path.isdir(build_dir):
+            try:
+                os.makedirs(build_dir)
+            except OSError:
+                if not os.path.isdir(build_dir):
+                    raise
+        with FileLock(self.bin_root() + ".lock", timeout=self.lock_timeout()):
+            self._download_stage0()
+
+    def _download_stage0(self):
         rustc_channel = self.rustc_channel
         cargo_channel = self.cargo_channel
         rustfmt_channel = self.rustfmt_channel
 
-        def support_xz():
-            try:
-                with tempfile.NamedTemporaryFile(delete=False) as temp_file:
-                    temp_path = temp_file.name
-                with tarfile.open(temp_path, "w:xz") as tar:
-                    pass
-                return True
-            except tarfile.CompressionError:
-                return False
+        # Every group is a list of (filename, pattern, tarball_suffix, date)
+        # components, the executables to fix once all of them are unpacked
+        # and the stamp to write after that.
+        groups = []
 
         if self.rustc().startswith(self.bin_root()) and \
                 (not os.path.exists(self.rustc()) or
@@ -366,15 +3025,11 @@ class RustBuild(object):
             filename = "rust-std-{}-{}{}".format(
                 rustc_channel, self.build, tarball_suffix)
             pattern = "rust-std-{}".format(self.build)
-            self._download_stage0_helper(filename, pattern, tarball_suffix)
+            components = [(filename, pattern, tarball_suffix, self.date)]
 
             filename = "rustc-{}-{}{}".format(rustc_channel, self.build,
                                               tarball_suffix)
-            self._download_stage0_helper(filename, "rustc", tarball_suffix)
-            self.fix_executable("{}/bin/rustc".format(self.bin_root()))
-            self.fix_executable("{}/bin/rustdoc".format(self.bin_root()))
-            with output(self.rustc_stamp()) as rust_stamp:
-                rust_stamp.write(self.date)
+            components.append((filename, "rustc", tarball_suffix, self.date))
 
             # This is required so that we don't mix incompatible MinGW
             # libraries/binaries that are included in rust-std with
@@ -382,7 +3037,8 @@ class RustBuild(object):
             if "pc-windows-gnu" in self.build:
                 filename = "rust-mingw-{}-{}{}".format(
                     rustc_channel, self.build, tarball_suffix)
-                self._download_stage0_helper(filename, "rust-mingw", tarball_suffix)
+                components.append((filename, "rust-mingw", tarball_suffix, self.date))
+            groups.append((components, ["rustc", "rustdoc"], self.rustc_stamp()))
 
         if self.cargo().startswith(self.bin_root()) and \
                 (not os.path.exists(self.cargo()) or
@@ -390,12 +3046,11 @@ class RustBuild(object):
             tarball_suffix = '.tar.xz' if support_xz() else '.tar.gz'
             filename = "cargo-{}-{}{}".format(cargo_channel, self.build,
                                               tarball_suffix)
-            self._download_stage0_helper(filename, "cargo", tarball_suffix)
-            self.fix_executable("{}/bin/cargo".format(self.bin_root()))
-            with output(self.cargo_stamp()) as cargo_stamp:
-                cargo_stamp.write(self.date)
+            components = [(filename, "cargo", tarball_suffix, self.date)]
+            groups.append((components, ["cargo"], self.cargo_stamp()))
 
-        if self.rustfmt() and self.rustfmt().startswith(self.bin_root()) and (
+        if self.fetch_rustfmt and self.rustfmt() and \
+                self.rustfmt().startswith(self.bin_root()) and (
             not os.path.exists(self.rustfmt())
             or self.program_out_of_date(self.rustfmt_stamp())
         ):
@@ -403,47 +3058,401 @@ class RustBuild(object):
                 tarball_suffix = '.tar.xz' if support_xz() else '.tar.gz'
                 [channel, date] = rustfmt_channel.split('-', 1)
                 filename = "rustfmt-{}-{}{}".format(channel, self.build, tarball_suffix)
-                self._download_stage0_helper(filename, "rustfmt-preview", tarball_suffix, date)
-                self.fix_executable("{}/bin/rustfmt".format(self.bin_root()))
-                self.fix_executable("{}/bin/cargo-fmt".format(self.bin_root()))
-                with output(self.rustfmt_stamp()) as rustfmt_stamp:
-                    rustfmt_stamp.write(self.date)
+                components = [(filename, "rustfmt-preview", tarball_suffix, date)]
+                groups.append((components, ["rustfmt", "cargo-fmt"],
+                               self.rustfmt_stamp()))
+
+        if groups:
+            self.work_done = True
+        self._download_stage0_components(groups)
+
+    def _download_stage0_components(self, groups):
+        """Download and unpack the given groups of stage0 components
+
+        Tarballs are fetched by a pool of `download_jobs()` threads and each
+        one is unpacked as soon as its own download has been verified. Once
+        all the components of a group are unpacked its executables are fixed
+        and then its stamp is written, so a stamp never describes a
+        partially installed program.
+        """
+        components = [component for group in groups for component in group[0]]
+        remaining = [set(group[0]) for group in groups]
+        progress_bar = not self.concurrent_phases and \
+            (self.download_jobs() <= 1 or len(components) <= 1)
+
+        def fetch(component):
+            """Fetch a component, returning how to install it in bin_root()"""
+            filename, pattern, tarball_suffix, date = component
+            if self.stage0_store() is not None:
+                entry, lock = self._store_stage0_helper(filename, pattern, tarball_suffix,
+                                                        date, progress_bar)
+
+                def link():
+                    try:
+                        materialize(entry, self.bin_root(), self.verbose)
+                    finally:
+                        lock.release()
+                return link
+            if self.stream_extract():
+                staging = self._stream_stage0_helper(filename, pattern,
+                                                     tarball_suffix, date)
+                # Streamed downloads are already extracted and verified
+                return lambda: promote(staging, self.bin_root(), self.verbose)
+            tarball, lock = self._download_stage0_helper(filename, date, progress_bar)
+
+            def install():
+                try:
+                    unpack(tarball, tarball_suffix, self.bin_root(), match=pattern,
+                           verbose=self.verbose)
+                finally:
+                    if lock is not None:
+                        lock.release()
+            return install
 
-    def _download_stage0_helper(self, filename, pattern, tarball_suffix, date=None):
+        staging = os.path.join(self.build_dir, self.build, "stage0-staging")
+        try:
+            fetched = parallel_imap(fetch, components, self.download_jobs(),
+                                    self.cancel)
+            for component, install in fetched:
+                install()
+                for (_, executables, stamp), left in zip(groups, remaining):
+                    if component not in left:
+                        continue
+                    left.remove(component)
+                    if left:
+                        continue
+                    paths = ["{}/bin/{}".format(self.bin_root(), executable)
+                             for executable in executables]
+                    with tracer.span("fix_executables", paths=paths):
+                        self.fix_executables(paths)
+                    with output(stamp) as stamp_file:
+                        stamp_file.write(self.date)
+        except BaseException:
+            # Don't leave extracted but unverified files behind
+            shutil.rmtree(staging, ignore_errors=True)
+            raise
+
+        if os.path.isdir(staging) and not os.listdir(staging):
+            os.rmdir(staging)
+
+        cache = self.stage0_cache()
+        if cache is not None:
+            cache.prune(verbose=self.verbose)
+
+    def _download_stage0_helper(self, filename, date=None, progress_bar=True):
+        """Make sure the given tarball is in the cache
+
+        Returns its path, and the lock which keeps it from being evicted from
+        the machine-wide stage0 cache until it's released. The lock is None
+        when that cache isn't used.
+        """
         if date is None:
             date = self.date
+        expected = self.pinned_sha256(date, filename)
+        cache = self.stage0_cache()
+        if cache is not None:
+            url = "{}/dist/{}/{}".format(self._download_url, date, filename)
+            return cache.fetch(url, filename, self.verbose, progress_bar, expected,
+                               self.stage0_deltas())
         cache_dst = os.path.join(self.build_dir, "cache")
         rustc_cache = os.path.join(cache_dst, date)
-        if not os.path.exists(rustc_cache):
+        try:
             os.makedirs(rustc_cache)
+        except OSError:
+            # Another download may have created it concurrently
+            if not os.path.isdir(rustc_cache):
+                raise
 
         url = "{}/dist/{}".format(self._download_url, date)
         tarball = os.path.join(rustc_cache, filename)
-        if not os.path.exists(tarball):
-            get("{}/{}".format(url, filename), tarball, verbose=self.verbose)
-        unpack(tarball, tarball_suffix, self.bin_root(), match=pattern, verbose=self.verbose)
+        # Concurrent x.py runs wait for each other's download of the tarball
+        # instead of fetching it again and replacing it under each other.
+        with FileLock(tarball + ".lock", timeout=self.lock_timeout()):
+            base = None
+            if self.stage0_deltas() and not os.path.exists(tarball):
+                base = self.delta_base(date, filename)
+            if base is not None:
+                if expected is None:
+                    expected = fetch_sha256("{}/{}".format(url, filename), self.verbose)
+                base_sha256 = self.pinned_sha256(*base) or \
+                    sha256_file(os.path.join(cache_dst, *base))
+                fetch_delta("{}/{}".format(url, filename), tarball,
+                            os.path.join(cache_dst, *base), base_sha256, expected,
+                            self.verbose)
+            # A pinned checksum lets get() verify the cached tarball offline
+            if expected is not None or not os.path.exists(tarball):
+                get("{}/{}".format(url, filename), tarball, verbose=self.verbose,
+                    progress_bar=progress_bar, expected=expected)
+        return tarball, None
+
+    def delta_base(self, date, filename):
+        """Return the `(date, filename)` of the newest tarball of the same
+        component as the given one in `build/cache`, or None"""
+        component = stage0_component(filename)
+        cache_dst = os.path.join(self.build_dir, "cache")
+        if component is None or not os.path.isdir(cache_dst):
+            return None
+        bases = []
+        for other in os.listdir(cache_dst):
+            directory = os.path.join(cache_dst, other)
+            if other >= date or not os.path.isdir(directory):
+                continue
+            bases.extend((other, name) for name in os.listdir(directory)
+                         if stage0_component(name) == component)
+        return max(bases) if bases else None
+
+    def pinned_sha256(self, date, filename):
+        """Return the SHA-256 pinned for the given stage0 tarball, or None
+
+        >>> rb = RustBuild()
+        >>> rb.checksums = {"2019-12-18/cargo.tar.xz": "abc"}
+        >>> rb.pinned_sha256("2019-12-18", "cargo.tar.xz")
+        'abc'
+        >>> rb.pinned_sha256("2019-12-19", "cargo.tar.xz") is None
+        True
+        """
+        return self.checksums.get("{}/{}".format(date, filename))
+
+    def _stream_stage0_helper(self, filename, pattern, tarball_suffix, date):
+        """Extract the given tarball while downloading it, without storing it
+
+        The network stream is hashed and decompressed concurrently, and the
+        files are extracted into a staging directory. Its path is returned
+        once the whole download matched its checksum, the caller then moves
+        its contents into place.
+        """
+        url = "{}/dist/{}/{}".format(self._download_url, date, filename)
+        cached = self.stage0_cached(date, filename)
+        if cached or not http_downloader.supports(url):
+            if self.verbose and not cached:
+                print("cannot stream", url, "falling back to a regular download")
+            tarball, lock = self._download_stage0_helper(filename, date, False)
+            staging = self._stage0_staging(filename)
+            try:
+                unpack(tarball, tarball_suffix, staging, self.verbose, pattern)
+            finally:
+                if lock is not None:
+                    lock.release()
+            return staging
+        expected = self.pinned_sha256(date, filename) or \
+            fetch_sha256(url, self.verbose)
+        fname = filename.replace(tarball_suffix, "")
+        # Retries go to the next mirror, if there are any
+        sources = dist_mirrors.urls(url)
+        for attempt in range(0, 4):
+            staging = self._stage0_staging(filename)
+            source = sources[attempt % len(sources)]
+            print("downloading and extracting {}".format(source))
+            try:
+                with tracer.span("download and unpack", url=source, cache="miss"):
+                    found = http_downloader.stream(source, lambda body: unpack_stream(
+                        body, tarball_suffix, fname, staging, self.verbose, pattern))
+                break
+            except (RuntimeError, EOFError, IOError, OSError, tarfile.TarError) as error:
+                if attempt == 3:
+                    raise
+                print("spurious failure ({}), trying again".format(error))
+                sleep(backoff_delay(attempt))
+        if not check_sha256(url, expected, self.verbose, found):
+            shutil.rmtree(staging)
+            raise RuntimeError("failed verification")
+        return staging
+
+    def _store_stage0_helper(self, filename, pattern, tarball_suffix, date,
+                             progress_bar=True):
+        """Make sure the given component is extracted in the toolchain store
+
+        Returns the directory holding the extracted component along with a
+        shared lock on it, which keeps the stage0 cache from evicting it
+        until it's released. It's keyed by the date, the build triple and
+        the tarball, and it's only created once it's complete, so it can be
+        linked into any number of build directories without downloading or
+        extracting anything again.
+        """
+        fname = filename.replace(tarball_suffix, "")
+        entry = os.path.join(self.stage0_store(), date, self.build, fname)
+        try:
+            os.makedirs(os.path.dirname(entry))
+        except OSError:
+            if not os.path.isdir(os.path.dirname(entry)):
+                raise
+        entry_lock = FileLock(entry + ".lock", True, self.lock_timeout())
+        entry_lock.acquire()
+        try:
+            if os.path.isdir(entry):
+                if self.verbose:
+                    print("using extracted toolchain", entry)
+                tracer.mark("toolchain store", entry=entry, cache="hit")
+                os.utime(entry, None)
+            else:
+                self._unpack_to_store(entry, filename, pattern, tarball_suffix, date,
+                                      progress_bar)
+        except BaseException:
+            entry_lock.release()
+            raise
+        return entry, entry_lock
+
+    def _unpack_to_store(self, entry, filename, pattern, tarball_suffix, date,
+                         progress_bar):
+        """Extract the given component into the store entry `entry`"""
+        tarball, lock = self._download_stage0_helper(filename, date, progress_bar)
+        temp = "{}.tmp-{}-{}".format(entry, os.getpid(), threading.current_thread().ident)
+        try:
+            try:
+                unpack(tarball, tarball_suffix, temp, self.verbose, pattern)
+            finally:
+                if lock is not None:
+                    lock.release()
+            # The store is linked into build directories, executables are
+            # fixed once here rather than through the links.
+            bin_dir = os.path.join(temp, "bin")
+            if os.path.isdir(bin_dir):
+                paths = [os.path.join(bin_dir, name) for name in os.listdir(bin_dir)]
+                with tracer.span("fix_executables", paths=paths):
+                    self.fix_executables(paths)
+            try:
+                os.rename(temp, entry)
+            except OSError:
+                # Another process stored the same component first
+                if not os.path.isdir(entry):
+                    raise
+        finally:
+            shutil.rmtree(temp, ignore_errors=True)
+
+    def _stage0_staging(self, filename):
+        """Return an empty staging directory for the given tarball, on the
+        same file system as `bin_root()`"""
+        staging = os.path.join(self.build_dir, self.build, "stage0-staging", filename)
+        if os.path.exists(staging):
+            shutil.rmtree(staging)
+        os.makedirs(staging)
+        return staging
+
+    def stage0_store(self):
+        """Return the directory of the extracted toolchain store, or None if
+        toolchains are extracted into the build directory
+
+        >>> rb = RustBuild()
+        >>> rb.config_toml = '[build]\\nstage0-cache = "/cache"'
+        >>> rb.stage0_store() is None
+        True
+        >>> rb.config_toml = '[build]\\nstage0-store = "/cache/toolchains"'
+        >>> rb.stage0_store() == "/cache/toolchains"
+        True
+        """
+        store = os.environ.get('RUST_STAGE0_STORE') or \
+            self.get_toml('stage0-store', 'build')
+        if store:
+            return os.path.expanduser(store)
+        return None
+
+    def prefetch_manifest(self):
+        """Return the manifest of the tarballs `bootstrap.py stage0-prefetch`
+        downloaded, it lives next to them
+
+        >>> rb = RustBuild()
+        >>> rb.build_dir = "build"
+        >>> rb.prefetch_manifest() == os.path.join("build", "cache", "stage0.sha256")
+        True
+        >>> rb.config_toml = '[build]\\nstage0-cache = "/cache"'
+        >>> rb.prefetch_manifest() == os.path.join("/cache", "stage0.sha256")
+        True
+        """
+        cache = self.stage0_cache()
+        root = cache.root if cache is not None else os.path.join(self.build_dir, "cache")
+        return os.path.join(root, "stage0.sha256")
+
+    def stage0_cached(self, date, filename):
+        """Return whether the given tarball was downloaded already and its
+        checksum is known, so that it can be used without any request"""
+        expected = self.pinned_sha256(date, filename)
+        if expected is None:
+            return False
+        cache = self.stage0_cache()
+        if cache is not None:
+            return os.path.exists(os.path.join(cache.entry(expected), filename))
+        return os.path.exists(os.path.join(self.build_dir, "cache", date, filename))
+
+    def stream_extract(self):
+        """Return whether stage0 tarballs are extracted while they download"""
+        return self.get_toml('stream-extract', 'build') == 'true'
+
+    def stage0_cache(self):
+        """Return the machine-wide stage0 cache, or None if it's disabled
+
+        >>> rb = RustBuild()
+        >>> rb.config_toml = '[build]\\nstage0-cache = "/cache"\\nstage0-cache-size = "2G"'
+        >>> cache = rb.stage0_cache()
+        >>> cache.root, cache.max_size
+        ('/cache', 2147483648)
+        """
+        root = os.environ.get('RUST_STAGE0_CACHE') or \
+            self.get_toml('stage0-cache', 'build')
+        if not root:
+            return None
+        size = os.environ.get('RUST_STAGE0_CACHE_SIZE') or \
+            self.get_toml('stage0-cache-size', 'build')
+        return Stage0Cache(os.path.expanduser(root),
+                           parse_size(size) if size else None,
+                           self.lock_timeout(), self.stage0_store())
+
+    def stage0_deltas(self):
+        """Return whether missing stage0 tarballs are first looked for as
+        deltas against cached ones"""
+        return self.get_toml('stage0-deltas', 'build') == 'true'
+
+    def lock_timeout(self):
+        """Return how many seconds to wait for a lock held by another x.py,
+        None if it's waited for as long as it takes
+
+        >>> rb = RustBuild()
+        >>> rb.lock_timeout()
+        3600.0
+        >>> rb.config_toml = '[build]\\nlock-timeout = 0'
+        >>> rb.lock_timeout() is None
+        True
+        """
+        timeout = self.get_toml('lock-timeout', 'build')
+        timeout = 3600.0 if timeout is None else float(timeout)
+        return timeout if timeout > 0 else None
+
+    def download_jobs(self):
+        """Return how many stage0 tarballs may be downloaded at once
+
+        >>> rb = RustBuild()
+        >>> rb.download_jobs()
+        4
+        >>> rb.config_toml = '[build]\\ndownload-jobs = 1'
+        >>> rb.download_jobs()
+        1
+        """
+        jobs = self.get_toml('download-jobs', 'build')
+        if jobs is None:
+            return 4
+        return max(1, int(jobs))
 
     @staticmethod
     def fix_executable(fname):
         """Modifies the interpreter section of 'fname' to fix the dynamic linker
 
-        This method is only required on NixOS and uses the PatchELF utility to
-        change the dynamic linker of ELF executables.
+        This is only required on NixOS, see `fix_executables`.
+        """
+        RustBuild.fix_executables([fname])
+
+    @staticmethod
+    def fix_executables(paths):
+        """Modifies the interpreter section of the given ELF executables to fix
+        the dynamic linker
+
+        This method is only required on NixOS. The interpreter is rewritten
+        by set_elf_interpreter, the PatchELF utility is only used for files it
+        can't handle. Files which aren't dynamically linked executables are
+        left alone.
 
         Please see https://nixos.org/patchelf.html for more information
         """
-        default_encoding = sys.getdefaultencoding()
-        try:
-            ostype = subprocess.check_output(
-                ['uname', '-s']).strip().decode(default_encoding)
-        except subprocess.CalledProcessError:
-            return
-        except OSError as reason:
-            if getattr(reason, 'winerror', None) is not None:
-                return
-            raise reason
-
-        if ostype != "Linux":
+        uname = host_uname()
+        if uname is None or uname[0] != "Linux":
             return
 
         if not os.path.exists("/etc/NIXOS"):
@@ -453,43 +3462,29 @@ class RustBuild(object):
 
         # At this point we're pretty sure the user is running NixOS
         nix_os_msg = "info: you seem to be running NixOS. Attempting to patch"
-        print(nix_os_msg, fname)
-
-        try:
-            interpreter = subprocess.check_output(
-                ["patchelf", "--print-interpreter", fname])
-            interpreter = interpreter.strip().decode(default_encoding)
-        except subprocess.CalledProcessError as reason:
-            print("warning: failed to call patchelf:", reason)
-            return
-
-        loader = interpreter.split("/")[-1]
-
-        try:
-            ldd_output = subprocess.check_output(
-                ['ldd', '/run/current-system/sw/bin/sh'])
-            ldd_output = ldd_output.strip().decode(default_encoding)
-        except subprocess.CalledProcessError as reason:
-            print("warning: unable to call ldd:", reason)
-            return
-
-        for line in ldd_output.splitlines():
-            libname = line.split()[0]
-            if libname.endswith(loader):
-                loader_path = libname[:len(libname) - len(loader)]
-                break
-        else:
-            print("warning: unable to find the path to the dynamic linker")
-            return
+        for fname in paths:
+            try:
+                found = elf_interpreter(fname)
+            except (IOError, OSError, struct.error) as reason:
+                print("warning: failed to read", fname, reason)
+                continue
+            if found is None:
+                continue
+            print(nix_os_msg, fname)
 
-        correct_interpreter = loader_path + loader
+            loader = found[2].split("/")[-1]
+            correct_interpreter = nix_loader(loader)
+            if correct_interpreter is None:
+                print("warning: unable to find the path to the dynamic linker")
+                return
 
-        try:
-            subprocess.check_output(
-                ["patchelf", "--set-interpreter", correct_interpreter, fname])
-        except subprocess.CalledProcessError as reason:
-            print("warning: failed to call patchelf:", reason)
-            return
+            if set_elf_interpreter(fname, correct_interpreter):
+                continue
+            try:
+                subprocess.check_output(
+                    ["patchelf", "--set-interpreter", correct_interpreter, fname])
+            except (subprocess.CalledProcessError, OSError) as reason:
+                print("warning: failed to call patchelf:", reason)
 
     def rustc_stamp(self):
         """Return the path for .rustc-stamp
@@ -544,6 +3539,64 @@ class RustBuild(object):
         """
         return os.path.join(self.build_dir, self.build, "stage0")
 
+    @property
+    def config_toml(self):
+        """The contents of config.toml"""
+        return self._config_toml
+
+    @config_toml.setter
+    def config_toml(self, text):
+        # The configuration is parsed once, into an index of the first value
+        # of every key by table and one of the first value of every key in
+        # any table.
+        self._config_toml = text
+        self._toml_keys = {}
+        self._toml_tables = {}
+        try:
+            entries = TomlParser(text).parse()
+        except ValueError as error:
+            # Leave reporting errors to bootstrap itself, which uses a real
+            # TOML parser, and fall back to looking at individual lines.
+            if getattr(self, 'verbose', False):
+                print("warning: failed to parse config.toml ({}), "
+                      "reading it line by line".format(error))
+            entries = self._scan_toml_lines(text)
+        for table, key, value in entries:
+            self._toml_keys.setdefault(key, value)
+            self._toml_tables.setdefault((table, key), value)
+
+    @classmethod
+    def _scan_toml_lines(cls, text):
+        """Find `key = value` lines the way bootstrap.py used to"""
+        entries = []
+        table = None
+        for line in text.splitlines():
+            table_match = re.match(r'^\s*\[(.*)\]\s*$', line)
+            if table_match is not None:
+                table = table_match.group(1)
+            match = re.match(r'^([^\s=]+)\s*=(.*)$', line)
+            if match is not None:
+                value = match.group(2)
+                entries.append((table, match.group(1),
+                                cls.get_string(value) or value.strip()))
+        return entries
+
+    def get_toml_value(self, key, section=None):
+        """Returns the typed value of the given key in config.toml, or None
+
+        Without a section the first value of the key in any table is used.
+
+        >>> rb = RustBuild()
+        >>> rb.config_toml = '[build]\\njobs = 4\\ntargets = [\\n  "a", "b",\\n]'
+        >>> rb.get_toml_value('jobs', 'build')
+        4
+        >>> rb.get_toml_value('targets')
+        ['a', 'b']
+        """
+        if section is None:
+            return self._toml_keys.get(key)
+        return self._toml_tables.get((section, key))
+
     def get_toml(self, key, section=None):
         """Returns the value of the given key in config.toml, otherwise returns None
 
@@ -567,23 +3620,16 @@ class RustBuild(object):
         >>> rb.get_toml('key', 'c') is None
         True
 
+        Values other than strings are returned as they are written in TOML
+
         >>> rb.config_toml = 'key1 = true'
         >>> rb.get_toml("key1")
         'true'
+        >>> rb.config_toml = 'target.x86_64-unknown-linux-gnu.llvm-config = "/llvm"'
+        >>> rb.get_toml('llvm-config', 'target.x86_64-unknown-linux-gnu')
+        '/llvm'
         """
-
-        cur_section = None
-        for line in self.config_toml.splitlines():
-            section_match = re.match(r'^\s*\[(.*)\]\s*$', line)
-            if section_match is not None:
-                cur_section = section_match.group(1)
-
-            match = re.match(r'^{}\s*=(.*)$'.format(key), line)
-            if match is not None:
-                value = match.group(1)
-                if section is None or section == cur_section:
-                    return self.get_string(value) or value.strip()
-        return None
+        return format_toml(self.get_toml_value(key, section))
 
     def cargo(self):
         """Return config path for cargo"""
@@ -599,6 +3645,25 @@ class RustBuild(object):
             return None
         return self.program_config('rustfmt')
 
+    def rustfmt_ready(self):
+        """Return whether rustfmt can be used without downloading it first
+
+        >>> rb = RustBuild()
+        >>> rb.rustfmt_ready()
+        False
+        >>> rb.rustfmt_channel = "nightly-2019-12-18"
+        >>> rb.config_toml = '[build]\\nrustfmt = "/usr/bin/rustfmt"'
+        >>> rb.rustfmt_ready()
+        True
+        """
+        rustfmt = self.rustfmt()
+        if rustfmt is None:
+            return False
+        if not rustfmt.startswith(self.bin_root()):
+            return True
+        return os.path.exists(rustfmt) and \
+            not self.program_out_of_date(self.rustfmt_stamp())
+
     def program_config(self, program):
         """Return config path for the given program
 
@@ -664,6 +3729,33 @@ class RustBuild(object):
         build_dir = os.path.join(self.build_dir, "bootstrap")
         if self.clean and os.path.exists(build_dir):
             shutil.rmtree(build_dir)
+        env = self.bootstrap_env()
+        fingerprint = self.bootstrap_fingerprint(env)
+        self.fingerprint = fingerprint
+        with tracer.span("bootstrap binaries", fingerprint=fingerprint) as span:
+            up_to_date = self.bootstrap_up_to_date(fingerprint)
+            span["cache"] = "hit" if up_to_date else "miss"
+        if up_to_date:
+            return
+        self.work_done = True
+        if not os.path.isfile(self.cargo()):
+            raise Exception("no cargo executable found at `{}`".format(
+                self.cargo()))
+        args = [self.cargo(), "build", "--manifest-path",
+                os.path.join(self.rust_root, "src/bootstrap/Cargo.toml")]
+        for _ in range(1, self.verbose):
+            args.append("--verbose")
+        if self.use_locked_deps:
+            args.append("--locked")
+        if self.use_vendored_sources:
+            args.append("--frozen")
+        with tracer.span("cargo build", category="build"):
+            run(args, env=env, verbose=self.verbose)
+        self.save_bootstrap(fingerprint)
+
+    def bootstrap_env(self):
+        """Return the environment bootstrap is built in"""
+        build_dir = os.path.join(self.build_dir, "bootstrap")
         env = os.environ.copy()
         env["RUSTC_BOOTSTRAP"] = '1'
         env["CARGO_TARGET_DIR"] = build_dir
@@ -698,61 +3790,318 @@ class RustBuild(object):
 
         env["PATH"] = os.path.join(self.bin_root(), "bin") + \
             os.pathsep + env["PATH"]
-        if not os.path.isfile(self.cargo()):
-            raise Exception("no cargo executable found at `{}`".format(
-                self.cargo()))
-        args = [self.cargo(), "build", "--manifest-path",
-                os.path.join(self.rust_root, "src/bootstrap/Cargo.toml")]
-        for _ in range(1, self.verbose):
-            args.append("--verbose")
-        if self.use_locked_deps:
-            args.append("--locked")
-        if self.use_vendored_sources:
-            args.append("--frozen")
-        run(args, env=env, verbose=self.verbose)
+        return env
+
+    def bootstrap_fingerprint(self, env):
+        """Return a hash of everything the bootstrap binaries are built from
+
+        That is the sources of the bootstrap crates, Cargo.lock, the stage0
+        compiler and Cargo, the RUSTFLAGS and the Cargo configuration from
+        the environment. Nothing specific to a worktree goes into it, so
+        identical checkouts get the same fingerprint.
+        """
+        sha256 = hashlib.sha256()
+
+        def feed(*parts):
+            for part in parts:
+                sha256.update(part.encode('utf-8') + b'\0')
+
+        feed(self.build)
+        for program, channel, stamp in (('rustc', self.rustc_channel, self.rustc_stamp()),
+                                        ('cargo', self.cargo_channel, self.cargo_stamp())):
+            path = getattr(self, program)()
+            if path.startswith(self.bin_root()) and os.path.exists(stamp):
+                with open(stamp) as stamp_file:
+                    feed(program, channel, stamp_file.read())
+            elif os.path.exists(path):
+                status = os.stat(path)
+                feed(program, path, str(status.st_size), str(int(status.st_mtime)))
+        for name in sorted(env):
+            if name in ('RUSTFLAGS', 'RUSTC_BOOTSTRAP', 'RUSTC_WRAPPER') or \
+                    (name.startswith('CARGO_') and name != 'CARGO_TARGET_DIR'):
+                feed(name, env[name])
+        feed(sha256_file(os.path.join(self.rust_root, "Cargo.lock")))
+        for crate in ("src/bootstrap", "src/build_helper"):
+            crate = os.path.join(self.rust_root, crate)
+            for root, dirs, files in os.walk(crate):
+                dirs.sort()
+                for name in sorted(files):
+                    if name.endswith(('.rs', '.toml')):
+                        path = os.path.join(root, name)
+                        feed(os.path.relpath(path, crate).replace(os.sep, '/'))
+                        hash_file(path, sha256)
+        return sha256.hexdigest()
+
+    def bootstrap_binaries(self):
+        """Return the paths of all the binaries built from src/bootstrap"""
+        with open(os.path.join(self.rust_root, "src/bootstrap/Cargo.toml")) as manifest:
+            names = re.findall(r'\[\[bin\]\]\s*name\s*=\s*"([^"]+)"', manifest.read())
+        return [os.path.join(os.path.dirname(self.bootstrap_binary()),
+                             name + self.exe_suffix()) for name in names]
+
+    def bootstrap_fingerprint_path(self):
+        """Return the path where the fingerprint of the last build is kept"""
+        return os.path.join(self.build_dir, "bootstrap", ".bootstrap-fingerprint")
+
+    def bootstrap_up_to_date(self, fingerprint):
+        """Check whether the bootstrap binaries match `fingerprint`
+
+        If they don't, they are taken from the machine-wide cache when it
+        has binaries built with an identical fingerprint.
+        """
+        binaries = self.bootstrap_binaries()
+        fingerprint_path = self.bootstrap_fingerprint_path()
+        if all(os.path.exists(binary) for binary in binaries) and \
+                os.path.exists(fingerprint_path):
+            with open(fingerprint_path) as last:
+                if last.read() == fingerprint:
+                    if self.verbose:
+                        print("bootstrap is up to date")
+                    return True
+        cache = self.stage0_cache()
+        if cache is None or self.clean:
+            return False
+        cached = os.path.join(cache.root, "bootstrap", fingerprint)
+        if not os.path.isdir(cached):
+            return False
+        # Keep prune() from evicting the binaries while they're copied
+        with cache.lock_path(cached, shared=True):
+            if not os.path.isdir(cached):
+                return False
+            print("using bootstrap binaries from", cached)
+            os.utime(cached, None)
+            for binary in binaries:
+                if not os.path.isdir(os.path.dirname(binary)):
+                    os.makedirs(os.path.dirname(binary))
+                shutil.copy2(os.path.join(cached, os.path.basename(binary)), binary + ".tmp")
+                if os.path.exists(binary):
+                    os.unlink(binary)
+                os.rename(binary + ".tmp", binary)
+        with output(fingerprint_path) as last:
+            last.write(fingerprint)
+        return True
+
+    def save_bootstrap(self, fingerprint):
+        """Record the fingerprint of freshly built bootstrap binaries and
+        share them through the machine-wide cache"""
+        with output(self.bootstrap_fingerprint_path()) as last:
+            last.write(fingerprint)
+        cache = self.stage0_cache()
+        if cache is None:
+            return
+        cached = os.path.join(cache.root, "bootstrap", fingerprint)
+        if os.path.isdir(cached):
+            return
+        temp = "{}.tmp-{}".format(cached, os.getpid())
+        try:
+            os.makedirs(temp)
+            for binary in self.bootstrap_binaries():
+                shutil.copy2(binary, temp)
+            os.rename(temp, cached)
+        except OSError as reason:
+            print("warning: failed to cache the bootstrap binaries:", reason)
+        finally:
+            shutil.rmtree(temp, ignore_errors=True)
+        cache.prune(verbose=self.verbose)
+
+    def help_snapshot_path(self, fingerprint, args):
+        """Return where the help bootstrap printed for `args` is kept
+
+        Help depends on the bootstrap binary, identified by its
+        `fingerprint`, on the arguments and on config.toml.
+        """
+        key = hashlib.sha256()
+        for part in [fingerprint, self.config_toml] + args:
+            if isinstance(part, type(u"")):
+                part = part.encode('utf-8')
+            key.update(part + b'\0')
+        return os.path.join(self.build_dir, "bootstrap", "help", key.hexdigest())
+
+    def help_snapshot(self, args):
+        """Return the `(status, output)` of bootstrap for the given help
+        arguments if they are known for the current sources, or None"""
+        fingerprint = self.bootstrap_fingerprint(self.bootstrap_env())
+        try:
+            with open(self.help_snapshot_path(fingerprint, args)) as snapshot:
+                snapshot = json.load(snapshot)
+            return snapshot["status"], snapshot["output"]
+        except (IOError, OSError, ValueError, KeyError):
+            return None
+
+    def save_help_snapshot(self, args, status, text):
+        """Remember what bootstrap printed for the given help arguments"""
+        path = self.help_snapshot_path(self.fingerprint, args)
+        try:
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            with output(path) as snapshot:
+                json.dump({"status": status, "output": text}, snapshot)
+        except (IOError, OSError) as reason:
+            print("warning: failed to save the help output:", reason)
 
     def build_triple(self):
         """Build triple as in LLVM"""
         config = self.get_toml('build')
         if config:
             return config
-        return default_build_triple()
+        return default_build_triple(self.build_dir)
 
-    def check_submodule(self, module, slow_submodules):
-        if not slow_submodules:
-            checked_out = subprocess.Popen(["git", "rev-parse", "HEAD"],
-                                           cwd=os.path.join(self.rust_root, module),
-                                           stdout=subprocess.PIPE)
-            return checked_out
-        else:
-            return None
+    def submodule_jobs(self):
+        """Return how many submodules may be updated at once
 
-    def update_submodule(self, module, checked_out, recorded_submodules):
-        module_path = os.path.join(self.rust_root, module)
+        >>> rb = RustBuild()
+        >>> rb.submodule_jobs()
+        4
+        >>> rb.config_toml = '[build]\\nsubmodule-jobs = 1'
+        >>> rb.submodule_jobs()
+        1
+        """
+        jobs = self.get_toml('submodule-jobs', 'build')
+        if jobs is None:
+            return 4
+        return max(1, int(jobs))
 
-        if checked_out is not None:
-            default_encoding = sys.getdefaultencoding()
-            checked_out = checked_out.communicate()[0].decode(default_encoding).strip()
-            if recorded_submodules[module] == checked_out:
-                return
+    def submodules_stamp(self):
+        """Return the path of the file recording the last submodule update"""
+        return os.path.join(self.build_dir, ".submodules-stamp")
+
+    def submodules_state(self, modules):
+        """Describe the checkout the submodules were last updated against
 
-        print("Updating submodule", module)
+        The first line covers the superproject's HEAD and index as well as
+        the configuration deciding which submodules are needed, and each
+        following line the HEAD of one submodule. No git command is run, so
+        this is cheap enough to check on every invocation.
+        """
+        def mtime(path):
+            try:
+                return repr(os.stat(path).st_mtime)
+            except OSError:
+                return "missing"
 
-        run(["git", "submodule", "-q", "sync", module],
-            cwd=self.rust_root, verbose=self.verbose)
+        gitdir = git_dir(self.rust_root)
+        state = [" ".join([
+            str(read_git_head(gitdir)),
+            mtime(os.path.join(gitdir, "index")),
+            mtime(os.path.join(self.rust_root, ".gitmodules")),
+            str(self.get_toml('llvm-config')),
+            str(self.get_toml('lld')),
+        ])]
+        for module in modules:
+            module_gitdir = git_dir(os.path.join(self.rust_root, module))
+            head = None
+            if module_gitdir is not None:
+                head = os.path.join(module_gitdir, "HEAD")
+            state.append("%s %s" % (module, head and mtime(head)))
+        return state
+
+    def submodules_unchanged(self):
+        """Check whether nothing changed since the submodules were last updated"""
         try:
-            run(["git", "submodule", "update",
-                 "--init", "--recursive", "--progress", module],
-                cwd=self.rust_root, verbose=self.verbose, exception=True)
-        except RuntimeError:
+            with open(self.submodules_stamp()) as stamp:
+                recorded = stamp.read().splitlines()
+        except (IOError, OSError):
+            return False
+        if not recorded:
+            return False
+        modules = [line.rsplit(" ", 1)[0] for line in recorded[1:]]
+        return self.submodules_state(modules) == recorded
+
+    def submodule_clone_mode_args(self, git_version):
+        """Return the arguments selecting how submodules are cloned
+
+        `build.submodule-clone` may be "full", "shallow" (only the recorded
+        commit is fetched) or "blobless" (file contents are fetched lazily).
+        Modes unsupported by the installed git fall back to full clones.
+
+        >>> rb = RustBuild()
+        >>> rb.submodule_clone_mode_args((2, 39, 5))
+        []
+        >>> rb.config_toml = '[build]\\nsubmodule-clone = "shallow"'
+        >>> rb.submodule_clone_mode_args((2, 39, 5))
+        ['--depth', '1']
+        >>> rb.config_toml = '[build]\\nsubmodule-clone = "blobless"'
+        >>> rb.submodule_clone_mode_args((2, 39, 5))
+        ['--filter=blob:none']
+        """
+        mode = self.get_toml('submodule-clone', 'build') or 'full'
+        modes = {
+            'full': ((0,), []),
+            'shallow': ((2, 10), ['--depth', '1']),
+            'blobless': ((2, 36), ['--filter=blob:none']),
+        }
+        if mode not in modes:
+            raise Exception("unknown submodule-clone mode `{}`, expected one of {}".format(
+                mode, ", ".join(sorted(modes))))
+        required, args = modes[mode]
+        if git_version < required:
+            print("warning: {} submodule clones need git {} or newer, cloning in full".format(
+                mode, ".".join(str(part) for part in required)))
+            return []
+        return args
+
+    def submodule_reference_args(self, module):
+        """Return the arguments borrowing objects for `module` from a reference
+
+        `build.submodule-reference` names a directory laid out like the source
+        tree, usually another checkout of this repository, whose submodules'
+        objects are used through git alternates instead of being downloaded.
+        """
+        reference = self.get_toml('submodule-reference', 'build')
+        if not reference:
+            return []
+        gitdir = git_dir(os.path.join(os.path.expanduser(reference), module))
+        if gitdir is None:
+            return []
+        return ['--reference', gitdir]
+
+    def update_submodule(self, module, clone_args=(), output=None):
+        """Check out the commit of `module` recorded in the superproject
+
+        The submodule must have been synced and initialized already.
+        `clone_args` are passed to `git submodule update`, if that fails they
+        are dropped again. If `output` is a list the output of git is
+        collected into it rather than printed, so several submodules can be
+        updated at once.
+        """
+        with tracer.span("submodule", category="git", module=module):
+            self._update_submodule(module, clone_args, output)
+
+    def _update_submodule(self, module, clone_args, output):
+        module_path = os.path.join(self.rust_root, module)
+
+        def git(args, cwd, exception=False):
+            if output is None:
+                run(args, cwd=cwd, verbose=self.verbose, exception=exception)
+                return
+            if self.verbose:
+                output.append("running: " + ' '.join(args))
+            run(args, cwd=cwd, exception=True, stderr=subprocess.STDOUT,
+                consume_stdout=lambda pipe: output.extend(
+                    pipe.read().decode(sys.getdefaultencoding(), "replace").splitlines()))
+
+        update = ["git", "submodule", "update", "--recursive"]
+        clone_args = list(clone_args)
+        attempts = [update + clone_args + [module]]
+        if output is None:
+            print("Updating submodule", module)
             # Some versions of git don't support --progress.
-            run(["git", "submodule", "update",
-                 "--init", "--recursive", module],
-                cwd=self.rust_root, verbose=self.verbose)
-        run(["git", "reset", "-q", "--hard"],
-            cwd=module_path, verbose=self.verbose)
-        run(["git", "clean", "-qdfx"],
-            cwd=module_path, verbose=self.verbose)
+            attempts.insert(0, update + ["--progress"] + clone_args + [module])
+        if clone_args:
+            # Not every remote serves shallow or partial clones.
+            attempts.append(update + [module])
+        for attempt in attempts[:-1]:
+            try:
+                git(attempt, self.rust_root, exception=True)
+                break
+            except RuntimeError:
+                pass
+        else:
+            git(attempts[-1], self.rust_root)
+        # These work the same for shallow and partial clones, the latter
+        # just fetch missing blobs on demand.
+        git(["git", "reset", "-q", "--hard"], module_path)
+        git(["git", "clean", "-qdfx"], module_path)
 
     def update_submodules(self):
         """Update submodules"""
@@ -760,14 +4109,20 @@ class RustBuild(object):
                 self.get_toml('submodules') == "false":
             return
 
+        slow_submodules = self.get_toml('fast-submodules') == "false"
+        if not slow_submodules and self.submodules_unchanged():
+            if self.verbose:
+                print("Submodules are up to date")
+            return
+
         # check the existence of 'git' command
         try:
-            subprocess.check_output(['git', '--version'])
+            git_version = parse_git_version(
+                subprocess.check_output(['git', '--version']).decode(sys.getdefaultencoding()))
         except (subprocess.CalledProcessError, OSError):
             print("error: `git` is not found, please make sure it's installed and in the path.")
             sys.exit(1)
 
-        slow_submodules = self.get_toml('fast-submodules') == "false"
         start_time = time()
         if slow_submodules:
             print('Unconditionally updating all submodules')
@@ -779,26 +4134,157 @@ class RustBuild(object):
              os.path.join(self.rust_root, ".gitmodules"),
              "--get-regexp", "path"]
         ).decode(default_encoding).splitlines()]
-        filtered_submodules = []
-        submodules_names = []
-        for module in submodules:
-            if module.endswith("llvm-project"):
-                if self.get_toml('llvm-config') and self.get_toml('lld') != 'true':
-                    continue
-            check = self.check_submodule(module, slow_submodules)
-            filtered_submodules.append((module, check))
-            submodules_names.append(module)
-        recorded = subprocess.Popen(["git", "ls-tree", "HEAD"] + submodules_names,
-                                    cwd=self.rust_root, stdout=subprocess.PIPE)
-        recorded = recorded.communicate()[0].decode(default_encoding).strip().splitlines()
+        submodules = [module for module in submodules
+                      if not (module.endswith("llvm-project") and
+                              self.get_toml('llvm-config') and
+                              self.get_toml('lld') != 'true')]
+
+        # A single `git ls-tree` gives the commits recorded for every
+        # submodule, the checked out ones are read straight from the
+        # submodules' git directories.
+        recorded = subprocess.check_output(["git", "ls-tree", "HEAD"] + submodules,
+                                           cwd=self.rust_root)
         recorded_submodules = {}
-        for data in recorded:
+        for data in recorded.decode(default_encoding).strip().splitlines():
             data = data.split()
             recorded_submodules[data[3]] = data[2]
-        for module in filtered_submodules:
-            self.update_submodule(module[0], module[1], recorded_submodules)
+        outdated = []
+        for module in submodules:
+            if not slow_submodules:
+                module_gitdir = git_dir(os.path.join(self.rust_root, module))
+                checked_out = module_gitdir and read_git_head(module_gitdir)
+                if checked_out is None and module_gitdir is not None:
+                    checked_out = subprocess.check_output(
+                        ["git", "rev-parse", "HEAD"],
+                        cwd=os.path.join(self.rust_root, module)
+                    ).decode(default_encoding).strip()
+                if checked_out == recorded_submodules.get(module):
+                    continue
+            outdated.append(module)
+
+        if outdated:
+            self.work_done = True
+            # Both of these write to the superproject's configuration, so
+            # they're run once for all submodules before updating in parallel.
+            run(["git", "submodule", "-q", "sync", "--"] + outdated,
+                cwd=self.rust_root, verbose=self.verbose)
+            run(["git", "submodule", "-q", "init", "--"] + outdated,
+                cwd=self.rust_root, verbose=self.verbose)
+
+        clone_args = {}
+        if outdated:
+            mode_args = self.submodule_clone_mode_args(git_version)
+            for module in outdated:
+                clone_args[module] = mode_args + self.submodule_reference_args(module)
+
+        jobs = self.submodule_jobs()
+        if (jobs <= 1 or len(outdated) <= 1) and not self.concurrent_phases:
+            for module in outdated:
+                self.update_submodule(module, clone_args[module])
+        else:
+            self.update_submodules_parallel(outdated, clone_args, jobs)
+
+        if not slow_submodules:
+            if not os.path.exists(self.build_dir):
+                os.makedirs(self.build_dir)
+            with output(self.submodules_stamp()) as stamp:
+                stamp.write("\n".join(self.submodules_state(submodules)) + "\n")
         print("Submodules updated in %.2f seconds" % (time() - start_time))
 
+    def update_submodules_parallel(self, modules, clone_args, jobs):
+        """Update `modules` using a pool of `jobs` threads
+
+        The output of every submodule is printed as one block, prefixed with
+        its name, in the same order the submodules would be updated serially.
+        """
+        def update(module):
+            lines = []
+            try:
+                self.update_submodule(module, clone_args[module], lines)
+            except RuntimeError as error:
+                return lines, error
+            return lines, None
+
+        finished = {}
+        next_module = 0
+        failure = None
+        for module, result in parallel_imap(update, modules, jobs, self.cancel):
+            finished[module] = result
+            while next_module < len(modules) and modules[next_module] in finished:
+                current = modules[next_module]
+                lines, error = finished.pop(current)
+                print("Updating submodule", current)
+                for line in lines:
+                    print("[%s] %s" % (current, line))
+                if error is not None and failure is None:
+                    failure = error
+                next_module += 1
+            sys.stdout.flush()
+        if failure is not None:
+            sys.exit(str(failure))
+
+    def dist_mirrors(self):
+        """Return the mirrors of the dist server to download stage0 from
+
+        >>> rb = RustBuild()
+        >>> rb.dist_mirrors()
+        []
+        >>> rb.config_toml = '[build]\\ndist-mirrors = ["https://a", "https://b"]'
+        >>> rb.dist_mirrors()
+        ['https://a', 'https://b']
+        """
+        mirrors = os.environ.get('RUST_DIST_MIRRORS')
+        if mirrors is None:
+            mirrors = self.get_toml_value('dist-mirrors', 'build') or []
+        if not isinstance(mirrors, list):
+            mirrors = mirrors.replace(",", " ").split()
+        return mirrors
+
+    def read_config(self, path):
+        """Read config.toml and the settings of x.py itself from it"""
+        try:
+            with open(path) as config:
+                self.config_toml = config.read()
+        except (OSError, IOError):
+            pass
+
+        config_verbose = self.get_toml('verbose', 'build')
+        if config_verbose is not None:
+            self.verbose = max(self.verbose, int(config_verbose))
+
+        self.use_vendored_sources = self.get_toml('vendor', 'build') == 'true'
+
+        self.use_locked_deps = self.get_toml('locked-deps', 'build') == 'true'
+
+        http_downloader.enabled = self.get_toml('downloader', 'build') != 'curl'
+
+    def read_stage0_data(self, data=None):
+        """Read the stage0 toolchain and where to download it from from
+        src/stage0.txt, or from `data` parsed from another such file
+
+        Checksums recorded by `bootstrap.py stage0-prefetch` are trusted as
+        well, the ones pinned in the checkout take precedence.
+        """
+        if data is None:
+            data = stage0_data(self.rust_root)
+        self.checksums = {}
+        manifest = self.prefetch_manifest()
+        if os.path.exists(manifest):
+            self.checksums.update(read_sha256_manifest(manifest))
+        self.checksums.update(stage0_checksums(self.rust_root, data))
+        self.date = data['date']
+        self.rustc_channel = data['rustc']
+        self.cargo_channel = data['cargo']
+
+        if "rustfmt" in data:
+            self.rustfmt_channel = data['rustfmt']
+
+        if 'dev' in data:
+            self.set_dev_environment()
+        else:
+            self.set_normal_environment()
+        dist_mirrors.configure(self._download_url, self.dist_mirrors())
+
     def set_normal_environment(self):
         """Set download URL for normal environment"""
         if 'RUSTUP_DIST_SERVER' in os.environ:
@@ -845,26 +4331,112 @@ class RustBuild(object):
                 shutil.rmtree('.cargo')
 
     def ensure_vendored(self):
-        """Ensure that the vendored sources are available if needed"""
+        """Ensure that the vendored sources are available and intact if needed
+
+        Every vendored crate is checked against its .cargo-checksum.json.
+        Broken crates are restored from the .crate files Cargo keeps in
+        `$CARGO_HOME/registry/cache`, `cargo vendor` is only run when the
+        vendor directory is missing or some crates can't be restored that way.
+
+        The check is skipped while Cargo.lock and the vendor directory keep
+        the mtimes they had when it last passed, as recorded in
+        `build/.vendor-stamp`. Files edited inside a crate aren't noticed
+        until then, removing that file forces the check.
+        """
+        if not self.use_vendored_sources:
+            return
         vendor_dir = os.path.join(self.rust_root, 'vendor')
-        # Note that this does not handle updating the vendored dependencies if
-        # the rust git repository is updated. Normal development usually does
-        # not use vendoring, so hopefully this isn't too much of a problem.
-        if self.use_vendored_sources and not os.path.exists(vendor_dir):
-            run([self.cargo(), "vendor"],
-                verbose=self.verbose, cwd=self.rust_root)
+        if os.path.exists(vendor_dir):
+            stamp = os.path.join(self.build_dir, ".vendor-stamp")
+            state = self.vendor_state()
+            if os.path.exists(stamp):
+                with open(stamp) as cached:
+                    if cached.read() == state:
+                        return
+            with tracer.span("verify vendor") as span:
+                broken = verify_vendored(
+                    vendor_dir, os.path.join(self.build_dir, ".vendor-checksums"),
+                    cpu_count())
+                span["broken"] = broken
+            if broken:
+                self.work_done = True
+                print("vendored crates don't match their checksums:", ", ".join(broken))
+                broken = [crate for crate in broken if not self.restore_crate(crate)]
+            if not broken:
+                try:
+                    with output(stamp) as cached:
+                        cached.write(state)
+                except (OSError, IOError):
+                    pass
+                return
+            print("re-vendoring because these can't be restored:", ", ".join(broken))
+        self.work_done = True
+        run([self.cargo(), "vendor"],
+            verbose=self.verbose, cwd=self.rust_root)
 
+    def vendor_state(self):
+        """Return the mtimes of Cargo.lock and the vendor directory, which
+        change whenever the set of vendored crates does"""
+        state = []
+        for path in (os.path.join(self.rust_root, "Cargo.lock"),
+                     os.path.join(self.rust_root, "vendor")):
+            try:
+                state.append(repr(os.stat(path).st_mtime))
+            except OSError:
+                state.append("-")
+        return " ".join(state)
 
-def bootstrap(help_triggered):
-    """Configure, fetch, build and run the initial bootstrap"""
+    def restore_crate(self, crate):
+        """Restore a broken vendored crate from Cargo's download cache,
+        returns whether that worked"""
+        vendor_dir = os.path.join(self.rust_root, 'vendor')
+        try:
+            with open(os.path.join(vendor_dir, crate, ".cargo-checksum.json")) as checksums:
+                package = json.load(checksums).get("package")
+        except (IOError, OSError, ValueError, AttributeError):
+            return False
+        locked = self.locked_packages().get(package)
+        if locked is None:
+            return False
+        crate_name = "{}-{}.crate".format(*locked)
+        registry = os.path.join(os.environ.get('CARGO_HOME') or
+                                os.path.expanduser("~/.cargo"), "registry", "cache")
+        indexes = os.listdir(registry) if os.path.isdir(registry) else []
+        for index in sorted(indexes):
+            crate_file = os.path.join(registry, index, crate_name)
+            if os.path.isfile(crate_file) and sha256_file(crate_file) == package:
+                break
+        else:
+            return False
+        print("restoring", crate, "from", crate_file)
+        restore_crate(os.path.join(vendor_dir, crate), crate_file)
+        return verify_crate(vendor_dir, crate, {})[0]
 
-    # If the user is asking for help, let them know that the whole download-and-build
-    # process has to happen before anything is printed out.
-    if help_triggered:
-        print("info: Downloading and building bootstrap before processing --help")
-        print("      command. See src/bootstrap/README.md for help with common")
-        print("      commands.")
+    def locked_packages(self):
+        """Return the `(name, version)` of the packages in Cargo.lock by their
+        checksum"""
+        if self._locked_packages is None:
+            self._locked_packages = {}
+            try:
+                with open(os.path.join(self.rust_root, "Cargo.lock")) as lock:
+                    entries = TomlParser(lock.read()).parse()
+            except (IOError, OSError, ValueError):
+                entries = []
+            package = {}
+            for table, key, value in entries:
+                if table != "package":
+                    continue
+                if key == "name":
+                    package = {}
+                package[key] = value
+                if key == "checksum":
+                    self._locked_packages[value] = (package.get("name"),
+                                                    package.get("version"))
+        return self._locked_packages
 
+
+def bootstrap(help_triggered, start_time=None):
+    """Configure, fetch, build and run the initial bootstrap"""
     parser = argparse.ArgumentParser(description='Build rust')
     parser.add_argument('--config')
     parser.add_argument('--build')
@@ -881,43 +4453,53 @@ def bootstrap(help_triggered):
     build.verbose = args.verbose
     build.clean = args.clean
 
-    try:
-        with open(args.config or 'config.toml') as config:
-            build.config_toml = config.read()
-    except (OSError, IOError):
-        pass
-
-    config_verbose = build.get_toml('verbose', 'build')
-    if config_verbose is not None:
-        build.verbose = max(build.verbose, int(config_verbose))
+    config_path = args.config or 'config.toml'
+    with tracer.span("config"):
+        build.read_config(config_path)
+        build.check_vendored_status()
 
-    build.use_vendored_sources = build.get_toml('vendor', 'build') == 'true'
+    with tracer.span("stage0_data"):
+        build.read_stage0_data()
 
-    build.use_locked_deps = build.get_toml('locked-deps', 'build') == 'true'
+    # rustfmt is only downloaded up front for `x.py fmt`, bootstrap asks for
+    # it through `bootstrap.py stage0-rustfmt` when it needs it otherwise.
+    build.fetch_rustfmt = x_py_subcommand(sys.argv[1:]) == 'fmt'
 
-    build.check_vendored_status()
-
-    data = stage0_data(build.rust_root)
-    build.date = data['date']
-    build.rustc_channel = data['rustc']
-    build.cargo_channel = data['cargo']
-
-    if "rustfmt" in data:
-        build.rustfmt_channel = data['rustfmt']
-
-    if 'dev' in data:
-        build.set_dev_environment()
-    else:
-        build.set_normal_environment()
+    build.build = args.build or build.build_triple()
+    help_args = sys.argv[1:]
+    if help_triggered:
+        # Help printed by bootstrap for the same sources is shown right away
+        with tracer.span("help snapshot") as span:
+            snapshot = build.help_snapshot(help_args)
+            span["cache"] = "hit" if snapshot is not None else "miss"
+        if snapshot is not None:
+            status, text = snapshot
+            getattr(sys.stdout, 'buffer', sys.stdout).write(text.encode('utf-8'))
+            if status != 0:
+                sys.exit(1)
+            return
 
-    build.update_submodules()
+        # If the user is asking for help, let them know that the whole
+        # download-and-build process has to happen before anything is
+        # printed out.
+        print("info: Downloading and building bootstrap before processing --help")
+        print("      command. See src/bootstrap/README.md for help with common")
+        print("      commands.")
 
-    # Fetch/build the bootstrap
-    build.build = args.build or build.build_triple()
-    build.download_stage0()
-    sys.stdout.flush()
-    build.ensure_vendored()
-    build.build_bootstrap()
+    # Fetch/build the bootstrap. Updating submodules and downloading stage0
+    # don't depend on each other and run at the same time.
+    build.concurrent_phases = True
+    http_downloader.cancel = build.cancel
+    try:
+        run_phases([
+            ("submodules", build.update_submodules, []),
+            ("stage0", build.download_stage0, []),
+            ("vendor", build.ensure_vendored, ["submodules", "stage0"]),
+            ("bootstrap", build.build_bootstrap, ["vendor"]),
+        ], build.cancel)
+    finally:
+        build.concurrent_phases = False
+        http_downloader.cancel = None
     sys.stdout.flush()
 
     # Run the bootstrap
@@ -932,9 +4514,75 @@ def bootstrap(help_triggered):
     env["RUSTC_BOOTSTRAP"] = '1'
     env["CARGO"] = build.cargo()
     env["RUSTC"] = build.rustc()
-    if build.rustfmt():
+    if build.rustfmt_ready():
         env["RUSTFMT"] = build.rustfmt()
-    run(args, env=env, verbose=build.verbose)
+    if os.path.exists(config_path):
+        env["BOOTSTRAP_CONFIG"] = os.path.abspath(config_path)
+    if help_triggered:
+        # Keep what bootstrap prints for the next time
+        status, text = run_help(args, build.verbose, env=env)
+        build.save_help_snapshot(help_args, status, text)
+        if status != 0:
+            sys.exit(1)
+        return
+    if os.name == 'posix' and not build.work_done:
+        exec_bootstrap(args, env, start_time, build.verbose)
+    with tracer.span("handoff", category="build"):
+        run(args, env=env, verbose=build.verbose)
+
+
+def exec_bootstrap(args, env, start_time=None, verbose=False):
+    """Replace this process with bootstrap
+
+    When nothing had to be done, rather than staying around until the build
+    finishes this process becomes bootstrap. Given the start time, bootstrap
+    prints the summary itself, along with the command which failed, and
+    exits with 1 on any failure, like x.py does.
+    """
+    if start_time is not None:
+        env["BOOTSTRAP_START_TIME"] = repr(start_time)
+    if verbose:
+        print("running: " + ' '.join(args))
+    tracer.mark("handoff", category="build", execve=True)
+    tracer.write()
+    sys.stdout.flush()
+    sys.stderr.flush()
+    os.execve(args[0], args, env)
+
+
+# Options of flags.rs that take a value, as the next argument unless it's
+# attached with `=` (or directly, for short ones)
+X_PY_VALUE_OPTIONS = (
+    "--config", "--build", "--host", "--target", "--exclude", "--on-fail",
+    "--stage", "--keep-stage", "--src", "-j", "--jobs", "--warnings",
+    "--error-format", "--test-args", "--rustc-args", "--compare-mode",
+    "--pass")
+
+
+def x_py_subcommand(args):
+    """Return the subcommand of the given x.py arguments, the first one that
+    is neither an option nor the value of one
+
+    >>> x_py_subcommand(["-v", "fmt", "--check"])
+    'fmt'
+    >>> x_py_subcommand(["--config", "fmt", "build", "src/tools/fmt"])
+    'build'
+    >>> x_py_subcommand(["-j4", "--stage=1", "test"])
+    'test'
+    >>> x_py_subcommand(["--help"]) is None
+    True
+    """
+    subcommands = ["build", "check", "clippy", "fix", "fmt", "test", "bench",
+                   "doc", "clean", "dist", "install"]
+    args = iter(args)
+    for arg in args:
+        if arg == "--":
+            break
+        if arg in X_PY_VALUE_OPTIONS:
+            next(args, None)
+        elif not arg.startswith("-"):
+            return arg if arg in subcommands else None
+    return None
 
 
 def main():
@@ -948,7 +4596,11 @@ def main():
     help_triggered = (
         '-h' in sys.argv) or ('--help' in sys.argv) or (len(sys.argv) == 1)
     try:
-        bootstrap(help_triggered)
+        try:
+            with tracer.span("x.py", args=sys.argv[1:]):
+                bootstrap(help_triggered, start_time)
+        finally:
+            tracer.write()
         if not help_triggered:
             print("Build completed successfully in {}".format(
                 format_build_time(time() - start_time)))
@@ -964,5 +4616,277 @@ def main():
         sys.exit(exit_code)
 
 
+def stage0_cache_main(argv):
+    """Inspect, verify or prune the machine-wide stage0 cache without
+    running x.py"""
+    parser = argparse.ArgumentParser(
+        prog='bootstrap.py stage0-cache',
+        description='Inspect, verify or prune the machine-wide stage0 cache')
+    parser.add_argument('command', choices=['list', 'verify', 'prune'])
+    parser.add_argument('--config', help='config.toml to read the cache settings from')
+    parser.add_argument('--dir', help='cache directory, overrides the configuration')
+    parser.add_argument('--max-size', help='size to prune the cache to, e.g. 20G')
+    args = parser.parse_args(argv)
+
+    build = RustBuild()
+    try:
+        with open(args.config or 'config.toml') as config:
+            build.config_toml = config.read()
+    except (OSError, IOError):
+        pass
+    cache = build.stage0_cache()
+    if args.dir:
+        cache = Stage0Cache(args.dir, cache and cache.max_size,
+                            store=cache and cache.store)
+    if cache is None:
+        parser.error("no cache configured, set RUST_STAGE0_CACHE, "
+                     "build.stage0-cache or pass --dir")
+
+    if args.command == 'list':
+        tarballs = os.path.join(cache.root, "sha256")
+        for path, names, size, last_used in cache.evictable():
+            if os.path.dirname(path) == tarballs:
+                name = "{}  {}".format(os.path.basename(path)[:16], ", ".join(names))
+            else:
+                name = cache.describe(path)
+            print("{}  {:>12}  {}".format(
+                datetime.datetime.fromtimestamp(last_used).strftime('%Y-%m-%d %H:%M'),
+                size, name))
+        print("total: {} bytes in {}".format(cache.size(), cache.root))
+    elif args.command == 'verify':
+        evicted = cache.verify()
+        print("evicted {} corrupt entries".format(len(evicted)))
+        return 1 if evicted else 0
+    else:
+        max_size = parse_size(args.max_size) if args.max_size else cache.max_size
+        if max_size is None:
+            parser.error("no size to prune to, set RUST_STAGE0_CACHE_SIZE, "
+                         "build.stage0-cache-size or pass --max-size")
+        evicted = cache.prune(max_size, verbose=True)
+        print("evicted {} entries, {} bytes left".format(len(evicted), cache.size()))
+    return 0
+
+
+def stage0_pin_main(argv):
+    """Pin the SHA-256 of the stage0 tarballs in src/stage0.sha256
+
+    With the checksums pinned a warm cache is used without any request and
+    cold downloads skip fetching `.sha256` files.
+    """
+    parser = argparse.ArgumentParser(
+        prog='bootstrap.py stage0-pin',
+        description='Write the SHA-256 of the stage0 tarballs to src/stage0.sha256')
+    parser.add_argument('--target', action='append',
+                        help='triple to pin the tarballs of, defaults to the '
+                             'host, may be given several times')
+    parser.add_argument('--src', help='root of the Rust checkout')
+    parser.add_argument('-j', '--jobs', type=int, default=8,
+                        help='checksums to download at once')
+    parser.add_argument('-v', '--verbose', action='store_true')
+    args = parser.parse_args(argv)
+
+    rust_root = args.src or os.path.abspath(os.path.join(__file__, '../../..'))
+    data = stage0_data(rust_root)
+    build = RustBuild()
+    if 'dev' in data:
+        build.set_dev_environment()
+    else:
+        build.set_normal_environment()
+    tarballs = [tarball
+                for target in args.target or [default_build_triple()]
+                for tarball_suffix in ('.tar.xz', '.tar.gz')
+                for tarball in stage0_tarballs(data, target, tarball_suffix)]
+
+    # Checksums of other triples stay pinned as long as they are current
+    manifest = os.path.join(rust_root, "src", "stage0.sha256")
+    dates = set(date for date, _ in tarballs)
+    checksums = {}
+    if os.path.exists(manifest):
+        checksums = dict((name, sha256) for name, sha256
+                         in read_sha256_manifest(manifest).items()
+                         if name.split("/", 1)[0] in dates)
+
+    def fetch(tarball):
+        url = "{}/dist/{}/{}".format(build._download_url, *tarball)
+        return fetch_sha256(url, args.verbose)
+
+    for tarball, sha256 in parallel_imap(fetch, tarballs, args.jobs):
+        checksums["/".join(tarball)] = sha256
+    write_sha256_manifest(manifest, checksums)
+    print("pinned {} checksums in {}".format(len(checksums), manifest))
+    return 0
+
+
+def stage0_prefetch_main(argv):
+    """Download and verify the stage0 tarballs of several triples up front
+
+    The tarballs go to the cache x.py downloads them to, and their SHA-256
+    are recorded in a manifest next to them which later x.py runs trust, so
+    that they don't make any request for these tarballs.
+    """
+    parser = argparse.ArgumentParser(
+        prog='bootstrap.py stage0-prefetch',
+        description='Download the stage0 tarballs of several triples into the cache')
+    parser.add_argument('--target', action='append',
+                        help='triple to download the tarballs of, defaults to '
+                             'the host, may be given several times')
+    parser.add_argument('--stage0', action='append', metavar='FILE',
+                        help='stage0.txt to download the toolchain of, defaults '
+                             'to the one of the checkout, may be given several times')
+    parser.add_argument('--date', action='append',
+                        help='download the channels of the checkout from this '
+                             'date instead, may be given several times')
+    parser.add_argument('--src', help='root of the Rust checkout')
+    parser.add_argument('--config', help='config.toml to read the cache settings from')
+    parser.add_argument('-j', '--jobs', type=int,
+                        help='tarballs to download at once, defaults to '
+                             'build.download-jobs')
+    parser.add_argument('-v', '--verbose', action='store_true')
+    args = parser.parse_args(argv)
+
+    rust_root = args.src or os.path.abspath(os.path.join(__file__, '../../..'))
+    sources = [read_stage0_file(path) for path in args.stage0 or []]
+    for date in args.date or []:
+        data = stage0_data(rust_root)
+        data['date'] = date
+        sources.append(data)
+    if not sources:
+        sources = [stage0_data(rust_root)]
+
+    tarball_suffix = '.tar.xz' if support_xz() else '.tar.gz'
+    tarballs = {}
+    for data in sources:
+        build = RustBuild()
+        build.rust_root = rust_root
+        build.verbose = args.verbose
+        build.read_config(args.config or 'config.toml')
+        build.read_stage0_data(data)
+        targets = args.target or [default_build_triple(build.build_dir)]
+        for target in targets:
+            for date, filename in stage0_tarballs(data, target, tarball_suffix):
+                key = (build._download_url, date, filename)
+                tarballs.setdefault(key, build)
+
+    def fetch(key):
+        _, date, filename = key
+        build = tarballs[key]
+        # The tarball is verified against its pinned or published checksum
+        # even if it's cached already, the manifest only lists good ones.
+        expected = build.pinned_sha256(date, filename)
+        if expected is None:
+            expected = fetch_sha256("{}/dist/{}/{}".format(*key), build.verbose)
+            build.checksums["{}/{}".format(date, filename)] = expected
+        _, lock = build._download_stage0_helper(filename, date, False)
+        if lock is not None:
+            lock.release()
+        return expected
+
+    checksums = {}
+    for key, sha256 in parallel_imap(fetch, sorted(tarballs),
+                                     args.jobs or build.download_jobs()):
+        checksums["{}/{}".format(*key[1:])] = sha256
+        if args.verbose:
+            print("verified", "/".join(key[1:]))
+
+    manifest = build.prefetch_manifest()
+    with FileLock(manifest + ".lock", timeout=build.lock_timeout()):
+        if os.path.exists(manifest):
+            recorded = read_sha256_manifest(manifest)
+            recorded.update(checksums)
+            checksums = recorded
+        write_sha256_manifest(manifest, checksums)
+    print("prefetched {} tarballs, {} checksums in {}".format(
+        len(tarballs), len(checksums), manifest))
+    return 0
+
+
+def stage0_delta_main(argv):
+    """Write the deltas x.py looks for when `build.stage0-deltas` is set
+
+    Given two tarballs the delta turning the first one into the second one
+    is written next to it, given two directories of a dist server, like
+    `dist/2019-11-07` and `dist/2019-12-18`, the deltas between all the
+    tarballs of the same components are.
+    """
+    parser = argparse.ArgumentParser(
+        prog='bootstrap.py stage0-delta',
+        description='Write deltas between the stage0 tarballs of two dates')
+    parser.add_argument('base', help='old tarball, or directory of the old date')
+    parser.add_argument('target', help='new tarball, or directory of the new date')
+    args = parser.parse_args(argv)
+
+    if os.path.isdir(args.base) and os.path.isdir(args.target):
+        bases = dict((stage0_component(name), name) for name in os.listdir(args.base))
+        pairs = [(os.path.join(args.base, bases[stage0_component(name)]),
+                  os.path.join(args.target, name))
+                 for name in sorted(os.listdir(args.target))
+                 if stage0_component(name) is not None and
+                 stage0_component(name) in bases]
+    elif os.path.isfile(args.base) and os.path.isfile(args.target):
+        pairs = [(args.base, args.target)]
+    else:
+        parser.error("expected two tarballs or two directories")
+
+    for base, target in pairs:
+        delta = "{}.delta-{}".format(target, sha256_file(base))
+        try:
+            size = write_delta(base, target, delta)
+        except (ValueError, EOFError, IOError, OSError) as error:
+            print("skipping {}: {}".format(target, error))
+            continue
+        print("{}: {} bytes, {:.0%} of the tarball".format(
+            delta, size, size / max(1, os.path.getsize(target))))
+    return 0
+
+
+def stage0_rustfmt_main(argv):
+    """Make sure the stage0 rustfmt is downloaded and print its path
+
+    x.py only downloads rustfmt for `x.py fmt`, bootstrap runs this when it
+    needs it otherwise. It's configured like bootstrap, through the `BUILD`,
+    `SRC`, `BUILD_DIR` and `BOOTSTRAP_CONFIG` environment variables x.py sets.
+    Nothing is printed on channels without rustfmt.
+    """
+    parser = argparse.ArgumentParser(
+        prog='bootstrap.py stage0-rustfmt',
+        description='Download the stage0 rustfmt and print its path')
+    parser.parse_args(argv)
+
+    build = RustBuild()
+    build.rust_root = os.environ.get('SRC') or \
+        os.path.abspath(os.path.join(__file__, '../../..'))
+    build.build_dir = os.environ.get('BUILD_DIR') or build.build_dir
+    build.read_config(os.environ.get('BOOTSTRAP_CONFIG') or 'config.toml')
+    build.read_stage0_data()
+    build.build = os.environ.get('BUILD') or build.build_triple()
+    if build.rustfmt() is None:
+        return 0
+    # Progress goes to stderr, including that of the programs run for the
+    # download, stdout is only for the path
+    sys.stdout.flush()
+    stdout = sys.stdout, os.dup(1)
+    os.dup2(2, 1)
+    sys.stdout = sys.stderr
+    try:
+        build.download_stage0()
+    finally:
+        sys.stderr.flush()
+        os.dup2(stdout[1], 1)
+        os.close(stdout[1])
+        sys.stdout = stdout[0]
+    print(build.rustfmt())
+    return 0
+
+
 if __name__ == '__main__':
+    if sys.argv[1:2] == ['stage0-cache']:
+        sys.exit(stage0_cache_main(sys.argv[2:]))
+    if sys.argv[1:2] == ['stage0-pin']:
+        sys.exit(stage0_pin_main(sys.argv[2:]))
+    if sys.argv[1:2] == ['stage0-delta']:
+        sys.exit(stage0_delta_main(sys.argv[2:]))
+    if sys.argv[1:2] == ['stage0-prefetch']:
+        sys.exit(stage0_prefetch_main(sys.argv[2:]))
+    if sys.argv[1:2] == ['stage0-rustfmt']:
+        sys.exit(stage0_rustfmt_main(sys.argv[2:]))
     main()
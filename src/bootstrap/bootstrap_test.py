@@ -1,18 +1,111 @@
 """Bootstrap tests"""
 
 from __future__ import absolute_import, division, print_function
+import io
+import json
 import os
 import doctest
+import socket
+import struct
+import subprocess
+import tarfile
 import unittest
 import tempfile
 import hashlib
 import sys
+import threading
+import time
 
-from shutil import rmtree
+from shutil import copy, rmtree
+
+try:
+    from http.server import HTTPServer, SimpleHTTPRequestHandler
+    from socketserver import ThreadingMixIn
+except ImportError:
+    from BaseHTTPServer import HTTPServer
+    from SimpleHTTPServer import SimpleHTTPRequestHandler
+    from SocketServer import ThreadingMixIn
 
 import bootstrap
 
 
+class LocalServer(ThreadingMixIn, HTTPServer):
+    """HTTP server serving the files of a directory, used as a stand-in for
+    the dist server"""
+    daemon_threads = True
+
+    def __init__(self, root, ranges=False, delay=0, rate=None):
+        server = self
+        self.ranges = []
+
+        class Handler(SimpleHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_HEAD(self):
+                time.sleep(delay)
+                return SimpleHTTPRequestHandler.do_HEAD(self)
+
+            def do_GET(self):
+                time.sleep(delay)
+                requested = self.headers.get("Range")
+                server.ranges.append(requested)
+                path = self.translate_path(self.path)
+                if rate and os.path.isfile(path):
+                    return self.send_slowly(path)
+                if not ranges or not requested or not os.path.isfile(path):
+                    return SimpleHTTPRequestHandler.do_GET(self)
+                with open(path, "rb") as served:
+                    content = served.read()
+                start = int(requested.split("=")[1].rstrip("-"))
+                if start >= len(content):
+                    self.send_response(416)
+                    self.send_header("Content-Length", "0")
+                    self.end_headers()
+                    return
+                self.send_response(206)
+                self.send_header("Content-Length", str(len(content) - start))
+                self.send_header("Content-Range", "bytes {}-{}/{}".format(
+                    start, len(content) - 1, len(content)))
+                self.end_headers()
+                self.wfile.write(content[start:])
+
+            def send_slowly(self, path):
+                """Send the file at `rate` bytes per second"""
+                with open(path, "rb") as served:
+                    content = served.read()
+                self.send_response(200)
+                self.send_header("Content-Length", str(len(content)))
+                self.end_headers()
+                step = max(1, rate // 10)
+                for start in range(0, len(content), step):
+                    self.wfile.write(content[start:start + step])
+                    time.sleep(0.1)
+
+            def translate_path(self, path):
+                return os.path.join(root, path.lstrip("/"))
+
+            def log_message(self, *args):
+                pass
+
+        HTTPServer.__init__(self, ("127.0.0.1", 0), Handler)
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def url(self, path):
+        """Return the URL of the given file"""
+        return "http://127.0.0.1:{}/{}".format(self.server_address[1], path)
+
+    def stop(self):
+        """Shut the server down"""
+        self.shutdown()
+        self.server_close()
+
+    def handle_error(self, request, client_address):
+        # Clients hanging up on purpose aren't worth a traceback
+        pass
+
+
 class Stage0DataTestCase(unittest.TestCase):
     """Test Case for stage0_data"""
     def setUp(self):
@@ -31,6 +124,204 @@ class Stage0DataTestCase(unittest.TestCase):
         data = bootstrap.stage0_data(self.rust_root)
         self.assertDictEqual(data, expected)
 
+    def test_stage0_checksums(self):
+        """Checksums pinned in stage0.txt take precedence over the manifest"""
+        with open(os.path.join(self.rust_root, "src", "stage0.txt"), "a") as stage0:
+            stage0.write("\n2017-06-15/cargo-beta-x.tar.xz: aaaa\n")
+        bootstrap.write_sha256_manifest(
+            os.path.join(self.rust_root, "src", "stage0.sha256"),
+            {"2017-06-15/cargo-beta-x.tar.xz": "bbbb",
+             "2017-06-15/rustc-beta-x.tar.xz": "cccc"})
+        data = bootstrap.stage0_data(self.rust_root)
+        self.assertDictEqual(bootstrap.stage0_checksums(self.rust_root, data), {
+            "2017-06-15/cargo-beta-x.tar.xz": "aaaa",
+            "2017-06-15/rustc-beta-x.tar.xz": "cccc",
+        })
+
+    def test_pinned_tarball_offline(self):
+        """A cached tarball with a pinned checksum is used without any request
+        and replaced when it's corrupt"""
+        build = bootstrap.RustBuild()
+        build.build_dir = os.path.join(self.rust_root, "build")
+        build._download_url = "http://127.0.0.1:9"
+        cache = os.path.join(build.build_dir, "cache", "2017-06-15")
+        os.makedirs(cache)
+        tarball = os.path.join(cache, "cargo-beta-x.tar.xz")
+        with open(tarball, "wb") as cached:
+            cached.write(b"cargo")
+        build.checksums = {"2017-06-15/cargo-beta-x.tar.xz": hashlib.sha256(b"cargo").hexdigest()}
+        self.assertEqual(build._download_stage0_helper("cargo-beta-x.tar.xz", "2017-06-15"),
+                         (tarball, None))
+
+        server = LocalServer(self.rust_root)
+        try:
+            build._download_url = server.url("").rstrip("/")
+            dist = os.path.join(self.rust_root, "dist", "2017-06-15")
+            os.makedirs(dist)
+            with open(os.path.join(dist, "cargo-beta-x.tar.xz"), "wb") as published:
+                published.write(b"cargo")
+            with open(tarball, "wb") as cached:
+                cached.write(b"corrupt")
+            build._download_stage0_helper("cargo-beta-x.tar.xz", "2017-06-15", False)
+        finally:
+            bootstrap.http_downloader.close()
+            server.stop()
+        # Only the tarball itself is requested, not its `.sha256`
+        self.assertEqual(len(server.ranges), 1)
+        with open(tarball, "rb") as cached:
+            self.assertEqual(cached.read(), b"cargo")
+
+    def test_prefetch(self):
+        """Prefetched tarballs of several triples are used without any request"""
+        with open(os.path.join(self.rust_root, "src", "stage0.txt"), "w") as stage0:
+            stage0.write("date: 2017-06-15\nrustc: beta\ncargo: beta\n")
+        config = os.path.join(self.rust_root, "config.toml")
+        with open(config, "w") as config_file:
+            config_file.write('[build]\nstage0-cache = "{}"\n'.format(
+                os.path.join(self.rust_root, "cache")))
+        suffix = ".tar.xz" if bootstrap.support_xz() else ".tar.gz"
+        dist = os.path.join(self.rust_root, "dist", "2017-06-15")
+        os.makedirs(dist)
+        for name in ["rust-std", "rustc", "cargo"]:
+            for triple in ["a-b-c", "x-y-z"]:
+                filename = "{}-beta-{}{}".format(name, triple, suffix)
+                with open(os.path.join(dist, filename), "wb") as published:
+                    published.write(filename.encode())
+                with open(os.path.join(dist, filename + ".sha256"), "w") as published:
+                    published.write(hashlib.sha256(filename.encode()).hexdigest())
+
+        server = LocalServer(self.rust_root)
+        environ = dict(os.environ)
+        os.environ["RUSTUP_DIST_SERVER"] = server.url("").rstrip("/")
+        try:
+            bootstrap.stage0_prefetch_main([
+                "--src", self.rust_root, "--config", config,
+                "--target", "a-b-c", "--target", "x-y-z"])
+        finally:
+            bootstrap.http_downloader.close()
+            server.stop()
+            os.environ.clear()
+            os.environ.update(environ)
+        # A checksum and a tarball for each of the 6 tarballs
+        self.assertEqual(len(server.ranges), 12)
+
+        build = bootstrap.RustBuild()
+        build.rust_root = self.rust_root
+        build.read_config(config)
+        build.read_stage0_data()
+        self.assertEqual(len(build.checksums), 6)
+        build._download_url = "http://127.0.0.1:9"
+        for triple in ["a-b-c", "x-y-z"]:
+            filename = "cargo-beta-{}{}".format(triple, suffix)
+            path, lock = build._download_stage0_helper(filename, "2017-06-15", False)
+            lock.release()
+            with open(path, "rb") as cached:
+                self.assertEqual(cached.read(), filename.encode())
+
+
+class BuildTripleTestCase(unittest.TestCase):
+    """Test Case for default_build_triple"""
+    def setUp(self):
+        self.build_dir = tempfile.mkdtemp()
+        self.stamp = os.path.join(self.build_dir, ".host-triple")
+        self.detected = bootstrap._build_triple
+        bootstrap._build_triple = None
+
+    def tearDown(self):
+        bootstrap._build_triple = self.detected
+        rmtree(self.build_dir)
+
+    def test_persisted(self):
+        """The triple is kept in the build directory for the same host"""
+        triple = bootstrap.default_build_triple(self.build_dir)
+        with open(self.stamp) as stamp:
+            self.assertEqual(stamp.read().splitlines()[1], triple)
+        with open(self.stamp, "w") as stamp:
+            stamp.write("{}\nfake-triple\n".format(bootstrap.host_triple_key()))
+        bootstrap._build_triple = None
+        self.assertEqual(bootstrap.default_build_triple(self.build_dir), "fake-triple")
+        # Memoised for the rest of the process
+        self.assertEqual(bootstrap.default_build_triple(), "fake-triple")
+
+    def test_other_host(self):
+        """A triple persisted by another host is detected again"""
+        with open(self.stamp, "w") as stamp:
+            stamp.write("Plan9 mips\nfake-triple\n")
+        self.assertNotEqual(bootstrap.default_build_triple(self.build_dir), "fake-triple")
+
+    def test_older_format(self):
+        """A triple persisted by an older bootstrap is detected again"""
+        with open(self.stamp, "w") as stamp:
+            stamp.write("{} {}\nfake-triple\n".format(*bootstrap.host_uname()))
+        self.assertNotEqual(bootstrap.default_build_triple(self.build_dir), "fake-triple")
+
+    def test_environment(self):
+        """The key follows MSYSTEM but not ANDROID_ROOT"""
+        saved = dict(os.environ)
+        try:
+            key = bootstrap.host_triple_key()
+            os.environ["ANDROID_ROOT"] = "/system"
+            self.assertEqual(bootstrap.host_triple_key(), key)
+            os.environ["MSYSTEM"] = "MINGW64"
+            self.assertNotEqual(bootstrap.host_triple_key(), key)
+        finally:
+            os.environ.clear()
+            os.environ.update(saved)
+
+    @unittest.skipUnless(sys.platform.startswith("linux"), "needs a Linux host")
+    def test_android_root(self):
+        """ANDROID_ROOT alone doesn't make a glibc host Android"""
+        saved = os.environ.get("ANDROID_ROOT")
+        os.environ["ANDROID_ROOT"] = "/system"
+        try:
+            self.assertFalse(bootstrap.host_is_android())
+            triple = bootstrap.detect_build_triple(("Linux", "x86_64"))
+        finally:
+            if saved is None:
+                del os.environ["ANDROID_ROOT"]
+            else:
+                os.environ["ANDROID_ROOT"] = saved
+        self.assertEqual(triple, "x86_64-unknown-linux-gnu")
+
+
+class ConfigTomlTestCase(unittest.TestCase):
+    """Test Case for reading config.toml"""
+    def setUp(self):
+        self.build = bootstrap.RustBuild()
+
+    def test_typed_values(self):
+        """Values keep their TOML types across multi-line arrays and strings"""
+        self.build.config_toml = (
+            '[build]\n'
+            'host = [\n  "a",  # first\n  "b",\n]\n'
+            'verbose = 2\n'
+            'description = """\nmulti\\\n  line"""\n'
+            '[rust]\n'
+            'debug = true\n')
+        self.assertEqual(self.build.get_toml_value('host', 'build'), ['a', 'b'])
+        self.assertEqual(self.build.get_toml_value('verbose', 'build'), 2)
+        self.assertEqual(self.build.get_toml_value('description', 'build'), 'multiline')
+        self.assertIs(self.build.get_toml_value('debug', 'rust'), True)
+        self.assertEqual(self.build.get_toml('debug', 'rust'), 'true')
+
+    def test_tables(self):
+        """Dotted keys and inline tables are filed under their table"""
+        self.build.config_toml = (
+            'build.vendor = true\n'
+            'target.x86_64-unknown-linux-gnu = { cc = "gcc", linker = "ld" }\n'
+            '[target."aarch64-unknown-linux-gnu"]\n'
+            'cc = "aarch64-gcc"\n')
+        self.assertEqual(self.build.get_toml('vendor', 'build'), 'true')
+        self.assertEqual(self.build.get_toml('linker', 'target.x86_64-unknown-linux-gnu'), 'ld')
+        self.assertEqual(self.build.get_toml('cc', 'target.aarch64-unknown-linux-gnu'),
+                         'aarch64-gcc')
+        self.assertEqual(self.build.get_toml('cc'), 'gcc')
+
+    def test_invalid(self):
+        """Invalid TOML is still read line by line"""
+        self.build.config_toml = '[build]\nbroken = [\nverbose = 1'
+        self.assertEqual(self.build.get_toml('verbose', 'build'), '1')
+
 
 class VerifyTestCase(unittest.TestCase):
     """Test Case for verify"""
@@ -59,6 +350,1373 @@ class VerifyTestCase(unittest.TestCase):
         """Should verify that the file is invalid"""
         self.assertFalse(bootstrap.verify(self.bad_src, self.sums, False))
 
+    def test_known_digest(self):
+        """Use the digest computed while downloading instead of the file"""
+        found = hashlib.sha256(b"Hello!").hexdigest()
+        self.assertFalse(bootstrap.verify(self.src, self.sums, False, found))
+
+    def test_copy_hashed(self):
+        """Hash a stream larger than one chunk while copying it"""
+        content = os.urandom(bootstrap.CHUNK_SIZE * 2 + 3)
+        path = os.path.join(self.container, "big")
+        sha256 = hashlib.sha256()
+        with open(path, "wb") as destination:
+            bootstrap.copy_hashed(io.BytesIO(content), destination, sha256)
+        expected = hashlib.sha256(content).hexdigest()
+        self.assertEqual(sha256.hexdigest(), expected)
+        self.assertEqual(bootstrap.sha256_file(path), expected)
+
+
+class Stage0ComponentsTestCase(unittest.TestCase):
+    """Test Case for downloading and unpacking stage0 components concurrently"""
+    def setUp(self):
+        self.container = tempfile.mkdtemp()
+        self.build = bootstrap.RustBuild()
+        self.build.build_dir = os.path.join(self.container, "build")
+        self.build.build = "x"
+        self.build.date = "2017-06-15"
+        os.makedirs(self.build.bin_root())
+        self.tarballs = {}
+        for name, component, path in [("rust-std", "rust-std-x", "lib/libstd.so"),
+                                      ("rustc", "rustc", "bin/rustc"),
+                                      ("cargo", "cargo", "bin/cargo")]:
+            filename = "{}-beta-x.tar.gz".format(name)
+            self.tarballs[filename] = os.path.join(self.container, filename)
+            prefix = "{}-beta-x/{}".format(name, component)
+            with tarfile.open(self.tarballs[filename], "w:gz") as tar:
+                for directory in (prefix, prefix + "/" + os.path.dirname(path)):
+                    info = tarfile.TarInfo(directory)
+                    info.type = tarfile.DIRTYPE
+                    info.mode = 0o755
+                    tar.addfile(info)
+                info = tarfile.TarInfo(prefix + "/" + path)
+                info.size = len(name)
+                tar.addfile(info, io.BytesIO(name.encode()))
+        self.rustc_stamp = os.path.join(self.container, ".rustc-stamp")
+        self.cargo_stamp = os.path.join(self.container, ".cargo-stamp")
+        self.groups = [
+            ([("rust-std-beta-x.tar.gz", "rust-std-x", ".tar.gz", self.build.date),
+              ("rustc-beta-x.tar.gz", "rustc", ".tar.gz", self.build.date)],
+             ["rustc"], self.rustc_stamp),
+            ([("cargo-beta-x.tar.gz", "cargo", ".tar.gz", self.build.date)],
+             ["cargo"], self.cargo_stamp),
+        ]
+        # Which executables were fixed, and whether their stamp existed then
+        self.fixed = []
+
+        def fix(path):
+            name = os.path.basename(path)
+            stamp = self.rustc_stamp if name == "rustc" else self.cargo_stamp
+            self.fixed.append((name, os.path.exists(stamp)))
+        self.build.fix_executables = lambda paths: [fix(path) for path in paths]
+
+    def tearDown(self):
+        rmtree(self.container)
+
+    def fetched(self, filename):
+        """Return what downloading the given tarball returns"""
+        return self.tarballs[filename], None
+
+    def read(self, *path):
+        """Return the contents of a file installed in stage0"""
+        with open(os.path.join(self.build.bin_root(), *path), "rb") as installed:
+            return installed.read()
+
+    def test_out_of_order(self):
+        """Downloads finishing in the reverse order are all unpacked, each
+        stamp is written once its whole group is"""
+        order = ["cargo-beta-x.tar.gz", "rustc-beta-x.tar.gz", "rust-std-beta-x.tar.gz"]
+        done = dict((filename, threading.Event()) for filename in order)
+
+        def download(filename, date=None, progress_bar=True):
+            position = order.index(filename)
+            if position > 0:
+                self.assertTrue(done[order[position - 1]].wait(10))
+            done[filename].set()
+            return self.fetched(filename)
+        self.build._download_stage0_helper = download
+
+        self.build._download_stage0_components(self.groups)
+        self.assertEqual(self.read("lib", "libstd.so"), b"rust-std")
+        self.assertEqual(self.read("bin", "rustc"), b"rustc")
+        self.assertEqual(self.read("bin", "cargo"), b"cargo")
+        self.assertEqual(self.fixed, [("cargo", False), ("rustc", False)])
+        for stamp in (self.rustc_stamp, self.cargo_stamp):
+            with open(stamp) as stamp_file:
+                self.assertEqual(stamp_file.read(), self.build.date)
+
+    def test_failed_download(self):
+        """A group with a failed download gets no stamp, even if its other
+        components were unpacked"""
+        rust_std_unpacked = threading.Event()
+
+        def download(filename, date=None, progress_bar=True):
+            if filename == "rustc-beta-x.tar.gz":
+                # Fail once the other half of the group is installed
+                self.assertTrue(rust_std_unpacked.wait(10))
+                raise RuntimeError("failed to download rustc")
+            return self.fetched(filename)
+        self.build._download_stage0_helper = download
+        real_unpack = bootstrap.unpack
+
+        def unpack(*args, **kwargs):
+            real_unpack(*args, **kwargs)
+            rust_std_unpacked.set()
+        bootstrap.unpack = unpack
+        try:
+            with self.assertRaises(RuntimeError):
+                self.build._download_stage0_components(self.groups[:1])
+        finally:
+            bootstrap.unpack = real_unpack
+        self.assertEqual(self.read("lib", "libstd.so"), b"rust-std")
+        self.assertFalse(os.path.exists(self.rustc_stamp))
+        self.assertEqual(self.fixed, [])
+
+
+class HttpDownloaderTestCase(unittest.TestCase):
+    """Test Case for HttpDownloader"""
+    def setUp(self):
+        self.container = tempfile.mkdtemp()
+        self.content = os.urandom(300 * 1024)
+        with open(os.path.join(self.container, "file.tar.xz"), "wb") as dist:
+            dist.write(self.content)
+        self.server = LocalServer(self.container)
+        self.downloader = bootstrap.HttpDownloader()
+
+    def tearDown(self):
+        self.downloader.close()
+        self.server.stop()
+        rmtree(self.container)
+
+    def test_download(self):
+        """Download a file and hash it on the way"""
+        path = os.path.join(self.container, "downloaded")
+        found = self.downloader.download(path, self.server.url("file.tar.xz"))
+        self.assertEqual(found, hashlib.sha256(self.content).hexdigest())
+        with open(path, "rb") as downloaded:
+            self.assertEqual(downloaded.read(), self.content)
+
+    def test_stream(self):
+        """Hash the whole body even if the consumer stops reading early"""
+        received = []
+        found = self.downloader.stream(self.server.url("file.tar.xz"),
+                                       lambda body: received.append(body.read(10)))
+        self.assertEqual(found, hashlib.sha256(self.content).hexdigest())
+        self.assertEqual(received, [self.content[:10]])
+
+    def test_connection_reuse(self):
+        """Several downloads from one server share a connection"""
+        path = os.path.join(self.container, "downloaded")
+        for _ in range(3):
+            self.downloader.download(path, self.server.url("file.tar.xz"))
+        self.assertEqual(self.downloader.connections_opened, 1)
+
+    def test_missing_file(self):
+        """An HTTP error is reported as a RuntimeError"""
+        path = os.path.join(self.container, "downloaded")
+        self.assertRaises(RuntimeError, self.downloader.download,
+                          path, self.server.url("missing.tar.xz"))
+
+    def test_retry_reason(self):
+        """Every failed attempt says why it failed"""
+        path = os.path.join(self.container, "downloaded")
+        printed = []
+        real_sleep, real_stdout = bootstrap.sleep, sys.stdout
+
+        class Collect(object):
+            """Stand-in for stdout recording everything written"""
+            @staticmethod
+            def write(data):
+                printed.append(data)
+
+            @staticmethod
+            def flush():
+                pass
+
+        bootstrap.sleep, sys.stdout = lambda _: None, Collect()
+        try:
+            with self.assertRaises(SystemExit) as context:
+                bootstrap.download(path, self.server.url("missing.tar.xz"), False, False)
+        finally:
+            bootstrap.sleep, sys.stdout = real_sleep, real_stdout
+            bootstrap.http_downloader.close()
+        reason = "failed to download {}: HTTP 404".format(self.server.url("missing.tar.xz"))
+        retries = [line for line in "".join(printed).splitlines() if line]
+        self.assertEqual(len(retries), 4)
+        for line in retries:
+            self.assertTrue(line.startswith("spurious failure ({}".format(reason)), line)
+        self.assertIn(reason, str(context.exception))
+
+
+class TraceTestCase(unittest.TestCase):
+    """Test Case for tracing downloads"""
+    def setUp(self):
+        self.container = tempfile.mkdtemp()
+        self.content = os.urandom(100 * 1024)
+        with open(os.path.join(self.container, "file.tar.xz"), "wb") as dist:
+            dist.write(self.content)
+        with open(os.path.join(self.container, "file.tar.xz.sha256"), "w") as sums:
+            sums.write(hashlib.sha256(self.content).hexdigest())
+        self.server = LocalServer(self.container)
+        self.trace = os.path.join(self.container, "trace.json")
+        self.tracer = bootstrap.tracer
+        bootstrap.tracer = bootstrap.Tracer(self.trace)
+
+    def tearDown(self):
+        bootstrap.tracer = self.tracer
+        bootstrap.http_downloader.close()
+        self.server.stop()
+        rmtree(self.container)
+
+    def test_download_trace(self):
+        """Downloads are recorded with their size and whether they were cached"""
+        dst = os.path.join(self.container, "downloaded")
+        for _ in range(2):
+            bootstrap.get(self.server.url("file.tar.xz"), dst)
+        bootstrap.tracer.write()
+        with open(self.trace) as trace:
+            events = json.load(trace)["traceEvents"]
+        downloads = [event["args"] for event in events if event["name"] == "download"]
+        self.assertEqual([(args["cache"], args["bytes"]) for args in downloads],
+                         [("miss", len(self.content)), ("hit", 0)])
+        self.assertTrue(any(event["ph"] == "M" for event in events))
+
+
+class MirrorTestCase(unittest.TestCase):
+    """Test Case for downloading from several mirrors"""
+    def setUp(self):
+        self.container = tempfile.mkdtemp()
+        self.content = os.urandom(300 * 1024)
+        self.servers = {}
+        self.expected = hashlib.sha256(self.content).hexdigest()
+        self.dst = os.path.join(self.container, "file.tar.xz")
+
+    def tearDown(self):
+        for server in self.servers.values():
+            server.stop()
+        bootstrap.http_downloader.close()
+        rmtree(self.container)
+
+    def serve(self, name, content=None, **options):
+        """Start a server for `content`, the right file by default"""
+        root = os.path.join(self.container, name)
+        os.mkdir(root)
+        with open(os.path.join(root, "file.tar.xz"), "wb") as dist:
+            dist.write(self.content if content is None else content)
+        with open(os.path.join(root, "file.tar.xz.sha256"), "w") as sums:
+            sums.write(self.expected)
+        self.servers[name] = LocalServer(root, **options)
+        return self.servers[name].url("").rstrip("/")
+
+    def mirrors(self, **options):
+        """Return a MirrorSet of the servers with the primary first"""
+        urls = [self.servers[name].url("").rstrip("/") for name in sorted(self.servers)]
+        return bootstrap.MirrorSet(urls[0], urls[1:], **options)
+
+    def test_fastest(self):
+        """Files come from the server answering the fastest"""
+        primary = self.serve("a-primary", delay=0.4)
+        self.serve("b-slow", delay=0.2)
+        self.serve("c-fast")
+        found = self.mirrors().download(self.dst, primary + "/file.tar.xz", self.expected)
+        self.assertEqual(found, self.expected)
+        self.assertEqual([len(self.servers[name].ranges) for name in sorted(self.servers)],
+                         [0, 0, 1])
+
+    def test_failover(self):
+        """A server delivering a broken file is skipped"""
+        primary = self.serve("a-primary", delay=0.4)
+        self.serve("b-broken", content=b"broken")
+        found = self.mirrors().download(self.dst, primary + "/file.tar.xz", self.expected)
+        self.assertEqual(found, self.expected)
+        with open(self.dst, "rb") as downloaded:
+            self.assertEqual(downloaded.read(), self.content)
+
+    def test_race(self):
+        """A slow transfer is raced against the next server"""
+        primary = self.serve("a-primary", delay=0.2)
+        self.serve("b-throttled", rate=20 * 1024)
+        mirrors = self.mirrors(race_speed=100 * 1024, race_time=1)
+        found = mirrors.download(self.dst, primary + "/file.tar.xz", self.expected)
+        self.assertEqual(found, self.expected)
+        self.assertEqual(len(self.servers["a-primary"].ranges), 1)
+        self.assertEqual(sorted(os.listdir(self.container)),
+                         ["a-primary", "b-throttled", "file.tar.xz"])
+
+    def test_get(self):
+        """Checksums come from the primary even if the file comes from a mirror"""
+        primary = self.serve("a-primary", delay=0.4)
+        self.serve("b-fast")
+        dist_mirrors = bootstrap.dist_mirrors
+        bootstrap.dist_mirrors = self.mirrors()
+        try:
+            bootstrap.get(primary + "/file.tar.xz", self.dst)
+        finally:
+            bootstrap.dist_mirrors = dist_mirrors
+        with open(self.dst, "rb") as downloaded:
+            self.assertEqual(downloaded.read(), self.content)
+        self.assertEqual(len(self.servers["b-fast"].ranges), 1)
+
+
+class ResumeTestCase(unittest.TestCase):
+    """Test Case for resuming partial downloads"""
+    def setUp(self):
+        self.container = tempfile.mkdtemp()
+        self.content = os.urandom(300 * 1024)
+        with open(os.path.join(self.container, "file.tar.xz"), "wb") as dist:
+            dist.write(self.content)
+        with open(os.path.join(self.container, "file.tar.xz.sha256"), "w") as sums:
+            sums.write(hashlib.sha256(self.content).hexdigest())
+        self.dst = os.path.join(self.container, "cache", "file.tar.xz")
+        os.mkdir(os.path.dirname(self.dst))
+        self.downloader = bootstrap.http_downloader
+
+    def tearDown(self):
+        self.downloader.close()
+        rmtree(self.container)
+
+    def get_with_partial_file(self, partial, ranges):
+        """Download with a `.part` file already holding `partial`"""
+        with open(self.dst + ".part", "wb") as part:
+            part.write(partial)
+        server = LocalServer(self.container, ranges)
+        try:
+            bootstrap.get(server.url("file.tar.xz"), self.dst, progress_bar=False)
+        finally:
+            self.downloader.close()
+            server.stop()
+        with open(self.dst, "rb") as downloaded:
+            self.assertEqual(downloaded.read(), self.content)
+        self.assertFalse(os.path.exists(self.dst + ".part"))
+        return server.ranges
+
+    def test_resume(self):
+        """Only the missing part of the file is requested"""
+        ranges = self.get_with_partial_file(self.content[:1000], True)
+        self.assertEqual(ranges, [None, "bytes=1000-"])
+
+    def test_complete_partial_file(self):
+        """A partial file holding everything is only verified"""
+        ranges = self.get_with_partial_file(self.content, True)
+        self.assertEqual(ranges[1], "bytes={}-".format(len(self.content)))
+
+    def test_ranges_unsupported(self):
+        """Download everything again when the server ignores ranges"""
+        self.get_with_partial_file(self.content[:1000], False)
+
+    def test_stale_partial_file(self):
+        """Start over when the partial file doesn't match the download"""
+        ranges = self.get_with_partial_file(b"stale", True)
+        self.assertEqual(ranges, [None, "bytes=5-", None])
+
+
+class FileLockTestCase(unittest.TestCase):
+    """Test Case for FileLock"""
+    def setUp(self):
+        self.container = tempfile.mkdtemp()
+        self.path = os.path.join(self.container, "entry.lock")
+
+    def tearDown(self):
+        rmtree(self.container)
+
+    def test_timeout(self):
+        """Waiting for a lock gives up after the timeout, naming the holder"""
+        with bootstrap.FileLock(self.path):
+            lock = bootstrap.FileLock(self.path, timeout=0.2)
+            with self.assertRaises(RuntimeError) as context:
+                lock.acquire()
+            self.assertIn("held by process {}".format(os.getpid()), str(context.exception))
+        self.assertTrue(lock.acquire(blocking=False))
+        lock.release()
+
+    def test_stale_owner(self):
+        """Without flock() an owner file left behind by a dead process is
+        removed, one of a live process is respected"""
+        child = subprocess.Popen([sys.executable, "-c", ""])
+        child.wait()
+        for pid, acquired in [(os.getpid(), False), (child.pid, True)]:
+            with open(self.path + ".owner", "w") as owner:
+                owner.write("{} {}\n".format(pid, socket.gethostname()))
+            lock = bootstrap.FileLock(self.path)
+            lock.flock = False
+            self.assertEqual(lock.acquire(blocking=False), False)
+            if acquired:
+                # The stale file is removed by the first attempt
+                self.assertTrue(lock.acquire(blocking=False))
+                lock.release()
+                self.assertFalse(os.path.exists(self.path + ".owner"))
+
+    def test_removed(self):
+        """A lock taken on a file which was removed in the meantime is taken
+        again on the file now at its path"""
+        holder = bootstrap.FileLock(self.path)
+        holder.acquire()
+        real_open = os.open
+
+        def open_then_remove(path, *args):
+            # The holder evicts its entry right after the waiter opened the file
+            fd = real_open(path, *args)
+            bootstrap.os.open = real_open
+            holder.remove()
+            return fd
+
+        waiter = bootstrap.FileLock(self.path)
+        bootstrap.os.open = open_then_remove
+        try:
+            self.assertTrue(waiter.acquire(blocking=False))
+        finally:
+            bootstrap.os.open = real_open
+        self.assertEqual(os.fstat(waiter._fd).st_ino, os.stat(self.path).st_ino)
+        self.assertFalse(bootstrap.FileLock(self.path).acquire(blocking=False))
+        waiter.release()
+
+    def test_shared_download(self):
+        """Concurrent downloads of a tarball into the same build directory
+        are done once"""
+        dist = os.path.join(self.container, "dist", "2017-06-15")
+        os.makedirs(dist)
+        with open(os.path.join(dist, "cargo-beta-x.tar.xz"), "wb") as published:
+            published.write(b"cargo")
+        with open(os.path.join(dist, "cargo-beta-x.tar.xz.sha256"), "w") as published:
+            published.write(hashlib.sha256(b"cargo").hexdigest())
+        server = LocalServer(self.container, delay=0.2)
+        builds = []
+        for _ in range(2):
+            build = bootstrap.RustBuild()
+            build.build_dir = os.path.join(self.container, "build")
+            build._download_url = server.url("").rstrip("/")
+            builds.append(build)
+        try:
+            threads = [threading.Thread(target=build._download_stage0_helper,
+                                        args=("cargo-beta-x.tar.xz", "2017-06-15", False))
+                       for build in builds]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        finally:
+            bootstrap.http_downloader.close()
+            server.stop()
+        # The checksum and the tarball, both only once
+        self.assertEqual(len(server.ranges), 2)
+
+
+class Stage0CacheTestCase(unittest.TestCase):
+    """Test Case for Stage0Cache"""
+    def setUp(self):
+        self.container = tempfile.mkdtemp()
+        self.cache = bootstrap.Stage0Cache(self.container)
+        for sha256, size, last_used in [("a", 10, 300), ("b", 20, 100), ("c", 30, 200)]:
+            entry = self.cache.entry(sha256)
+            os.makedirs(entry)
+            path = os.path.join(entry, "{}.tar.xz".format(sha256))
+            with open(path, "wb") as tarball:
+                tarball.write(b"x" * size)
+            os.utime(path, (last_used, last_used))
+
+    def tearDown(self):
+        rmtree(self.container)
+
+    def test_entries(self):
+        """List entries, least recently used first"""
+        entries = [(entry[0], entry[2]) for entry in self.cache.entries()]
+        self.assertEqual(entries, [("b", 20), ("c", 30), ("a", 10)])
+        self.assertEqual(self.cache.size(), 60)
+
+    def test_prune(self):
+        """Evict the least recently used entries first"""
+        evicted = [os.path.basename(entry[0]) for entry in self.cache.prune(15)]
+        self.assertEqual(evicted, ["b", "c"])
+        self.assertEqual([entry[0] for entry in self.cache.entries()], ["a"])
+
+    def test_prune_toolchains(self):
+        """Extracted toolchains count toward the size of the cache and are
+        evicted with the tarballs"""
+        tree = os.path.join(self.container, "toolchains", "2017-06-15", "x", "rustc-beta-x")
+        os.makedirs(os.path.join(tree, "bin"))
+        with open(os.path.join(tree, "bin", "rustc"), "wb") as rustc:
+            rustc.write(b"x" * 1000)
+        os.makedirs(tree + ".tmp-1-2")
+        os.utime(tree, (150, 150))
+        self.assertEqual([os.path.relpath(entry[0], self.container)
+                          for entry in self.cache.evictable()],
+                         [os.path.join("sha256", "b"),
+                          os.path.relpath(tree, self.container),
+                          os.path.join("sha256", "c"), os.path.join("sha256", "a")])
+        self.assertGreater(self.cache.size(), 1060)
+        evicted = [entry[0] for entry in self.cache.prune(45)]
+        self.assertEqual(evicted, [self.cache.entry("b"), tree])
+        self.assertFalse(os.path.exists(tree))
+
+    def test_prune_store_outside(self):
+        """A toolchain store outside of the cache directory is evicted with
+        it as well"""
+        store = tempfile.mkdtemp()
+        try:
+            tree = os.path.join(store, "2017-06-15", "x", "rustc-beta-x")
+            os.makedirs(os.path.join(tree, "bin"))
+            with open(os.path.join(tree, "bin", "rustc"), "wb") as rustc:
+                rustc.write(b"x" * 1000)
+            os.utime(tree, (150, 150))
+            build = bootstrap.RustBuild()
+            build.config_toml = '[build]\nstage0-cache = "{}"\nstage0-store = "{}"'.format(
+                self.container, store)
+            cache = build.stage0_cache()
+            self.assertEqual(cache.describe(tree), tree)
+            self.assertGreater(cache.size(), 1060)
+            evicted = [entry[0] for entry in cache.prune(45)]
+            self.assertEqual(evicted, [cache.entry("b"), tree])
+            self.assertFalse(os.path.exists(tree))
+        finally:
+            rmtree(store)
+
+    def test_verify(self):
+        """Entries which don't match their address are evicted"""
+        entry = self.cache.entry(hashlib.sha256(b"x" * 10).hexdigest())
+        os.makedirs(entry)
+        with open(os.path.join(entry, "good.tar.xz"), "wb") as tarball:
+            tarball.write(b"x" * 10)
+        evicted = [entry[0] for entry in self.cache.verify()]
+        self.assertEqual(evicted, ["b", "c", "a"])
+        self.assertEqual([entry[1] for entry in self.cache.entries()], [["good.tar.xz"]])
+
+    def test_prune_removes_locks(self):
+        """The lock files of evicted entries are deleted with them"""
+        for sha256 in "abc":
+            with self.cache.lock(sha256):
+                pass
+        self.cache.prune(15)
+        self.assertEqual(sorted(os.listdir(os.path.join(self.container, "sha256"))),
+                         ["a", "a.lock"])
+
+    def test_evicted_while_downgrading(self):
+        """A tarball evicted while its lock is downgraded is fetched again"""
+        dist = os.path.join(self.container, "dist")
+        os.makedirs(dist)
+        with open(os.path.join(dist, "cargo-beta-x.tar.xz"), "wb") as published:
+            published.write(b"cargo")
+        server = LocalServer(self.container)
+        cache = self.cache
+        real_fcntl = bootstrap.fcntl
+        evictions = []
+
+        class Fcntl(object):
+            """fcntl letting prune in while the lock is converted"""
+            def __getattr__(self, name):
+                return getattr(real_fcntl, name)
+
+            @staticmethod
+            def flock(fd, operation):
+                if operation == real_fcntl.LOCK_SH and not evictions:
+                    real_fcntl.flock(fd, real_fcntl.LOCK_UN)
+                    evictions.extend(cache.prune(0))
+                real_fcntl.flock(fd, operation)
+
+        bootstrap.fcntl = Fcntl()
+        try:
+            path, lock = cache.fetch(server.url("dist/cargo-beta-x.tar.xz"),
+                                     "cargo-beta-x.tar.xz",
+                                     expected=hashlib.sha256(b"cargo").hexdigest())
+            # The lock is held on the file prune can see
+            self.assertFalse(cache.lock(hashlib.sha256(b"cargo").hexdigest())
+                             .acquire(blocking=False))
+            lock.release()
+        finally:
+            bootstrap.fcntl = real_fcntl
+            bootstrap.http_downloader.close()
+            server.stop()
+        self.assertEqual(len(evictions), 4)
+        self.assertEqual(len(server.ranges), 2)
+        with open(path, "rb") as tarball:
+            self.assertEqual(tarball.read(), b"cargo")
+
+    def test_prune_skips_entries_in_use(self):
+        """Entries locked by someone else are not evicted"""
+        with self.cache.lock("b", shared=True):
+            evicted = [os.path.basename(entry[0]) for entry in self.cache.prune(15)]
+        self.assertEqual(evicted, ["c", "a"])
+
+
+def pseudo_random(size, seed):
+    """Return `size` bytes which look random and depend on `seed`"""
+    return b"".join(hashlib.sha256("{}-{}".format(seed, i).encode()).digest()
+                    for i in range(size // 32))
+
+
+def make_tarball(path, files):
+    """Write a tarball of the given `{name: content}`, compressed according
+    to its extension"""
+    with tarfile.open(path, "w:" + path.rsplit(".", 1)[1]) as tar:
+        for name in sorted(files):
+            info = tarfile.TarInfo(name)
+            info.size = len(files[name])
+            tar.addfile(info, io.BytesIO(files[name]))
+
+
+class DeltaTestCase(unittest.TestCase):
+    """Test Case for deltas between stage0 tarballs"""
+    def setUp(self):
+        self.container = tempfile.mkdtemp()
+        self.files = dict(("rustc/lib/file{:02}".format(i),
+                           pseudo_random(50 * 1024, "file{}".format(i)))
+                          for i in range(20))
+        self.build = bootstrap.RustBuild()
+        self.build.build_dir = os.path.join(self.container, "build")
+        self.build.config_toml = '[build]\nstage0-deltas = true\n'
+        self.base = os.path.join(self.build.build_dir, "cache", "2017-06-15",
+                                 "rustc-beta-x.tar.gz")
+        os.makedirs(os.path.dirname(self.base))
+        make_tarball(self.base, self.files)
+
+        # A file early in the tarball changes
+        self.files["rustc/lib/file02"] = pseudo_random(50 * 1024, "changed")
+        dist = os.path.join(self.container, "dist", "2017-07-20")
+        os.makedirs(dist)
+        self.published = os.path.join(dist, "rustc-beta-x.tar.gz")
+        make_tarball(self.published, self.files)
+        with open(self.published + ".sha256", "w") as published:
+            published.write(bootstrap.sha256_file(self.published))
+        self.server = LocalServer(self.container)
+        self.build._download_url = self.server.url("").rstrip("/")
+
+    def tearDown(self):
+        bootstrap.http_downloader.close()
+        self.server.stop()
+        rmtree(self.container)
+
+    def round_trip(self, base, target):
+        """Check the delta between two tarballs only holds the changed file
+        and rebuilds the target exactly"""
+        delta = os.path.join(self.container, "delta")
+        size = bootstrap.write_delta(base, target, delta)
+        self.assertLess(size, os.path.getsize(target) // 10)
+        output = os.path.join(self.container, "output")
+        found = bootstrap.apply_delta(base, delta, output)
+        self.assertEqual(found, bootstrap.sha256_file(target))
+        self.assertEqual(os.listdir(self.container).count("output.base"), 0)
+
+    def test_round_trip(self):
+        """Only the chunks of the changed member are stored in the delta"""
+        self.round_trip(self.base, self.published)
+
+    @unittest.skipUnless(bootstrap.module_available(bootstrap.lzma), "needs lzma")
+    def test_round_trip_xz(self):
+        """The compression of xz tarballs is reproduced as well"""
+        base = self.base.replace(".tar.gz", ".tar.xz")
+        target = self.published.replace(".tar.gz", ".tar.xz")
+        with tarfile.open(self.base) as tar:
+            make_tarball(base, dict((member.name, tar.extractfile(member).read())
+                                    for member in tar.getmembers()))
+        make_tarball(target, self.files)
+        self.round_trip(base, target)
+
+    def test_irreproducible(self):
+        """No delta is written when the compression can't be reproduced"""
+        # Not a level x.py tries
+        with tarfile.open(self.published, "w:gz", compresslevel=0) as tar:
+            info = tarfile.TarInfo("rustc/lib/file00")
+            info.size = 3
+            tar.addfile(info, io.BytesIO(b"abc"))
+        with self.assertRaises(ValueError):
+            bootstrap.write_delta(self.base, self.published,
+                                  os.path.join(self.container, "delta"))
+
+    def test_download(self):
+        """A published delta is used instead of the tarball, which is only
+        downloaded if there is none"""
+        bootstrap.stage0_delta_main([os.path.dirname(self.base),
+                                     os.path.dirname(self.published)])
+        tarball, _ = self.build._download_stage0_helper("rustc-beta-x.tar.gz", "2017-07-20",
+                                                        False)
+        self.assertEqual(bootstrap.sha256_file(tarball),
+                         bootstrap.sha256_file(self.published))
+        # The checksum and the delta
+        self.assertEqual(len(self.server.ranges), 2)
+
+        os.remove(tarball)
+        for name in os.listdir(os.path.dirname(self.published)):
+            if ".delta-" in name:
+                os.remove(os.path.join(os.path.dirname(self.published), name))
+        self.build._download_stage0_helper("rustc-beta-x.tar.gz", "2017-07-20", False)
+        self.assertEqual(bootstrap.sha256_file(tarball),
+                         bootstrap.sha256_file(self.published))
+        # The checksum, the missing delta and the tarball
+        self.assertEqual(len(self.server.ranges), 5)
+
+    def test_stage0_cache(self):
+        """The most recently used entry of the component is the base in the
+        machine-wide cache"""
+        cache = bootstrap.Stage0Cache(os.path.join(self.container, "cache"))
+        sha256 = bootstrap.sha256_file(self.base)
+        entry = cache.entry(sha256)
+        os.makedirs(entry)
+        base = os.path.join(entry, "rustc-beta-x.tar.gz")
+        os.rename(self.base, base)
+        bootstrap.write_delta(base, self.published, "{}.delta-{}".format(
+            self.published, sha256))
+        url = self.server.url("dist/2017-07-20/rustc-beta-x.tar.gz")
+        path, lock = cache.fetch(url, "rustc-beta-x.tar.gz", delta=True,
+                                 expected=bootstrap.sha256_file(self.published))
+        lock.release()
+        self.assertEqual(bootstrap.sha256_file(path), bootstrap.sha256_file(self.published))
+        self.assertEqual(len(self.server.ranges), 1)
+
+
+class UnpackTestCase(unittest.TestCase):
+    """Test Case for unpack"""
+    def setUp(self):
+        self.container = tempfile.mkdtemp()
+        self.tarball = os.path.join(self.container, "rustc-beta-x.tar.gz")
+        with tarfile.open(self.tarball, "w:gz") as tar:
+            for name, content in [("rustc-beta-x/install.sh", b"#!/bin/sh"),
+                                  ("rustc-beta-x/rustc/bin/rustc", b"rustc"),
+                                  ("rustc-beta-x/rustc/lib/libstd.so", b"std"),
+                                  ("rustc-beta-x/cargo/bin/cargo", b"cargo")]:
+                info = tarfile.TarInfo(name)
+                info.size = len(content)
+                tar.addfile(info, io.BytesIO(content))
+            info = tarfile.TarInfo("rustc-beta-x/rustc/lib/libstd-1.so")
+            info.type = tarfile.LNKTYPE
+            info.linkname = "rustc-beta-x/rustc/lib/libstd.so"
+            tar.addfile(info)
+        self.dst = os.path.join(self.container, "stage0")
+
+    def tearDown(self):
+        rmtree(self.container)
+
+    def read(self, *path):
+        """Return the contents of an unpacked file"""
+        with open(os.path.join(self.dst, *path), "rb") as unpacked:
+            return unpacked.read()
+
+    def test_unpack_component(self):
+        """Only the matching component is unpacked, without its prefix"""
+        bootstrap.unpack(self.tarball, ".tar.gz", self.dst, match="rustc")
+        self.assertEqual(sorted(os.listdir(self.dst)), ["bin", "lib"])
+        self.assertEqual(self.read("bin", "rustc"), b"rustc")
+        self.assertEqual(self.read("lib", "libstd-1.so"), b"std")
+
+    def test_replace_hard_link(self):
+        """Files are replaced instead of written through existing links"""
+        outside = os.path.join(self.container, "outside")
+        with open(outside, "wb") as linked:
+            linked.write(b"old")
+        os.makedirs(os.path.join(self.dst, "bin"))
+        os.link(outside, os.path.join(self.dst, "bin", "rustc"))
+        bootstrap.unpack(self.tarball, ".tar.gz", self.dst, match="rustc")
+        self.assertEqual(self.read("bin", "rustc"), b"rustc")
+        with open(outside, "rb") as linked:
+            self.assertEqual(linked.read(), b"old")
+
+
+class MaterializeTestCase(unittest.TestCase):
+    """Test Case for materialize"""
+    def setUp(self):
+        self.container = tempfile.mkdtemp()
+        self.src = os.path.join(self.container, "store")
+        os.makedirs(os.path.join(self.src, "bin"))
+        with open(os.path.join(self.src, "bin", "rustc"), "w") as rustc:
+            rustc.write("rustc")
+        self.dst = os.path.join(self.container, "stage0")
+
+    def tearDown(self):
+        rmtree(self.container)
+
+    def test_materialize(self):
+        """Recreate the tree, replacing existing files"""
+        os.makedirs(os.path.join(self.dst, "bin"))
+        with open(os.path.join(self.dst, "bin", "rustc"), "w") as rustc:
+            rustc.write("old")
+        bootstrap.materialize(self.src, self.dst)
+        with open(os.path.join(self.dst, "bin", "rustc")) as rustc:
+            self.assertEqual(rustc.read(), "rustc")
+        with open(os.path.join(self.src, "bin", "rustc")) as rustc:
+            self.assertEqual(rustc.read(), "rustc")
+
+
+def fake_elf(path, interpreter, bits=64, order="<"):
+    """Write an ELF file whose only program header is PT_INTERP"""
+    if bits == 64:
+        header = struct.pack(order + "16sHHIQQQIHHHHHH", b"\x7fELF\x02" + (
+            b"\x01" if order == "<" else b"\x02"), 2, 62, 1, 0, 64, 0, 0, 64, 56, 1, 0, 0, 0)
+        phdr = struct.pack(order + "IIQQQQQQ", 3, 4, 120, 0, 0, len(interpreter), 0, 1)
+    else:
+        header = struct.pack(order + "16sHHIIIIIHHHHHH", b"\x7fELF\x01" + (
+            b"\x01" if order == "<" else b"\x02"), 2, 8, 1, 0, 52, 0, 0, 52, 32, 1, 0, 0, 0)
+        phdr = struct.pack(order + "IIIIIIII", 3, 84, 0, 0, len(interpreter), 0, 4, 1)
+    with open(path, "wb") as elf:
+        elf.write(header + phdr + interpreter + b"code")
+
+
+class ElfTestCase(unittest.TestCase):
+    """Test Case for reading and rewriting the interpreter of ELF files"""
+    def setUp(self):
+        self.container = tempfile.mkdtemp()
+        self.path = os.path.join(self.container, "rustc")
+
+    def tearDown(self):
+        rmtree(self.container)
+
+    def test_read(self):
+        """PT_INTERP is found in 32 and 64-bit files of either byte order"""
+        for bits, order, offset in [(64, "<", 120), (32, ">", 84)]:
+            fake_elf(self.path, b"/lib/ld.so\0", bits, order)
+            self.assertEqual(bootstrap.elf_interpreter(self.path), (offset, 11, "/lib/ld.so"))
+        with open(self.path, "w") as script:
+            script.write("#!/bin/sh\n")
+        self.assertIsNone(bootstrap.elf_interpreter(self.path))
+
+    def test_rewrite(self):
+        """The interpreter is rewritten in place when the new one fits"""
+        fake_elf(self.path, b"/lib64/ld-linux-x86-64.so.2\0")
+        self.assertTrue(bootstrap.set_elf_interpreter(self.path, "/nix/ld.so"))
+        self.assertEqual(bootstrap.elf_interpreter(self.path)[1:], (28, "/nix/ld.so"))
+        with open(self.path, "rb") as elf:
+            self.assertTrue(elf.read().endswith(b"/nix/ld.so" + b"\0" * 18 + b"code"))
+
+        # Longer paths go in a new segment, which needs one to start from
+        self.assertFalse(bootstrap.set_elf_interpreter(self.path, "/nix/store/" + "x" * 32))
+        self.assertEqual(bootstrap.elf_interpreter(self.path)[2], "/nix/ld.so")
+
+    @unittest.skipUnless(sys.platform.startswith("linux") and os.path.exists("/bin/true"),
+                         "needs a dynamically linked Linux program")
+    def test_append(self):
+        """The path of the NixOS dynamic linker, longer than the usual one, is
+        appended and the program still runs, later updates fit in place"""
+        found = bootstrap.elf_interpreter(os.path.realpath("/bin/true"))
+        if found is None:
+            self.skipTest("/bin/true is statically linked")
+        copy("/bin/true", self.path)
+        store = os.path.join(self.container, "nix", "store")
+        loaders = []
+        for glibc in ["0123456789abcdfghijklmnpqrsvwxyz-glibc-2.31",
+                      "zyxwvsrqpnmlkjihgfdcba9876543210-glibc-2.32"]:
+            loaders.append(os.path.join(store, glibc, "lib", found[2].split("/")[-1]))
+            os.makedirs(os.path.dirname(loaders[-1]))
+            os.symlink(found[2], loaders[-1])
+        self.assertGreater(len(loaders[0]), found[1])
+
+        self.assertTrue(bootstrap.set_elf_interpreter(self.path, loaders[0]))
+        self.assertEqual(bootstrap.elf_interpreter(self.path)[2], loaders[0])
+        self.assertEqual(subprocess.call([self.path]), 0)
+
+        size = os.path.getsize(self.path)
+        self.assertTrue(bootstrap.set_elf_interpreter(self.path, loaders[1]))
+        self.assertEqual(bootstrap.elf_interpreter(self.path)[2], loaders[1])
+        self.assertEqual(os.path.getsize(self.path), size)
+        self.assertEqual(subprocess.call([self.path]), 0)
+
+
+class VendorTestCase(unittest.TestCase):
+    """Test Case for verifying and restoring vendored crates"""
+    def setUp(self):
+        self.rust_root = tempfile.mkdtemp()
+        self.vendor = os.path.join(self.rust_root, "vendor")
+        self.cache = os.path.join(self.rust_root, "build", ".vendor-checksums")
+        self.crate_file = os.path.join(self.rust_root, "cargo", "registry", "cache",
+                                       "index", "b-1.0.0.crate")
+        os.makedirs(os.path.dirname(self.crate_file))
+        with tarfile.open(self.crate_file, "w:gz") as tar:
+            for name, content in [("b-1.0.0/src/lib.rs", b"b"), ("b-1.0.0/.gitignore", b"x")]:
+                info = tarfile.TarInfo(name)
+                info.size = len(content)
+                tar.addfile(info, io.BytesIO(content))
+        package = bootstrap.sha256_file(self.crate_file)
+        for crate, content, checksum in [("a", b"a", None), ("b", b"b", package)]:
+            os.makedirs(os.path.join(self.vendor, crate, "src"))
+            with open(os.path.join(self.vendor, crate, "src", "lib.rs"), "wb") as source:
+                source.write(content)
+            with open(os.path.join(self.vendor, crate, ".cargo-checksum.json"), "w") as sums:
+                json.dump({"files": {"src/lib.rs": hashlib.sha256(content).hexdigest()},
+                           "package": checksum}, sums)
+        with open(os.path.join(self.rust_root, "Cargo.lock"), "w") as lock:
+            lock.write('[[package]]\nname = "b"\nversion = "1.0.0"\n'
+                       'checksum = "{}"\n'.format(package))
+        self.build = bootstrap.RustBuild()
+        self.build.rust_root = self.rust_root
+        self.build.build_dir = os.path.join(self.rust_root, "build")
+        self.build.use_vendored_sources = True
+        self.cargo_home = os.environ.get("CARGO_HOME")
+        os.environ["CARGO_HOME"] = os.path.join(self.rust_root, "cargo")
+
+    def tearDown(self):
+        if self.cargo_home is None:
+            del os.environ["CARGO_HOME"]
+        else:
+            os.environ["CARGO_HOME"] = self.cargo_home
+        rmtree(self.rust_root)
+
+    def corrupt(self, crate):
+        """Change the source of the given crate"""
+        with open(os.path.join(self.vendor, crate, "src", "lib.rs"), "ab") as source:
+            source.write(b"changed")
+
+    def test_verify(self):
+        """Broken crates are reported and unchanged files aren't hashed again"""
+        os.makedirs(self.build.build_dir)
+        self.assertEqual(bootstrap.verify_vendored(self.vendor, self.cache, 2), [])
+        self.corrupt("b")
+        hashed = []
+        sha256_file = bootstrap.sha256_file
+        bootstrap.sha256_file = lambda path: hashed.append(path) or sha256_file(path)
+        try:
+            self.assertEqual(bootstrap.verify_vendored(self.vendor, self.cache, 2), ["b"])
+        finally:
+            bootstrap.sha256_file = sha256_file
+        self.assertEqual(hashed, [os.path.join(self.vendor, "b", "src", "lib.rs")])
+
+    def test_restore(self):
+        """A broken crate is restored from Cargo's cache without re-vendoring"""
+        self.corrupt("b")
+        self.build.ensure_vendored()
+        self.assertTrue(self.build.work_done)
+        self.assertEqual(sorted(os.listdir(os.path.join(self.vendor, "b"))),
+                         [".cargo-checksum.json", "src"])
+        self.assertEqual(bootstrap.verify_vendored(self.vendor, self.cache, 2), [])
+
+    def test_unchanged(self):
+        """Nothing is checked again until Cargo.lock or the vendor directory
+        is modified"""
+        os.makedirs(self.build.build_dir)
+        self.build.ensure_vendored()
+        self.assertFalse(self.build.work_done)
+        self.corrupt("b")
+        verify_vendored = bootstrap.verify_vendored
+        bootstrap.verify_vendored = lambda *args: self.fail("verified again")
+        try:
+            self.build.ensure_vendored()
+        finally:
+            bootstrap.verify_vendored = verify_vendored
+        self.assertFalse(self.build.work_done)
+
+        os.utime(self.vendor, (0, os.stat(self.vendor).st_mtime + 1))
+        self.build.ensure_vendored()
+        self.assertTrue(self.build.work_done)
+        self.assertEqual(bootstrap.verify_vendored(self.vendor, self.cache, 2), [])
+
+
+class BootstrapFingerprintTestCase(unittest.TestCase):
+    """Test Case for skipping the build of bootstrap"""
+    def setUp(self):
+        self.container = tempfile.mkdtemp()
+        self.rust_root = os.path.join(self.container, "rust")
+        for path, content in [("Cargo.lock", "# lock"),
+                              ("src/bootstrap/Cargo.toml",
+                               '[[bin]]\nname = "bootstrap"\n[[bin]]\nname = "rustc"\n'),
+                              ("src/bootstrap/lib.rs", "// lib"),
+                              ("src/build_helper/lib.rs", "// helper")]:
+            path = os.path.join(self.rust_root, path)
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            with open(path, "w") as source:
+                source.write(content)
+        self.build = self.new_build("build")
+        self.env = {"RUSTFLAGS": "-Dwarnings", "HOME": "/home"}
+
+    def tearDown(self):
+        rmtree(self.container)
+
+    def new_build(self, build_dir):
+        """Return a RustBuild using the given build directory"""
+        build = bootstrap.RustBuild()
+        build.rust_root = self.rust_root
+        build.build_dir = os.path.join(self.container, build_dir)
+        build.build = "x86_64-unknown-linux-gnu"
+        build.config_toml = '[build]\nstage0-cache = "{}"'.format(
+            os.path.join(self.container, "cache").replace("\\", "/"))
+        return build
+
+    def build_binaries(self, build):
+        """Pretend that cargo built the bootstrap binaries"""
+        for binary in build.bootstrap_binaries():
+            if not os.path.isdir(os.path.dirname(binary)):
+                os.makedirs(os.path.dirname(binary))
+            with open(binary, "w") as built:
+                built.write("binary")
+
+    def test_fingerprint(self):
+        """Only relevant inputs change the fingerprint"""
+        fingerprint = self.build.bootstrap_fingerprint(self.env)
+        self.env["HOME"] = "/elsewhere"
+        self.assertEqual(self.build.bootstrap_fingerprint(self.env), fingerprint)
+        self.env["RUSTFLAGS"] = ""
+        self.assertNotEqual(self.build.bootstrap_fingerprint(self.env), fingerprint)
+        self.env["RUSTFLAGS"] = "-Dwarnings"
+        with open(os.path.join(self.rust_root, "src/bootstrap/lib.rs"), "w") as lib:
+            lib.write("// changed")
+        self.assertNotEqual(self.build.bootstrap_fingerprint(self.env), fingerprint)
+
+    def test_fingerprint_channels(self):
+        """The channel of each stage0 program goes into the fingerprint"""
+        os.makedirs(self.build.bin_root())
+        for stamp in (self.build.rustc_stamp(), self.build.cargo_stamp()):
+            with open(stamp, "w") as stamp_file:
+                stamp_file.write("2017-06-15")
+        self.build.rustc_channel = self.build.cargo_channel = "beta"
+        fingerprint = self.build.bootstrap_fingerprint(self.env)
+        self.build.cargo_channel = "nightly"
+        self.assertNotEqual(self.build.bootstrap_fingerprint(self.env), fingerprint)
+
+    def test_evict_binaries(self):
+        """Cached bootstrap binaries count toward the size of the cache"""
+        self.build_binaries(self.build)
+        self.build.save_bootstrap("old")
+        old = os.path.join(self.container, "cache", "bootstrap", "old")
+        os.utime(old, (100, 100))
+        self.build.config_toml += '\nstage0-cache-size = "20"'
+        self.build.save_bootstrap("new")
+        self.assertFalse(os.path.exists(old))
+        self.assertTrue(self.build.bootstrap_up_to_date("new"))
+
+    def test_up_to_date(self):
+        """Skip the build when the fingerprint matches"""
+        fingerprint = self.build.bootstrap_fingerprint(self.env)
+        self.assertFalse(self.build.bootstrap_up_to_date(fingerprint))
+        self.build_binaries(self.build)
+        self.build.save_bootstrap(fingerprint)
+        self.assertTrue(self.build.bootstrap_up_to_date(fingerprint))
+        self.assertFalse(self.build.bootstrap_up_to_date("other"))
+
+    def test_shared_binaries(self):
+        """Another build directory reuses binaries with the same fingerprint"""
+        fingerprint = self.build.bootstrap_fingerprint(self.env)
+        self.build_binaries(self.build)
+        self.build.save_bootstrap(fingerprint)
+        other = self.new_build("other")
+        self.assertTrue(other.bootstrap_up_to_date(fingerprint))
+        for binary in other.bootstrap_binaries():
+            self.assertTrue(os.path.exists(binary))
+
+    def test_help_snapshot(self):
+        """Help is reused for the same arguments and sources only"""
+        self.build.fingerprint = self.build.bootstrap_fingerprint(self.build.bootstrap_env())
+        self.build.save_help_snapshot(["build", "-h"], 0, u"Usage: x.py build\n")
+        self.assertEqual(self.build.help_snapshot(["build", "-h"]), (0, u"Usage: x.py build\n"))
+        self.assertIsNone(self.build.help_snapshot(["test", "-h"]))
+        with open(os.path.join(self.rust_root, "src/bootstrap/lib.rs"), "w") as lib:
+            lib.write("// changed")
+        self.assertIsNone(self.build.help_snapshot(["build", "-h"]))
+
+
+class SubmoduleTestCase(unittest.TestCase):
+    """Test Case for updating submodules"""
+    def setUp(self):
+        self.container = tempfile.mkdtemp()
+        self.environ = dict(os.environ)
+        os.environ.update({
+            "GIT_AUTHOR_NAME": "test", "GIT_AUTHOR_EMAIL": "test@example.com",
+            "GIT_COMMITTER_NAME": "test", "GIT_COMMITTER_EMAIL": "test@example.com",
+            # Submodules are cloned from local paths
+            "GIT_CONFIG_COUNT": "1", "GIT_CONFIG_KEY_0": "protocol.file.allow",
+            "GIT_CONFIG_VALUE_0": "always",
+        })
+        self.rust_root = os.path.join(self.container, "rust")
+        self.commits = {}
+        for name in ["one", "two", "rust"]:
+            self.git(self.container, "init", "-q", name)
+            self.commit(os.path.join(self.container, name))
+        for name in ["one", "two"]:
+            self.git(self.rust_root, "submodule", "-q", "add", "../" + name, name)
+        self.git(self.rust_root, "commit", "-qm", "submodules")
+        self.build = bootstrap.RustBuild()
+        self.build.rust_root = self.rust_root
+        self.build.build_dir = os.path.join(self.container, "build")
+        self.build.config_toml = '[build]\nsubmodule-jobs = 2'
+
+    def tearDown(self):
+        os.environ.clear()
+        os.environ.update(self.environ)
+        rmtree(self.container)
+
+    @staticmethod
+    def git(cwd, *args):
+        """Run git in `cwd` and return its output"""
+        return bootstrap.subprocess.check_output(
+            ("git",) + args, cwd=cwd).decode("utf-8").strip()
+
+    def commit(self, repository):
+        """Add a commit to `repository` and return its hash"""
+        self.git(repository, "commit", "-q", "--allow-empty", "-m", "commit")
+        return self.git(repository, "rev-parse", "HEAD")
+
+    def test_read_git_head(self):
+        """HEAD is resolved from loose and packed refs"""
+        gitdir = bootstrap.git_dir(os.path.join(self.rust_root, "one"))
+        self.assertTrue(os.path.isdir(gitdir))
+        expected = self.git(self.rust_root, "rev-parse", "HEAD")
+        self.assertEqual(bootstrap.read_git_head(os.path.join(self.rust_root, ".git")),
+                         expected)
+        self.git(self.rust_root, "pack-refs", "--all")
+        self.assertEqual(bootstrap.read_git_head(os.path.join(self.rust_root, ".git")),
+                         expected)
+
+    def test_update(self):
+        """Out-of-date submodules are updated and the result is remembered"""
+        upstream = {}
+        for name in ["one", "two"]:
+            upstream[name] = self.commit(os.path.join(self.container, name))
+            module = os.path.join(self.rust_root, name)
+            self.git(module, "pull", "-q", "origin", "HEAD")
+            self.git(self.rust_root, "add", name)
+            self.git(module, "checkout", "-q", "HEAD~")
+        self.git(self.rust_root, "commit", "-qm", "update")
+
+        self.assertFalse(self.build.submodules_unchanged())
+        self.build.update_submodules()
+        for name in ["one", "two"]:
+            self.assertEqual(
+                self.git(os.path.join(self.rust_root, name), "rev-parse", "HEAD"),
+                upstream[name])
+        self.assertTrue(self.build.submodules_unchanged())
+
+        self.git(os.path.join(self.rust_root, "two"), "checkout", "-q", "HEAD~")
+        self.assertFalse(self.build.submodules_unchanged())
+
+    def test_reference(self):
+        """A fresh checkout borrows objects from a reference checkout"""
+        self.git(self.container, "clone", "-q", self.rust_root, "other")
+        build = bootstrap.RustBuild()
+        build.rust_root = os.path.join(self.container, "other")
+        build.build_dir = os.path.join(self.container, "other-build")
+        build.config_toml = '[build]\nsubmodule-reference = "{}"'.format(
+            self.rust_root.replace("\\", "/"))
+        build.update_submodules()
+        for name in ["one", "two"]:
+            module = os.path.join(build.rust_root, name)
+            self.assertEqual(self.git(module, "rev-parse", "HEAD"),
+                             self.git(os.path.join(self.rust_root, name), "rev-parse", "HEAD"))
+            alternates = os.path.join(bootstrap.git_dir(module), "objects", "info", "alternates")
+            self.assertTrue(os.path.exists(alternates))
+
+
+class HandoffTestCase(unittest.TestCase):
+    """Test Case for replacing x.py with bootstrap"""
+    def setUp(self):
+        self.container = tempfile.mkdtemp()
+
+    def tearDown(self):
+        rmtree(self.container)
+
+    @unittest.skipUnless(os.name == "posix", "x.py only execs into bootstrap on Unix")
+    def test_exec(self):
+        """bootstrap gets the start time of x.py for its summary, and a failed
+        build exits with 1 like x.py does"""
+        fake = os.path.join(self.container, "bootstrap")
+        with open(fake, "w") as script:
+            # Like bin/main.rs, which maps every failure to 1 on this path
+            script.write('#!/bin/sh\necho "$BOOTSTRAP_START_TIME $*"\nexit 1\n')
+        os.chmod(fake, 0o755)
+        code = ("import os, sys; sys.path.insert(0, {!r}); import bootstrap; "
+                "bootstrap.exec_bootstrap([{!r}, 'build'], dict(os.environ), 12.5)").format(
+                    os.path.dirname(os.path.abspath(bootstrap.__file__)), fake)
+        child = subprocess.Popen([sys.executable, "-c", code], stdout=subprocess.PIPE)
+        stdout, _ = child.communicate()
+        self.assertEqual(child.returncode, 1)
+        self.assertEqual(stdout.decode().strip(), "12.5 build")
+
+    @unittest.skipUnless(os.name == "posix", "the fake bootstrap is a shell script")
+    def test_help_failure(self):
+        """A failure of bootstrap printing help exits with 1 like x.py does,
+        after the command which failed"""
+        fake = os.path.join(self.container, "bootstrap")
+        with open(fake, "w") as script:
+            script.write('#!/bin/sh\necho "Usage: x.py $*"\nexit 3\n')
+        os.chmod(fake, 0o755)
+
+        class Stdout(object):
+            """Stand-in for stdout with a binary buffer"""
+            buffer = io.BytesIO()
+
+            @staticmethod
+            def flush():
+                pass
+
+        stdout = sys.stdout
+        sys.stdout = Stdout()
+        try:
+            status, text = bootstrap.run_help([fake, "build", "-h"])
+        finally:
+            sys.stdout = stdout
+        self.assertEqual(status, 1)
+        self.assertEqual(text, u"Usage: x.py build -h\nfailed to run: {} build -h\n".format(fake))
+        self.assertEqual(Stdout.buffer.getvalue().decode(), text)
+
+
+class Stage0RustfmtTestCase(unittest.TestCase):
+    """Test Case for `bootstrap.py stage0-rustfmt`"""
+    def setUp(self):
+        self.container = tempfile.mkdtemp()
+        os.makedirs(os.path.join(self.container, "src"))
+        self.write_stage0("rustfmt: nightly-2017-06-14\n")
+        self.env = dict(os.environ, SRC=self.container, BUILD="x",
+                        BUILD_DIR=os.path.join(self.container, "build"),
+                        BOOTSTRAP_CONFIG=os.path.join(self.container, "config.toml"))
+
+    def tearDown(self):
+        rmtree(self.container)
+
+    def write_stage0(self, extra):
+        """Write src/stage0.txt with the given extra lines"""
+        with open(os.path.join(self.container, "src", "stage0.txt"), "w") as stage0:
+            stage0.write("date: 2017-06-15\nrustc: beta\ncargo: beta\n" + extra)
+
+    def stage0_rustfmt(self):
+        """Run the command with a download_stage0 that reports progress
+        from both x.py and a program it runs, and only installs rustfmt"""
+        code = """if 1:
+            import os, subprocess, sys
+            sys.path.insert(0, {!r})
+            import bootstrap
+            def download_stage0(build):
+                print("downloading rustfmt")
+                sys.stdout.flush()
+                subprocess.check_call([sys.executable, "-c", "print('unpacking rustfmt')"])
+                os.makedirs(os.path.dirname(build.rustfmt()))
+                open(build.rustfmt(), "w").close()
+                with open(build.rustfmt_stamp(), "w") as stamp:
+                    stamp.write(build.date)
+            bootstrap.RustBuild.download_stage0 = download_stage0
+            sys.exit(bootstrap.stage0_rustfmt_main([]))
+            """.format(os.path.dirname(os.path.abspath(bootstrap.__file__)))
+        child = subprocess.Popen([sys.executable, "-c", code], env=self.env,
+                                 stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        stdout, stderr = child.communicate()
+        self.assertEqual(child.returncode, 0, stderr)
+        return stdout.decode(), stderr.decode()
+
+    def rust_build(self):
+        """Return a RustBuild configured like the one of x.py"""
+        build = bootstrap.RustBuild()
+        build.rust_root = self.container
+        build.build_dir = self.env["BUILD_DIR"]
+        build.build = "x"
+        build.read_stage0_data()
+        return build
+
+    def test_download_on_demand(self):
+        """rustfmt is downloaded when asked for, only its path is printed on
+        stdout, and x.py hands it to bootstrap from then on"""
+        build = self.rust_build()
+        self.assertFalse(build.rustfmt_ready())
+        stdout, stderr = self.stage0_rustfmt()
+        self.assertEqual(stdout.splitlines(), [build.rustfmt()])
+        self.assertIn("downloading rustfmt", stderr)
+        self.assertIn("unpacking rustfmt", stderr)
+        self.assertTrue(build.rustfmt_ready())
+
+    def test_no_rustfmt(self):
+        """Nothing is printed on channels without rustfmt"""
+        self.write_stage0("")
+        self.assertEqual(self.stage0_rustfmt(), ("", ""))
+        self.assertIsNone(self.rust_build().rustfmt())
+
+
+class PhasesTestCase(unittest.TestCase):
+    """Test Case for running bootstrap phases concurrently"""
+    def setUp(self):
+        self.stdout = sys.stdout
+        self.written = []
+
+        class Collect(object):
+            """Stand-in for stdout recording everything written"""
+            @staticmethod
+            def write(data):
+                self.written.append(data)
+
+            @staticmethod
+            def flush():
+                pass
+
+        sys.stdout = Collect()
+
+    def tearDown(self):
+        sys.stdout = self.stdout
+
+    def lines(self):
+        """Return the lines written so far"""
+        return "".join(self.written).splitlines()
+
+    def test_grouped_output(self):
+        """Output of a later phase is held back until earlier ones finished"""
+        second_done = threading.Event()
+
+        def first():
+            print("first 1")
+            second_done.wait(10)
+            print("first 2")
+
+        def second():
+            print("second 1")
+            list(bootstrap.parallel_imap(lambda _: print("second worker"), [1, 2], 2))
+            second_done.set()
+
+        bootstrap.run_phases([("first", first, []), ("second", second, [])])
+        self.assertEqual(self.lines(), ["first 1", "first 2", "second 1",
+                                        "second worker", "second worker"])
+
+    def test_failure(self):
+        """Phases depending on a failed one are not started"""
+        ran = []
+
+        def fail():
+            raise RuntimeError("failed")
+
+        with self.assertRaises(RuntimeError):
+            bootstrap.run_phases([
+                ("fail", fail, []),
+                ("independent", lambda: ran.append("independent"), []),
+                ("dependent", lambda: ran.append("dependent"), ["fail"]),
+            ])
+        self.assertEqual(ran, ["independent"])
+        self.assertEqual(sys.stdout.__class__.__name__, "Collect")
+
+    def test_cancel(self):
+        """A failing phase cuts the downloads and workers of others short"""
+        root = tempfile.mkdtemp()
+        with open(os.path.join(root, "big.tar.gz"), "wb") as published:
+            published.write(b"x" * 10 * 1024 * 1024)
+        # At this rate the download would take 100 seconds
+        server = LocalServer(root, rate=100 * 1024)
+        cancel = threading.Event()
+        started = threading.Event()
+        processed = []
+
+        def stage0():
+            bootstrap.download(os.path.join(root, "big.part"), server.url("big.tar.gz"),
+                               False, False, False)
+
+        def submodules():
+            def update(module):
+                started.set()
+                processed.append(module)
+                time.sleep(0.1)
+            list(bootstrap.parallel_imap(update, range(100), 2, cancel))
+
+        def fail():
+            started.wait(10)
+            while not server.ranges:
+                time.sleep(0.01)
+            raise RuntimeError("failed")
+
+        bootstrap.http_downloader.cancel = cancel
+        start = time.time()
+        try:
+            with self.assertRaises(RuntimeError) as context:
+                bootstrap.run_phases([
+                    ("stage0", stage0, []),
+                    ("submodules", submodules, []),
+                    ("fail", fail, []),
+                ], cancel)
+        finally:
+            bootstrap.http_downloader.cancel = None
+            bootstrap.http_downloader.close()
+            server.stop()
+            rmtree(root)
+        self.assertEqual(str(context.exception), "failed")
+        self.assertTrue(cancel.is_set())
+        self.assertLess(time.time() - start, 5)
+        self.assertLess(len(processed), 100)
+
 
 class ProgramOutOfDate(unittest.TestCase):
     """Test if a program is out of date"""
@@ -99,7 +1757,26 @@ if __name__ == '__main__':
     SUITE.addTest(doctest.DocTestSuite(bootstrap))
     SUITE.addTests([
         TEST_LOADER.loadTestsFromTestCase(Stage0DataTestCase),
+        TEST_LOADER.loadTestsFromTestCase(BuildTripleTestCase),
+        TEST_LOADER.loadTestsFromTestCase(ConfigTomlTestCase),
         TEST_LOADER.loadTestsFromTestCase(VerifyTestCase),
+        TEST_LOADER.loadTestsFromTestCase(Stage0ComponentsTestCase),
+        TEST_LOADER.loadTestsFromTestCase(HttpDownloaderTestCase),
+        TEST_LOADER.loadTestsFromTestCase(TraceTestCase),
+        TEST_LOADER.loadTestsFromTestCase(MirrorTestCase),
+        TEST_LOADER.loadTestsFromTestCase(ResumeTestCase),
+        TEST_LOADER.loadTestsFromTestCase(FileLockTestCase),
+        TEST_LOADER.loadTestsFromTestCase(Stage0CacheTestCase),
+        TEST_LOADER.loadTestsFromTestCase(DeltaTestCase),
+        TEST_LOADER.loadTestsFromTestCase(UnpackTestCase),
+        TEST_LOADER.loadTestsFromTestCase(MaterializeTestCase),
+        TEST_LOADER.loadTestsFromTestCase(ElfTestCase),
+        TEST_LOADER.loadTestsFromTestCase(VendorTestCase),
+        TEST_LOADER.loadTestsFromTestCase(BootstrapFingerprintTestCase),
+        TEST_LOADER.loadTestsFromTestCase(SubmoduleTestCase),
+        TEST_LOADER.loadTestsFromTestCase(HandoffTestCase),
+        TEST_LOADER.loadTestsFromTestCase(Stage0RustfmtTestCase),
+        TEST_LOADER.loadTestsFromTestCase(PhasesTestCase),
         TEST_LOADER.loadTestsFromTestCase(ProgramOutOfDate)])
 
     RUNNER = unittest.TextTestRunner(stream=sys.stdout, verbosity=2)
@@ -221,6 +221,18 @@ struct Build {
     configure_args: Option<Vec<String>>,
     local_rebuild: Option<bool>,
     print_step_timings: Option<bool>,
+    download_jobs: Option<u32>,
+    downloader: Option<String>,
+    stage0_cache: Option<String>,
+    stage0_cache_size: Option<String>,
+    stream_extract: Option<bool>,
+    stage0_deltas: Option<bool>,
+    stage0_store: Option<String>,
+    submodule_jobs: Option<u32>,
+    submodule_clone: Option<String>,
+    submodule_reference: Option<String>,
+    dist_mirrors: Option<Vec<String>>,
+    lock_timeout: Option<f64>,
 }
 
 /// TOML representation of various global install decisions.
@@ -3,8 +3,9 @@
 use crate::Build;
 use build_helper::t;
 use ignore::WalkBuilder;
-use std::path::Path;
-use std::process::Command;
+use std::env;
+use std::path::{Path, PathBuf};
+use std::process::{Command, Stdio};
 
 fn rustfmt(src: &Path, rustfmt: &Path, path: &Path, check: bool) {
     let mut cmd = Command::new(&rustfmt);
@@ -28,6 +29,29 @@ struct RustfmtConfig {
     ignore: Vec<String>,
 }
 
+/// Asks bootstrap.py for the stage0 rustfmt, which x.py only downloads up front
+/// for `x.py fmt` itself. Returns `None` on channels without rustfmt, when
+/// bootstrap wasn't started by x.py, or when the download failed. The download
+/// progress goes to stderr.
+fn fetch_rustfmt(build: &Build) -> Option<PathBuf> {
+    let python = env::var_os("BOOTSTRAP_PYTHON")?;
+    let mut cmd = Command::new(python);
+    cmd.arg(build.src.join("src/bootstrap/bootstrap.py")).arg("stage0-rustfmt");
+    let output = match cmd.stderr(Stdio::inherit()).output() {
+        Ok(output) if output.status.success() => output,
+        Ok(output) => {
+            eprintln!("failed to download rustfmt: {:?} exited with {}", cmd, output.status);
+            return None;
+        }
+        Err(e) => {
+            eprintln!("failed to download rustfmt: failed to execute {:?}: {}", cmd, e);
+            return None;
+        }
+    };
+    let stdout = String::from_utf8_lossy(&output.stdout);
+    stdout.lines().rev().map(str::trim).find(|line| !line.is_empty()).map(PathBuf::from)
+}
+
 pub fn format(build: &Build, check: bool) {
     let mut builder = ignore::types::TypesBuilder::new();
     builder.add_defaults();
@@ -47,7 +71,8 @@ pub fn format(build: &Build, check: bool) {
     }
     let ignore_fmt = ignore_fmt.build().unwrap();
 
-    let rustfmt_path = build.config.initial_rustfmt.as_ref().unwrap_or_else(|| {
+    let rustfmt_path = build.config.initial_rustfmt.clone().or_else(|| fetch_rustfmt(build));
+    let rustfmt_path = rustfmt_path.unwrap_or_else(|| {
         eprintln!("./x.py fmt is not supported on this channel");
         std::process::exit(1);
     });